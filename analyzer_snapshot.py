@@ -0,0 +1,66 @@
+import os
+import pickle
+from typing import Dict, Iterable, Union
+
+# snapshot of the analyzers (stop words, number map, memoized terms and tags, see TextProcessing.state and
+# CustomizedTextProcessing.state) in a pickle of builtin types. loading it takes a few milliseconds where creating
+# the analyzers imports nltk and reads its stop word corpus, so a new worker starts without nltk; the stemmer, the
+# tagger and the nltk tokenizer are only loaded when a token is not in the snapshot (see preload)
+ANALYZER_SNAPSHOT = os.environ.get("BRS_ANALYZER_SNAPSHOT")
+SNAPSHOT_VERSION = 1
+
+
+def save_snapshot(analyzers: Dict[str, object], path: Union[str, os.PathLike]) -> None:
+    """
+    write the state of the analyzers, atomically so that a running app never reads a partial snapshot
+    :param analyzers: analyzer name -> TextProcessing like object with state and from_state
+    :param path:
+    :return:
+    """
+    snapshot = {'version': SNAPSHOT_VERSION,
+                'analyzers': {name: (type(analyzer), analyzer.state()) for name, analyzer in analyzers.items()}}
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+
+def load_snapshot(path: Union[str, os.PathLike]) -> Dict[str, object]:
+    """
+    :param path:
+    :return: analyzer name -> analyzer restored from the snapshot
+    """
+    with open(path, "rb") as f:
+        snapshot = pickle.load(f)
+    if snapshot.get('version') != SNAPSHOT_VERSION:
+        raise ValueError(f"analyzer snapshot {path} has version {snapshot.get('version')}, expected "
+                         f"{SNAPSHOT_VERSION}: write it again with python hw3.py --analyzer-snapshot")
+    return {name: cls.from_state(state) for name, (cls, state) in snapshot['analyzers'].items()}
+
+
+def warm_up_analyzers(analyzers: Iterable, texts: Iterable[str]) -> None:
+    """
+    normalize the tokens of the texts (e.g. the titles of the corpus and a query log) so that their surface forms are
+    in the term caches of the analyzers before the snapshot is written. the analyzers without a term cache are left
+    as they are, their tags depend on the context
+    :param analyzers:
+    :param texts:
+    :return:
+    """
+    analyzers = [analyzer for analyzer in analyzers if hasattr(analyzer, "term_cache")]
+    for text in texts:
+        for analyzer in analyzers:
+            analyzer.get_normalized_tokens("", text)
+
+
+def preload(analyzers: Iterable) -> None:
+    """
+    load the nltk resources the analyzers use lazily (tokenizer, stemmer), e.g. in a background thread once the app
+    is ready, so that the first query does not wait for them
+    :param analyzers:
+    :return:
+    """
+    for analyzer in analyzers:
+        analyzer.tokenizer.tokenize("")
+        if hasattr(analyzer, "stemmer"):
+            analyzer.stemmer("preload")
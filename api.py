@@ -0,0 +1,211 @@
+import asyncio
+import os
+from functools import partial
+from typing import Dict, List, Optional, Tuple
+
+from motor.motor_asyncio import AsyncIOMotorClient
+from quart import Quart, jsonify, request
+
+from inverted_index import ANALYZERS, DEFAULT_ANALYZER, index_collection, stats_collection, stopwords_in_query, \
+    query_key, positive_terms, prune_unknown, evaluate, expand_wildcards, wildcard_expansions, phrase_terms, \
+    index_check_due, index_generation, set_index_generation
+from postings_cache import PostingsCache
+from storage import INDEX_META, MongoStorage, get_storage, positions_collection, join_positions
+from query_parser import parse_query
+from ranking import DocLengths, bm25_top_k
+from utils import TTLCache
+
+# asynchronous JSON search API, served by an ASGI server: hypercorn -w 4 api:app
+# unlike hw3 the requests of a worker share one event loop, so a worker keeps serving other requests while the
+# postings and documents of a query are fetched from mongo
+app = Quart(__name__)
+
+PAGE_SIZE = 8
+RANKED_DEPTH_PAGES = 5
+# size of the connection pool of each worker to mongo
+MONGO_POOL_SIZE = int(os.environ.get("BRS_MONGO_POOL_SIZE", 100))
+# requests that take longer than this many seconds are answered with a 504
+REQUEST_TIMEOUT = float(os.environ.get("BRS_API_TIMEOUT", 2.0))
+
+db = None
+RESULT_CACHE = TTLCache(maxsize=1024, ttl=300)
+# analyzer -> (generation, doc lengths)
+_doc_lengths = {}
+
+
+@app.before_serving
+async def connect() -> None:
+    # the client is bound to the event loop of the server, so it is created once the loop runs. it connects to the
+    # database of the storage set by BRS_STORAGE (see storage.get_storage), which has to be a mongo one
+    global db
+    storage = get_storage()
+    if not isinstance(storage, MongoStorage):
+        raise RuntimeError(f"api.py only serves indexes stored in mongo, BRS_STORAGE is "
+                           f"{os.environ.get('BRS_STORAGE')!r}: use hw3.py for the other storages")
+    client = AsyncIOMotorClient(storage.host, storage.port, maxPoolSize=MONGO_POOL_SIZE,
+                                serverSelectionTimeoutMS=int(REQUEST_TIMEOUT * 1000),
+                                socketTimeoutMS=int(REQUEST_TIMEOUT * 1000))
+    db = client[storage.name]
+
+
+async def query_db_index_many(tokens: List[str], positions: bool = True,
+                              collection: str = "inverted_index") -> Dict[str, Dict]:
+    """
+    motor version of mongo_db.query_db_index_many
+    :param tokens:
+    :param positions:
+    :param collection:
+    :return:
+    """
+    cursor = db[collection].find({'token': {'$in': list(tokens)}}, {'_id': 0})
+    post_dicts = {post_dict['token']: post_dict async for post_dict in cursor}
+    if positions and post_dicts:
+        cursor = db[positions_collection(collection)].find({'token': {'$in': list(post_dicts)}}, {'_id': 0})
+        join_positions(post_dicts, [chunk async for chunk in cursor])
+    return post_dicts
+
+
+async def query_docs(doc_ids: List[int], snippet_len: int = 150) -> List[Dict]:
+    """
+    motor version of mongo_db.query_docs
+    :param doc_ids:
+    :param snippet_len:
+    :return:
+    """
+    cursor = db["wapo_docs"].aggregate([
+        {'$match': {'id': {'$in': list(doc_ids)}}},
+        {'$project': {'_id': 0, 'id': 1, 'title': 1, 'snippet': {'$substrCP': ['$content_str', 0, snippet_len]}}},
+    ])
+    docs = {doc['id']: doc async for doc in cursor}
+    return [docs[doc_id] for doc_id in doc_ids if doc_id in docs]
+
+
+async def get_doc_lengths(analyzer: str, generation: Optional[str]) -> DocLengths:
+    cached = _doc_lengths.get(analyzer)
+    if cached is None or cached[0] != generation:
+        doc_lengths = DocLengths()
+        cursor = db[stats_collection(analyzer)].find({}, {'_id': 0, 'id': 1, 'length': 1})
+        doc_lengths.update([(doc['id'], doc['length']) async for doc in cursor])
+        cached = _doc_lengths[analyzer] = (generation, doc_lengths)
+    return cached[1]
+
+
+POSTINGS_CACHES = {name: PostingsCache(afetch_many=partial(query_db_index_many, collection=index_collection(name)))
+                   for name in ANALYZERS}
+
+
+async def check_index_generation(analyzer: str) -> Optional[str]:
+    """
+    motor version of inverted_index.check_index_generation, which also drops the stale entries of the postings caches
+    of the api
+    :param analyzer:
+    :return:
+    """
+    if index_check_due(analyzer):
+        meta = await db[INDEX_META].find_one({'collection': index_collection(analyzer)}, {'_id': 0, 'generation': 1})
+        set_index_generation(analyzer, meta['generation'] if meta else None)
+    # the generation may also have been read by a synchronous lookup, e.g. of the term dictionary
+    generation = index_generation(analyzer)
+    POSTINGS_CACHES[analyzer].set_generation(generation)
+    return generation
+
+
+async def fetch_postings(terms: List[str], analyzer: str, positions: List[str]) -> Dict[str, Dict]:
+    """
+    async version of inverted_index.fetch_postings over mongo: the terms that need their positions and the others
+    are fetched at the same time
+    :param terms:
+    :param analyzer:
+    :param positions: the terms whose positions are needed
+    :return:
+    """
+    cache = POSTINGS_CACHES[analyzer]
+    positions = set(positions)
+    without_positions, with_positions = await asyncio.gather(
+        cache.aquery_many([term for term in terms if term not in positions], positions=False),
+        cache.aquery_many([term for term in terms if term in positions], positions=True))
+    without_positions.update(with_positions)
+    return without_positions
+
+
+async def match(query: str, mode: str, k: Optional[int], analyzer: str,
+                generation: Optional[str] = None) -> Tuple[List[int], List[str]]:
+    """
+    the matched ids of the query, as hw3.search
+    :param query:
+    :param mode: "boolean" or "ranked"
+    :param k: number of ranked documents
+    :param analyzer:
+    :param generation: current generation of the index, see check_index_generation
+    :return: matched ids, unknown words
+    """
+    node = parse_query(query, ANALYZERS[analyzer])
+    # the term dictionary of the collection is in memory, the wildcards are expanded without a round trip
+    expansions = wildcard_expansions(node, analyzer=analyzer)
+    node = expand_wildcards(node, expansions)
+    unknown_words = [pattern for pattern, terms in expansions.items() if not terms]
+    if node is None:
+        return [], unknown_words
+    if mode == "ranked":
+        terms = sorted(positive_terms(node))
+        postings, doc_lengths = await asyncio.gather(fetch_postings(terms, analyzer, terms),
+                                                     get_doc_lengths(analyzer, generation))
+        matching_ids = [doc_id for doc_id, _ in bm25_top_k(postings, doc_lengths, k)]
+    else:
+        terms = sorted(node.terms())
+        postings = await fetch_postings(terms, analyzer, list(phrase_terms(node)))
+        node = prune_unknown(node, postings)
+        matching_ids = evaluate(node, postings) if node is not None else []
+    return matching_ids, unknown_words + [term for term in terms if term not in postings]
+
+
+async def search(query: str, mode: str = "boolean", page_id: int = 1, analyzer: str = DEFAULT_ANALYZER) -> Dict:
+    """
+    a page of results of the query
+    :param query:
+    :param mode: "boolean" or "ranked"
+    :param page_id: 1-based page number
+    :param analyzer:
+    :return:
+    """
+    ranked = mode == "ranked"
+    k = -(-page_id // RANKED_DEPTH_PAGES) * RANKED_DEPTH_PAGES * PAGE_SIZE + 1 if ranked else None
+    # the results of an older build of the index are not reused
+    generation = await check_index_generation(analyzer)
+    key = (analyzer, query_key(query, analyzer), generation, k)
+    cached = RESULT_CACHE.get(key)
+    if cached is None:
+        cached = await match(query, mode, k, analyzer, generation)
+        RESULT_CACHE.put(key, cached)
+    matching_ids, unknowns = cached
+    page_ids = matching_ids[(page_id - 1) * PAGE_SIZE:page_id * PAGE_SIZE]
+    return {"query": query, "page": page_id, "mode": mode, "analyzer": analyzer,
+            # the total number of matches is unknown in ranked mode, only the top documents are computed
+            "num_matches": None if ranked else len(matching_ids),
+            "more": len(matching_ids) > page_id * PAGE_SIZE,
+            "stopwords": stopwords_in_query(query, analyzer), "unknown": unknowns,
+            "results": await query_docs(page_ids) if page_ids else []}
+
+
+@app.route("/api/search")
+async def api_search():
+    query = request.args.get("q", "")
+    page_id = max(request.args.get("page", 1, type=int), 1)
+    mode = request.args.get("mode", "boolean")
+    analyzer = request.args.get("analyzer", DEFAULT_ANALYZER)
+    if analyzer not in ANALYZERS:
+        return jsonify({"error": f"unknown analyzer {analyzer!r}"}), 400
+    try:
+        return jsonify(await asyncio.wait_for(search(query, mode, page_id, analyzer), REQUEST_TIMEOUT))
+    except asyncio.TimeoutError:
+        return jsonify({"error": "timeout"}), 504
+
+
+@app.route("/api/cache_stats")
+async def api_cache_stats():
+    return jsonify({"results": RESULT_CACHE.stats(),
+                    "postings": {name: cache.stats() for name, cache in POSTINGS_CACHES.items()}})
+
+
+if __name__ == "__main__":
+    app.run(port=5001)
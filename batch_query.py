@@ -0,0 +1,308 @@
+import argparse
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial, reduce
+from itertools import chain
+from typing import Dict, Iterable, List, Optional, TextIO, Tuple
+
+try:
+    # optional vectorized kernels, the batch is evaluated with the ones of inverted_index without it
+    import numpy as np
+except ImportError:
+    np = None
+
+from inverted_index import ANALYZERS, DEFAULT_ANALYZER, analyzer_index_path, evaluate, expand_wildcards, \
+    fetch_postings, plan_cost, prune_unknown, wildcard_expansions, phrase_terms
+from postings_file import PostingsFile
+from query_parser import parse_query, Phrase, And, Or, Not
+from segments import SegmentedIndex
+from tracing import span
+from utils import json_loads
+
+# offline evaluation of many queries (e.g. TREC topics) at once: the queries of a batch are parsed first, the posting
+# list of each distinct term is fetched once for the whole batch as sorted numpy arrays, then the queries are
+# evaluated with numpy set kernels (intersect1d, union1d, setdiff1d, phrases as intersections of position keys) on a
+# pool of worker processes, which inherit the arrays of the batch
+BATCH_SIZE = 1000
+TREC_DEPTH = 1000
+TOPIC = re.compile(r"<num>\s*(?:Number:)?\s*(\S+?)\s*(?:</num>|\n).*?<title>\s*(.*?)\s*(?:</title>|<)",
+                   re.DOTALL | re.IGNORECASE)
+
+# postings of the batch being evaluated, set in each worker process by _init_worker
+_batch = {}
+
+
+def load_topics(path: str) -> List[Tuple[str, str]]:
+    """
+    the queries of a topics file: TREC topics (the <title> of each <top>, identified by its <num>) or one
+    "qid<tab>query" per line
+    :param path:
+    :return: (query id, query) pairs, in the order of the file
+    """
+    with open(path, encoding="utf-8") as f:
+        text = f.read()
+    if "<top>" in text:
+        return [(qid, " ".join(title.split())) for qid, title in TOPIC.findall(text)]
+    queries = []
+    for line in text.splitlines():
+        if line.strip():
+            qid, _, query = line.strip().partition("\t")
+            queries.append((qid, query))
+    return queries
+
+
+def load_docnos(wapo_jl_path: str) -> List[str]:
+    """
+    the WAPO article id of each doc id, the document numbers of the TREC qrels
+    :param wapo_jl_path:
+    :return:
+    """
+    with open(wapo_jl_path, "rb") as f:
+        return [json_loads(line)["id"] for line in f]
+
+
+def fetch_batch(terms: Iterable[str], index=None, analyzer: str = DEFAULT_ANALYZER,
+                positions: Iterable[str] = ()) -> Tuple[Dict, Dict]:
+    """
+    the postings of the terms of a batch as numpy arrays, each term being looked up once. the doc ids and positions
+    of a postings file are decoded straight into arrays, the posting lists of the other backends are converted
+    :param terms:
+    :param index: see query_inverted_index
+    :param analyzer:
+    :param positions: the terms whose positions are needed
+    :return: term -> doc ids array, and term -> (number of positions in each doc, flat positions) arrays for the
+        terms of positions that have them (see postings_file.decode_positions_arrays). the unknown terms are left out
+    """
+    terms = sorted(terms)
+    positions = set(positions)
+    arrays = {}
+    positions_arrays = {}
+    if hasattr(index, 'postings_array'):
+        with span("fetch_postings"):
+            for term in terms:
+                if term in index:
+                    arrays[term] = index.postings_array(term)
+                    if term in positions and index.positional:
+                        positions_arrays[term] = index.positions_arrays(term)
+        return arrays, positions_arrays
+    for term, post_dict in fetch_postings(terms, index, analyzer, positions=positions).items():
+        arrays[term] = np.asarray(post_dict['doc_ids'], dtype=np.int64)
+        if 'positions' in post_dict:
+            positions_arrays[term] = (np.array([len(doc_positions) for doc_positions in post_dict['positions']],
+                                               dtype=np.int64),
+                                      np.fromiter(chain.from_iterable(post_dict['positions']), dtype=np.int64))
+    return arrays, positions_arrays
+
+
+def phrase_arrays(node: Phrase, arrays: Dict, positions_arrays: Dict):
+    """
+    numpy version of the phrase evaluation: each occurrence of a phrase term is keyed by its doc id and the start
+    position of the phrase it would belong to (position - offset), a phrase match is a key shared by all its terms
+    :param node:
+    :param arrays: see fetch_batch
+    :param positions_arrays: see fetch_batch
+    :return: ascending doc ids array
+    """
+    if any(term not in positions_arrays for term, _ in node.terms_offsets):
+        # index built without positions, the phrase degrades to the AND of its terms
+        return reduce(partial(np.intersect1d, assume_unique=True), [arrays[term] for term in node.terms()])
+    max_offset = max(offset for _, offset in node.terms_offsets)
+    keys = None
+    for term, offset in sorted(node.terms_offsets, key=lambda term_offset: len(arrays[term_offset[0]])):
+        counts, term_positions = positions_arrays[term]
+        term_keys = (np.repeat(arrays[term], counts) << 32) + (term_positions + (max_offset - offset))
+        keys = term_keys if keys is None else np.intersect1d(keys, term_keys, assume_unique=True)
+        if not len(keys):
+            break
+    # the keys are ascending, so are their doc ids
+    doc_ids = keys >> 32
+    return doc_ids[np.diff(doc_ids, prepend=-1) != 0]
+
+
+def evaluate_arrays(node, arrays: Dict, positions_arrays: Dict, postings: Dict[str, Dict]):
+    """
+    numpy version of inverted_index.evaluate: an AND intersects its operands from the cheapest one and removes the
+    negated ones, an OR is the union of its operands
+    :param node: query_parser node without unknown terms (see inverted_index.prune_unknown)
+    :param arrays: term -> doc ids array (see fetch_batch)
+    :param positions_arrays: see fetch_batch
+    :param postings: term -> posting dict, for the plan costs
+    :return: ascending doc ids array
+    """
+    if isinstance(node, Phrase):
+        return phrase_arrays(node, arrays, positions_arrays)
+    if isinstance(node, And):
+        children = sorted(node.children, key=lambda c: plan_cost(c, postings))
+        if isinstance(children[0], Not):
+            return np.zeros(0, dtype=np.int64)
+        result = evaluate_arrays(children[0], arrays, positions_arrays, postings)
+        for child in children[1:]:
+            if not len(result):
+                break
+            if isinstance(child, Not):
+                result = np.setdiff1d(result, evaluate_arrays(child.child, arrays, positions_arrays, postings),
+                                      assume_unique=True)
+            else:
+                result = np.intersect1d(result, evaluate_arrays(child, arrays, positions_arrays, postings),
+                                        assume_unique=True)
+        return result
+    if isinstance(node, Or):
+        return reduce(np.union1d, [evaluate_arrays(child, arrays, positions_arrays, postings)
+                                   for child in node.children])
+    if isinstance(node, Not):
+        return np.zeros(0, dtype=np.int64)
+    return arrays[node.term]
+
+
+def _init_worker(postings: Dict[str, Dict], arrays: Optional[Dict], positions_arrays: Optional[Dict]) -> None:
+    _batch['postings'] = postings
+    _batch['arrays'] = arrays
+    _batch['positions_arrays'] = positions_arrays
+
+
+def _evaluate_nodes(nodes: List) -> List:
+    postings, arrays, positions_arrays = _batch['postings'], _batch['arrays'], _batch['positions_arrays']
+    results = []
+    for node in nodes:
+        node = prune_unknown(node, postings) if node is not None else None
+        if node is None:
+            results.append([])
+        elif arrays is not None:
+            results.append(evaluate_arrays(node, arrays, positions_arrays, postings))
+        else:
+            results.append(evaluate(node, postings))
+    return results
+
+
+def _chunks(items: List, num_chunks: int) -> List[List]:
+    size = max(1, -(-len(items) // num_chunks))
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def batch_query(queries: List[Tuple[str, str]], index=None, analyzer: str = DEFAULT_ANALYZER, workers: int = 0,
+                batch_size: int = BATCH_SIZE, vectorized: bool = True) -> Dict[str, List[int]]:
+    """
+    boolean queries evaluated by batches: the terms of a batch are looked up once, whatever the number of queries
+    they appear in, and the batch is evaluated on a process pool. the results are the ones of query_inverted_index,
+    except that a query without match gets an empty list
+    :param queries: (query id, query) pairs
+    :param index: see query_inverted_index
+    :param analyzer: key of ANALYZERS
+    :param workers: number of worker processes, 0 to evaluate in this process
+    :param batch_size: number of queries whose postings are in memory at the same time
+    :param vectorized: evaluate with the numpy kernels when numpy is installed
+    :return: query id -> ascending matched doc ids
+    """
+    results = {}
+    for start in range(0, len(queries), batch_size):
+        batch = queries[start:start + batch_size]
+        batch_index = index.snapshot() if hasattr(index, 'snapshot') else index
+        with span("parse"):
+            nodes = [parse_query(query, ANALYZERS[analyzer]) for _, query in batch]
+        nodes = [expand_wildcards(node, wildcard_expansions(node, batch_index, analyzer)) for node in nodes]
+        terms = set().union(*(node.terms() for node in nodes if node is not None))
+        positional_terms = set().union(*(phrase_terms(node) for node in nodes if node is not None))
+        if vectorized and np is not None:
+            arrays, positions_arrays = fetch_batch(terms, batch_index, analyzer, positional_terms)
+            postings = {term: {'token': term, 'doc_ids': doc_ids} for term, doc_ids in arrays.items()}
+        else:
+            postings = fetch_postings(sorted(terms), batch_index, analyzer, positions=positional_terms)
+            arrays = positions_arrays = None
+        with span("evaluate"):
+            if workers:
+                with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                         initargs=(postings, arrays, positions_arrays)) as executor:
+                    matches = [doc_ids for chunk in executor.map(_evaluate_nodes, _chunks(nodes, workers * 4))
+                               for doc_ids in chunk]
+            else:
+                _init_worker(postings, arrays, positions_arrays)
+                matches = _evaluate_nodes(nodes)
+                _batch.clear()
+        for (qid, _), doc_ids in zip(batch, matches):
+            results[qid] = doc_ids.tolist() if hasattr(doc_ids, 'tolist') else list(doc_ids)
+    return results
+
+
+def write_run(results: Dict[str, List[int]], f: TextIO, run_tag: str = "brs", depth: int = TREC_DEPTH,
+              docnos: Optional[List[str]] = None) -> None:
+    """
+    write the results in the TREC run format, "qid Q0 docno rank score run_tag" per line. boolean results have no
+    score, the score decreases with the rank so that trec_eval keeps the order of the results
+    :param results: query id -> doc ids
+    :param f:
+    :param run_tag:
+    :param depth: number of documents per query
+    :param docnos: document number of each doc id (see load_docnos), the doc id itself by default
+    :return:
+    """
+    for qid, doc_ids in results.items():
+        doc_ids = doc_ids[:depth]
+        for rank, doc_id in enumerate(doc_ids, 1):
+            docno = docnos[doc_id] if docnos is not None else doc_id
+            f.write(f"{qid} Q0 {docno} {rank} {len(doc_ids) - rank + 1} {run_tag}\n")
+
+
+def open_index(index_file: Optional[str], segments: Optional[str], analyzer: str):
+    """
+    the index of the analyzer in a segments directory or next to a postings file, None for mongo
+    :param index_file:
+    :param segments:
+    :param analyzer:
+    :return:
+    """
+    if segments:
+        return SegmentedIndex(analyzer_index_path(segments, analyzer), analyzer=ANALYZERS[analyzer])
+    if index_file:
+        return PostingsFile(analyzer_index_path(index_file, analyzer))
+    return None
+
+
+def run(queries: Iterable[Tuple[str, str]], f: TextIO, index=None, analyzer: str = DEFAULT_ANALYZER,
+        workers: int = 0, batch_size: int = BATCH_SIZE, vectorized: bool = True, run_tag: str = "brs",
+        depth: int = TREC_DEPTH, docnos: Optional[List[str]] = None) -> Dict[str, float]:
+    """
+    batch_query then write_run, the retrieval is timed
+    :param queries: (query id, query) pairs, see load_topics
+    :param f: run file
+    :param index: see batch_query
+    :param analyzer:
+    :param workers:
+    :param batch_size:
+    :param vectorized:
+    :param run_tag: see write_run
+    :param depth:
+    :param docnos:
+    :return: number of queries, seconds and queries/sec
+    """
+    queries = list(queries)
+    start_t = time.perf_counter()
+    results = batch_query(queries, index, analyzer, workers, batch_size, vectorized)
+    elapsed_t = time.perf_counter() - start_t
+    write_run(results, f, run_tag, depth, docnos)
+    return {"queries": len(queries), "seconds": elapsed_t, "qps": len(queries) / elapsed_t if elapsed_t else 0.0}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="batch boolean retrieval of a topics file into a TREC run")
+    parser.add_argument("topics", help="TREC topics file, or one qid<tab>query per line")
+    parser.add_argument("--output", type=str, default="run.txt")
+    parser.add_argument("--run-tag", type=str, default="brs")
+    parser.add_argument("--depth", type=int, default=TREC_DEPTH, help="documents per query in the run")
+    parser.add_argument("--workers", type=int, default=0, help="worker processes (0: evaluate in this process)")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="queries whose postings are fetched at once")
+    parser.add_argument("--no-numpy", action="store_true", help="evaluate with the kernels of inverted_index")
+    parser.add_argument("--index-file", type=str, default=None, help="query a postings file instead of mongo")
+    parser.add_argument("--segments", type=str, default=None, help="query a segments directory instead of mongo")
+    parser.add_argument("--analyzer", default=DEFAULT_ANALYZER, choices=list(ANALYZERS))
+    parser.add_argument("--docnos", type=str, default=None,
+                        help="WAPO .jl file the index was built from, to write the article ids as docnos")
+    args = parser.parse_args()
+
+    with open(args.output, "w", encoding="utf-8") as out:
+        report = run(load_topics(args.topics), out, open_index(args.index_file, args.segments, args.analyzer),
+                     args.analyzer, args.workers, args.batch_size, not args.no_numpy, args.run_tag, args.depth,
+                     load_docnos(args.docnos) if args.docnos else None)
+    print(f"'batch_query' {report['queries']} queries in {report['seconds']:0.2f} seconds "
+          f"({report['qps']:0.1f} queries/sec, {'numpy' if np is not None and not args.no_numpy else 'python'} "
+          f"kernels, {args.workers or 1} process(es))")
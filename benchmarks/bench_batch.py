@@ -0,0 +1,64 @@
+"""
+offline evaluation benchmark: throughput of a workload of boolean queries run one at a time through
+query_inverted_index against batch_query.batch_query, with the python kernels, the numpy kernels and the numpy
+kernels on a process pool
+the corpus and the Zipf queries are the synthetic ones of bench_search. with the mongo backend (in-memory stand-in,
+optionally with a round trip time) the postings cache is cleared before each run, so the batch also saves the
+lookups of the terms shared by several queries
+run from the repository root:
+    python benchmarks/bench_batch.py --docs 20000 --queries 2000 --workers 4
+"""
+import argparse
+import contextlib
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import batch_query  # noqa: E402
+from bench_search import build, synthetic_docs, zipf_queries  # noqa: E402
+from inverted_index import POSTINGS_CACHES, query_inverted_index  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description="batch query benchmark")
+    parser.add_argument("--docs", type=int, default=20000)
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--backend", choices=["file", "mongo"], default="file")
+    parser.add_argument("--mongo-latency-ms", type=float, default=0.0)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        _, index, terms = build(args.backend, list(synthetic_docs(args.docs, seed=args.seed)), None, work_dir,
+                                args.mongo_latency_ms / 1000)
+        queries = [(str(qid), query) for qid, query in
+                   enumerate(zipf_queries(terms, args.queries, seed=args.seed))]
+        runs = {
+            "one at a time": lambda: {qid: [doc_id for doc_id in query_inverted_index(query, index=index)[0]
+                                            if doc_id != -1] for qid, query in queries},
+            "batch python": lambda: batch_query.batch_query(queries, index, vectorized=False),
+        }
+        if batch_query.np is not None:
+            runs["batch numpy"] = lambda: batch_query.batch_query(queries, index)
+            runs[f"batch numpy x{args.workers}"] = lambda: batch_query.batch_query(queries, index,
+                                                                                  workers=args.workers)
+        expected = None
+        print(f"{args.docs} docs, {len(queries)} queries, {args.backend} backend")
+        for name, func in runs.items():
+            POSTINGS_CACHES["nltk"].clear()
+            start_t = time.perf_counter()
+            with contextlib.redirect_stdout(sys.stderr):
+                results = func()
+            elapsed_t = time.perf_counter() - start_t
+            expected = expected or results
+            print(f"{name:<20}{len(queries) / elapsed_t:>10.1f} queries/sec"
+                  f"{'' if results == expected else '   (results differ)'}")
+
+
+if __name__ == "__main__":
+    main()
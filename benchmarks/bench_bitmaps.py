@@ -0,0 +1,90 @@
+"""
+micro-benchmark of the hybrid posting representation (bitmap_postings) against plain doc id lists: memory of each
+representation and time of the AND / OR / NOT of two posting lists of various densities
+- list: inverted_index.intersection, the heapq merge of the former OR, the set difference of the former NOT
+- hybrid: the bitmap_postings kernels, a posting list being a bitmap when it is dense (bitmap_postings.is_dense)
+run from the repository root: python benchmarks/bench_bitmaps.py
+"""
+import argparse
+import heapq
+import random
+import sys
+import timeit
+from itertools import groupby
+from pathlib import Path
+from typing import List
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from bitmap_postings import Bitmap, hybrid, and_postings, or_postings, andnot_postings, to_list  # noqa: E402
+from inverted_index import intersection  # noqa: E402
+
+# document frequencies of the two terms, as a fraction of the corpus size
+MIXES = {
+    "rare+rare": [0.001, 0.002],
+    "rare+common": [0.001, 0.5],
+    "medium+medium": [0.02, 0.05],
+    "medium+common": [0.05, 0.4],
+    "common+common": [0.3, 0.5],
+    "very common": [0.7, 0.9],
+}
+
+
+def make_postings(num_docs: int, density: float, rng: random.Random) -> List[int]:
+    return sorted(rng.sample(range(num_docs), int(num_docs * density)))
+
+
+def list_bytes(doc_ids: List[int]) -> int:
+    # the list and its int objects, the ints below 257 are shared by the interpreter
+    return sys.getsizeof(doc_ids) + sum(sys.getsizeof(doc_id) for doc_id in doc_ids if doc_id > 256)
+
+
+def postings_bytes(postings) -> int:
+    return postings.nbytes if isinstance(postings, Bitmap) else list_bytes(postings)
+
+
+def list_or(a: List[int], b: List[int]) -> List[int]:
+    return [doc_id for doc_id, _ in groupby(heapq.merge(a, b))]
+
+
+def list_not(a: List[int], b: List[int]) -> List[int]:
+    b_set = set(b)
+    return [doc_id for doc_id in a if doc_id not in b_set]
+
+
+def best_time(func, repeat: int) -> float:
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="hybrid posting representation micro-benchmark")
+    parser.add_argument("--docs", type=int, default=500000, help="corpus size")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    print(f"{'mix':<16}{'list KB':>10}{'hybrid KB':>11}"
+          + "".join(f"{op + ' list':>11}{op + ' hyb':>10}" for op in ("AND", "OR", "NOT")) + "   (ms)")
+    for name, densities in MIXES.items():
+        a, b = (make_postings(args.docs, d, rng) for d in densities)
+        ha, hb = hybrid(a), hybrid(b)
+        assert to_list(and_postings(ha, hb)) == intersection([a, b])
+        assert to_list(or_postings([ha, hb])) == list_or(a, b)
+        assert to_list(andnot_postings(hb, ha)) == list_not(b, a)
+        times = [
+            best_time(lambda: intersection([a, b]), args.repeat),
+            best_time(lambda: to_list(and_postings(ha, hb)), args.repeat),
+            best_time(lambda: list_or(a, b), args.repeat),
+            best_time(lambda: to_list(or_postings([ha, hb])), args.repeat),
+            best_time(lambda: list_not(b, a), args.repeat),
+            best_time(lambda: to_list(andnot_postings(hb, ha)), args.repeat),
+        ]
+        print(f"{name:<16}{(list_bytes(a) + list_bytes(b)) / 1024:>10.0f}"
+              f"{(postings_bytes(ha) + postings_bytes(hb)) / 1024:>11.0f}"
+              + "".join(f"{t_list * 1000:>11.2f}{t_hybrid * 1000:>10.2f}"
+                        for t_list, t_hybrid in zip(times[::2], times[1::2])))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+"""
+micro-benchmark of inverted_index.intersection (galloping) against the former set based intersection
+run from the repository root: python benchmarks/bench_intersection.py
+"""
+import argparse
+import random
+import sys
+import timeit
+from pathlib import Path
+from typing import List
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from inverted_index import intersection, set_intersection  # noqa: E402
+
+# document frequencies of the query terms, as a fraction of the corpus size
+MIXES = {
+    "rare+rare": [0.001, 0.002],
+    "rare+common": [0.001, 0.5],
+    "medium+common": [0.05, 0.4],
+    "common+common": [0.3, 0.5],
+    "rare+medium+common": [0.002, 0.05, 0.6],
+    "4 common": [0.2, 0.3, 0.4, 0.5],
+    "disjoint": [0.01, 0.0],
+}
+
+
+def make_postings(num_docs: int, density: float, rng: random.Random) -> List[int]:
+    return sorted(rng.sample(range(num_docs), int(num_docs * density)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="intersection micro-benchmark")
+    parser.add_argument("--docs", type=int, default=200000, help="corpus size")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    print(f"{'mix':<22}{'matches':>10}{'set (ms)':>12}{'gallop (ms)':>14}{'speedup':>10}")
+    for name, densities in MIXES.items():
+        posting_lists = sorted((make_postings(args.docs, d, rng) for d in densities), key=len)
+        assert sorted(set_intersection(posting_lists)) == intersection(posting_lists) or not posting_lists[0]
+        t_set = min(timeit.repeat(lambda: set_intersection(posting_lists), number=1, repeat=args.repeat))
+        t_gallop = min(timeit.repeat(lambda: intersection(posting_lists), number=1, repeat=args.repeat))
+        matches = len(intersection(posting_lists))
+        print(f"{name:<22}{matches:>10}{t_set * 1000:>12.3f}{t_gallop * 1000:>14.3f}{t_set / t_gallop:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
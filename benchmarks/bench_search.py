@@ -0,0 +1,319 @@
+"""
+end-to-end search benchmark: builds indexes over corpora of increasing size and replays query workloads through
+query_inverted_index (or rank_inverted_index), reporting build time, index size, throughput and latency percentiles
+as JSON so that runs of different commits can be compared
+- corpora: synthetic documents with Zipf distributed words, or the first documents of a WAPO .jl file
+- workloads: a query log (one query per line, or JSON lines with a "query" field) and/or queries of Zipf
+  distributed index terms
+- backends: "file" (compressed postings file in a temporary directory), "sqlite" (embedded storage.SQLiteStorage in
+  the same directory) and "mongo", which runs the mongo code path
+  against an in-memory stand-in of the database (optionally with a simulated round trip time) so no server is needed.
+  mongomock is not used since its unique indexes make the index inserts quadratic
+run from the repository root:
+    python benchmarks/bench_search.py --sizes 1000 10000 --output bench.json
+    python benchmarks/bench_search.py --wapo pa3_data/wapo_pa3.jl --sizes 5000 --log queries.txt --backends file mongo
+"""
+import argparse
+import contextlib
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from itertools import accumulate, islice
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from bson import BSON
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import bitmap_postings  # noqa: E402
+import inverted_index  # noqa: E402
+from inverted_index import build_inverted_index_parallel, query_inverted_index, rank_inverted_index  # noqa: E402
+from postings_file import PostingsFile  # noqa: E402
+from storage import MongoStorage, SQLiteStorage, get_storage, set_storage, positions_collection  # noqa: E402
+from utils import load_wapo  # noqa: E402
+
+
+class MemoryCollection:
+    def __init__(self, database: "MemoryDatabase", latency: float = 0.0):
+        """
+        in-memory stand-in of the part of a pymongo collection that mongo_db uses for the index collections:
+        documents are stored by the first key of their unique index and found by equality or $in filters on that key
+        :param database:
+        :param latency: seconds slept by every query, to simulate the round trip to a server
+        """
+        self.database = database
+        self.latency = latency
+        self.key = None
+        self.docs = {}
+
+    def create_index(self, keys, unique: bool = False) -> str:
+        self.key = keys[0][0]
+        return self.key
+
+    def insert_many(self, docs: List[Dict], ordered: bool = True) -> None:
+        for doc in docs:
+            self.docs.setdefault(doc[self.key], []).append(doc)
+
+    def replace_one(self, filter: Dict, replacement: Dict, upsert: bool = False) -> None:
+        # the collection of the index generations (see storage.INDEX_META) has no unique index, it is keyed by the
+        # field of the filter
+        if self.key is None:
+            (self.key,) = filter
+        if upsert or filter[self.key] in self.docs:
+            self.docs[filter[self.key]] = [replacement]
+
+    def find(self, filter: Optional[Dict] = None, projection: Optional[Dict] = None) -> Iterator[Dict]:
+        if self.latency:
+            time.sleep(self.latency)
+        if filter:
+            (value,) = filter.values()
+            values = value['$in'] if isinstance(value, dict) else [value]
+            docs = [doc for v in values for doc in self.docs.get(v, ())]
+        else:
+            docs = [doc for docs in self.docs.values() for doc in docs]
+        included = {field for field, keep in (projection or {}).items() if keep}
+        excluded = {field for field, keep in (projection or {}).items() if not keep}
+        return iter([{field: v for field, v in doc.items()
+                      if field not in excluded and (not included or field in included)} for doc in docs])
+
+    def find_one(self, filter: Optional[Dict] = None, projection: Optional[Dict] = None) -> Optional[Dict]:
+        return next(self.find(filter, projection), None)
+
+    def rename(self, new_name: str, dropTarget: bool = False) -> None:
+        name = next(name for name, collection in self.database.items() if collection is self)
+        self.database[new_name] = self.database.pop(name)
+
+
+class MemoryDatabase(dict):
+    def __init__(self, latency: float = 0.0):
+        super().__init__()
+        self.latency = latency
+
+    def __missing__(self, name: str) -> MemoryCollection:
+        self[name] = MemoryCollection(self, self.latency)
+        return self[name]
+
+    def list_collection_names(self) -> List[str]:
+        return list(self)
+
+    def drop_collection(self, name: str) -> None:
+        self.pop(name, None)
+
+
+def synthetic_docs(num_docs: int, vocab_size: int = 50000, doc_len: int = 300, zipf_s: float = 1.1,
+                   seed: int = 0) -> Iterator[Dict]:
+    """
+    documents of random words drawn from a Zipf distribution, in the format of utils.load_wapo
+    :param num_docs:
+    :param vocab_size:
+    :param doc_len: number of words of the content of a doc
+    :param zipf_s: exponent of the distribution
+    :param seed:
+    :return:
+    """
+    rng = random.Random(seed)
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    vocab = list({"".join(rng.choice(letters) for _ in range(rng.randint(4, 9))) for _ in range(vocab_size)})
+    cum_weights = list(accumulate(1 / rank ** zipf_s for rank in range(1, len(vocab) + 1)))
+    for doc_id in range(num_docs):
+        words = rng.choices(vocab, cum_weights=cum_weights, k=doc_len + 8)
+        yield {"id": doc_id, "title": " ".join(words[:8]), "author": "", "published_date": "",
+               "content_str": " ".join(words[8:])}
+
+
+def load_log(path: str, field: str = "query") -> List[str]:
+    """
+    queries of a log file: one query per line, or JSON lines from which the field is taken
+    :param path:
+    :param field:
+    :return:
+    """
+    queries = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith("{"):
+                record = json.loads(line)
+                line = record.get(field) or record.get("q") or record.get("title") or ""
+            if line:
+                queries.append(line)
+    return queries
+
+
+def zipf_queries(index_terms: List[str], num_queries: int, zipf_s: float = 1.0, seed: int = 0) -> List[str]:
+    """
+    queries of 1 to 3 index terms drawn from a Zipf distribution over the terms sorted by decreasing df, with some
+    OR, NOT and phrase queries
+    :param index_terms: terms sorted by decreasing document frequency
+    :param num_queries:
+    :param zipf_s:
+    :param seed:
+    :return:
+    """
+    rng = random.Random(seed)
+    cum_weights = list(accumulate(1 / rank ** zipf_s for rank in range(1, len(index_terms) + 1)))
+    queries = []
+    for _ in range(num_queries):
+        terms = rng.choices(index_terms, cum_weights=cum_weights, k=rng.randint(1, 3))
+        shape = rng.random()
+        if len(terms) > 1 and shape < 0.15:
+            queries.append(" OR ".join(terms))
+        elif len(terms) > 1 and shape < 0.25:
+            queries.append(" ".join(terms[:-1]) + " NOT " + terms[-1])
+        elif len(terms) > 1 and shape < 0.35:
+            queries.append('"' + " ".join(terms) + '"')
+        else:
+            queries.append(" ".join(terms))
+    return queries
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(int(len(sorted_values) * p / 100), len(sorted_values) - 1)]
+
+
+def replay(queries: List[str], index, mode: str, k: int, repeat: int) -> Dict:
+    latencies = []
+    start_t = time.perf_counter()
+    for _ in range(repeat):
+        for query in queries:
+            query_t = time.perf_counter()
+            if mode == "ranked":
+                rank_inverted_index(query, k, index=index)
+            else:
+                query_inverted_index(query, index=index)
+            latencies.append(time.perf_counter() - query_t)
+    elapsed_t = time.perf_counter() - start_t
+    latencies.sort()
+    return {"queries": len(latencies), "qps": len(latencies) / elapsed_t if elapsed_t else 0.0,
+            "p50_ms": percentile(latencies, 50) * 1000, "p95_ms": percentile(latencies, 95) * 1000,
+            "p99_ms": percentile(latencies, 99) * 1000, "max_ms": latencies[-1] * 1000 if latencies else 0.0}
+
+
+def build(backend: str, docs: List[Dict], workers: Optional[int], work_dir: str, latency: float = 0.0) -> Tuple:
+    """
+    build the index of the docs on the backend
+    :param backend: "file", "sqlite" or "mongo"
+    :param docs:
+    :param workers:
+    :param work_dir: directory of the postings file
+    :param latency: simulated round trip time of the mongo queries in seconds
+    :return: build time, index size in bytes, number of terms and the index to pass to query_inverted_index
+    """
+    start_t = time.perf_counter()
+    # the build functions print their timing, keep stdout for the JSON report
+    with contextlib.redirect_stdout(sys.stderr):
+        if backend == "file":
+            index_file = os.path.join(work_dir, f"bench_{len(docs)}.idx")
+            build_inverted_index_parallel(iter(docs), workers=workers, index_file=index_file)
+        elif backend == "sqlite":
+            set_storage(SQLiteStorage(os.path.join(work_dir, f"bench_{len(docs)}.db")))
+            build_inverted_index_parallel(iter(docs), workers=workers)
+        else:
+            set_storage(MongoStorage(db=MemoryDatabase()))
+            build_inverted_index_parallel(iter(docs), workers=workers)
+            for collection in get_storage().db.values():
+                collection.latency = latency
+    build_t = time.perf_counter() - start_t
+    if backend == "file":
+        index = PostingsFile(index_file)
+        terms = sorted(index.terms(), key=index.df, reverse=True)
+        size = os.path.getsize(index_file)
+    elif backend == "sqlite":
+        index = None
+        storage = get_storage()
+        terms = [token for token, in storage.conn.execute(
+            "SELECT token FROM inverted_index ORDER BY length(doc_ids) DESC")]
+        size = os.path.getsize(storage.path)
+    else:
+        index = None
+        db = get_storage().db
+        post_dicts = list(db["inverted_index"].find())
+        terms = [post_dict['token'] for post_dict in sorted(post_dicts, key=lambda p: len(p['doc_ids']),
+                                                            reverse=True)]
+        chunks = list(db[positions_collection("inverted_index")].find())
+        size = sum(len(BSON.encode(doc)) for doc in post_dicts + chunks)
+    return {"build_s": build_t, "index_bytes": size, "terms": len(terms)}, index, terms
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=Path(__file__).resolve().parent.parent, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="search benchmark suite")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 5000, 20000], help="corpus sizes in docs")
+    parser.add_argument("--wapo", type=str, default=None, help="sample the corpora from this .jl file")
+    parser.add_argument("--backends", nargs="+", default=["file"], choices=["file", "sqlite", "mongo"])
+    parser.add_argument("--log", type=str, default=None, help="query log to replay")
+    parser.add_argument("--zipf-queries", type=int, default=500, help="number of Zipf queries, 0 to skip")
+    parser.add_argument("--mode", choices=["boolean", "ranked"], default="boolean")
+    parser.add_argument("--k", type=int, default=41, help="number of ranked documents")
+    parser.add_argument("--repeat", type=int, default=1, help="number of replays of each workload")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--mongo-latency-ms", type=float, default=0.0,
+                        help="simulated round trip time of the mongo backend queries")
+    parser.add_argument("--no-bitmaps", action="store_true",
+                        help="keep every posting list as a doc id list instead of bitmaps for the dense terms")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=str, default=None, help="JSON report file, stdout by default")
+    args = parser.parse_args()
+
+    if args.no_bitmaps:
+        bitmap_postings.MIN_DENSE_DF = float("inf")
+    log_queries = load_log(args.log) if args.log else []
+    report = {"commit": git_commit(), "time": time.time(), "mode": args.mode, "corpus": args.wapo or "synthetic",
+              "mongo_latency_ms": args.mongo_latency_ms, "bitmaps": not args.no_bitmaps, "runs": []}
+    with tempfile.TemporaryDirectory(prefix="bench_") as work_dir:
+        for size in args.sizes:
+            if args.wapo:
+                docs = list(islice(load_wapo(args.wapo), size))
+            else:
+                docs = list(synthetic_docs(size, seed=args.seed))
+            for backend in args.backends:
+                stats, index, terms = build(backend, docs, args.workers, work_dir, args.mongo_latency_ms / 1000)
+                workloads = {}
+                if log_queries:
+                    workloads["log"] = log_queries
+                if args.zipf_queries and terms:
+                    workloads["zipf"] = zipf_queries(terms, args.zipf_queries, seed=args.seed)
+                for name, queries in workloads.items():
+                    # every workload starts with a cold postings cache
+                    cache = inverted_index.POSTINGS_CACHES[inverted_index.DEFAULT_ANALYZER]
+                    cache.clear()
+                    hits, misses = cache.hits, cache.misses
+                    inverted_index._mongo_doc_lengths.clear()
+                    run = {"docs": len(docs), "backend": backend, "workload": name, **stats,
+                           **replay(queries, index, args.mode, args.k, args.repeat)}
+                    if backend != "file":
+                        lookups = cache.hits - hits + cache.misses - misses
+                        run["cache_hit_rate"] = (cache.hits - hits) / lookups if lookups else 0.0
+                    report["runs"].append(run)
+                    print(f"{backend:<6}{len(docs):>8} docs  {name:<5} {run['qps']:>9.1f} q/s  "
+                          f"p50 {run['p50_ms']:.2f} p95 {run['p95_ms']:.2f} p99 {run['p99_ms']:.2f} ms",
+                          file=sys.stderr)
+                if index is not None:
+                    index.close()
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
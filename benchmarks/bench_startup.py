@@ -0,0 +1,87 @@
+"""
+cold start benchmark: time until a new process has imported the app (hw3) and can serve, with the analyzers created
+from nltk and restored from an analyzer snapshot (see analyzer_snapshot), and the time of the first normalization
+of a query, which loads the nltk resources that the snapshot left out
+each run is a new interpreter, the median of the runs is reported. importing the app does not connect to the storage
+run from the repository root:
+    python benchmarks/bench_startup.py --runs 5
+    python benchmarks/bench_startup.py --wapo pa3_data/wapo_pa3.jl --snapshot analyzers.pkl
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from itertools import islice
+from pathlib import Path
+from typing import Dict, Optional
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from analyzer_snapshot import save_snapshot, warm_up_analyzers  # noqa: E402
+from customized_text_processing import CustomizedTextProcessing  # noqa: E402
+from text_processing import TextProcessing  # noqa: E402
+from utils import load_wapo  # noqa: E402
+
+QUERY = "homicides in Prince George's county"
+CHILD = """
+import json, time
+start_t = time.perf_counter()
+import hw3
+ready_t = time.perf_counter()
+hw3.ANALYZERS[hw3.DEFAULT_ANALYZER].get_normalized_tokens("", {query!r})
+print(json.dumps({{"import": ready_t - start_t, "first_query": time.perf_counter() - ready_t,
+                  "startup": hw3.STARTUP_SECONDS}}))
+"""
+
+
+def write_snapshot(path: str, wapo: Optional[str], num_docs: int) -> None:
+    analyzers = {"nltk": TextProcessing.from_nltk(), "custom": CustomizedTextProcessing.from_customized()}
+    if wapo:
+        warm_up_analyzers(analyzers.values(), (doc['title'] or "" for doc in islice(load_wapo(wapo), num_docs)))
+    save_snapshot(analyzers, path)
+
+
+def run(snapshot: Optional[str]) -> Dict[str, float]:
+    env = dict(os.environ, BRS_PRELOAD="0")
+    env.pop("BRS_ANALYZER_SNAPSHOT", None)
+    if snapshot:
+        env["BRS_ANALYZER_SNAPSHOT"] = snapshot
+    start_t = time.perf_counter()
+    out = subprocess.run([sys.executable, "-c", CHILD.format(query=QUERY)], cwd=ROOT, env=env, check=True,
+                         capture_output=True, text=True).stdout
+    timings = json.loads(out.strip().splitlines()[-1])
+    timings["process"] = time.perf_counter() - start_t
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="cold start benchmark")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--snapshot", type=str, default=None,
+                        help="analyzer snapshot to use, written to a temporary file when not given")
+    parser.add_argument("--wapo", type=str, default=None, help="warm the written snapshot with the titles of this file")
+    parser.add_argument("--docs", type=int, default=100000, help="number of titles to warm the snapshot with")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        snapshot = args.snapshot
+        if snapshot is None or not os.path.exists(snapshot):
+            snapshot = snapshot or os.path.join(tmp_dir, "analyzers.pkl")
+            write_snapshot(snapshot, args.wapo, args.docs)
+        print(f"snapshot: {snapshot} ({os.path.getsize(snapshot) / 1024:0.0f} KB)")
+        print(f"{'analyzers':<12}{'process':>10}{'import':>10}{'startup':>10}{'1st query':>11}   (ms, median of "
+              f"{args.runs})")
+        for name, path in (("nltk", None), ("snapshot", snapshot)):
+            runs = [run(path) for _ in range(args.runs)]
+            print(f"{name:<12}" + "".join(f"{statistics.median(r[key] for r in runs) * 1000:>{width}.0f}"
+                                          for key, width in (("process", 10), ("import", 10), ("startup", 10),
+                                                             ("first_query", 11))))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+"""
+term dictionary benchmark: latency of prefix expansion, wildcard expansion and spelling suggestions with
+term_dictionary.TermDictionary against a scan of all the terms (startswith, fnmatch and an edit distance per term with
+the same first letter), and the memory of the dictionary against a list of the terms
+the vocabulary is the one of a postings file, or synthetic words with Zipf document frequencies like bench_search's.
+the queries are prefixes, wildcards and misspellings (one or two random edits) of random terms
+run from the repository root:
+    python benchmarks/bench_terms.py --terms 200000 --lookups 200
+    python benchmarks/bench_terms.py --index-file index.idx
+"""
+import argparse
+import fnmatch
+import random
+import statistics
+import string
+import sys
+import time
+from pathlib import Path
+from typing import Callable, List, Tuple
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from postings_file import PostingsFile  # noqa: E402
+from term_dictionary import MAX_EDIT_DISTANCE, MAX_EXPANSIONS, TermDictionary  # noqa: E402
+
+
+def synthetic_vocabulary(num_terms: int, seed: int = 0) -> Tuple[List[str], List[int]]:
+    rng = random.Random(seed)
+    terms = sorted({"".join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(3, 10)))
+                    for _ in range(num_terms)})
+    ranks = list(range(1, len(terms) + 1))
+    rng.shuffle(ranks)
+    return terms, [max(1, int(1000000 / rank)) for rank in ranks]
+
+
+def misspell(term: str, rng: random.Random) -> str:
+    for _ in range(rng.randint(1, MAX_EDIT_DISTANCE)):
+        i = rng.randrange(len(term) + 1)
+        edit = rng.choice(("insert", "delete", "replace")) if term else "insert"
+        char = rng.choice(string.ascii_lowercase)
+        if edit == "insert":
+            term = term[:i] + char + term[i:]
+        elif edit == "delete":
+            term = term[:max(i - 1, 0)] + term[i:]
+        else:
+            term = term[:max(i - 1, 0)] + char + term[i:]
+    return term
+
+
+def edit_distance(a: str, b: str) -> int:
+    row = list(range(len(b) + 1))
+    for i, char in enumerate(a, 1):
+        above, row = row, [i]
+        for j, other in enumerate(b, 1):
+            row.append(min(row[j - 1] + 1, above[j] + 1, above[j - 1] + (char != other)))
+    return row[-1]
+
+
+def time_lookups(func: Callable, queries: List[str]) -> float:
+    """
+    :return: median latency in milliseconds
+    """
+    latencies = []
+    for query in queries:
+        start_t = time.perf_counter()
+        func(query)
+        latencies.append(time.perf_counter() - start_t)
+    return statistics.median(latencies) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="term dictionary benchmark")
+    parser.add_argument("--index-file", type=str, default=None, help="take the vocabulary of this postings file")
+    parser.add_argument("--terms", type=int, default=200000, help="size of the synthetic vocabulary")
+    parser.add_argument("--lookups", type=int, default=200)
+    parser.add_argument("--scan-lookups", type=int, default=10, help="lookups timed for the scans, which are slow")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.index_file:
+        index = PostingsFile(args.index_file)
+        terms = list(index.terms())
+        dfs = [index.df(term) for term in terms]
+    else:
+        terms, dfs = synthetic_vocabulary(args.terms, args.seed)
+    start_t = time.perf_counter()
+    dictionary = TermDictionary(terms, dfs)
+    build_t = time.perf_counter() - start_t
+    df = dict(zip(terms, dfs))
+    memory = len(dictionary._blob) + dictionary._offsets.itemsize * len(dictionary._offsets) + \
+        dictionary._dfs.itemsize * len(dictionary._dfs)
+    list_memory = sys.getsizeof(terms) + sum(sys.getsizeof(term) for term in terms)
+    print(f"{len(terms)} terms, built in {build_t * 1000:0.0f} ms, {memory / 2 ** 20:0.1f} MB "
+          f"(list of str: {list_memory / 2 ** 20:0.1f} MB)")
+
+    rng = random.Random(args.seed)
+    sample = [rng.choice(terms) for _ in range(args.lookups)]
+    prefixes = [term[:max(2, len(term) // 2)] for term in sample]
+    wildcards = [term[:2] + "*" + term[-2:] for term in sample]
+    typos = [misspell(term, rng) for term in sample]
+
+    def most_frequent(matches: List[str]) -> List[str]:
+        return sorted(matches, key=lambda term: -df[term])[:MAX_EXPANSIONS]
+
+    lookups = [
+        ("prefix", prefixes, dictionary.expand_prefix,
+         lambda prefix: most_frequent([term for term in terms if term.startswith(prefix)])),
+        ("wildcard", wildcards, dictionary.expand,
+         lambda pattern: most_frequent(fnmatch.filter(terms, pattern))),
+        ("suggest", typos, dictionary.suggest,
+         lambda word: sorted(term for term in terms
+                             if term[:1] == word[:1] and edit_distance(word, term) <= MAX_EDIT_DISTANCE)),
+    ]
+    print(f"{'lookup':<10}{'dictionary':>12}{'scan':>12}   (ms, median)")
+    for name, queries, func, scan in lookups:
+        print(f"{name:<10}{time_lookups(func, queries):>12.3f}"
+              f"{time_lookups(scan, queries[:args.scan_lookups]):>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
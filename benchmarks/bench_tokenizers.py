@@ -0,0 +1,90 @@
+"""
+throughput and term agreement of the analyzers' tokenizer paths on a sample of the WAPO corpus
+run from the repository root: python benchmarks/bench_tokenizers.py [--wapo pa3_data/wapo_pa3.jl] [--docs 1000]
+"""
+import argparse
+import sys
+import time
+from itertools import islice
+from pathlib import Path
+from typing import Callable, Dict, List, Set
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from nltk import pos_tag, word_tokenize  # noqa: E402
+
+from customized_text_processing import CustomizedTextProcessing  # noqa: E402
+from text_processing import TextProcessing  # noqa: E402
+from tokenization import RegexTokenizer  # noqa: E402
+from utils import load_wapo  # noqa: E402
+
+
+def legacy_custom_analyzer() -> Callable:
+    # the former CustomizedTextProcessing path: nltk.pos_tag (which reloads the tagger) on each text
+    custom = CustomizedTextProcessing.from_customized()
+
+    def get_normalized_tokens(title: str, content: str) -> Set[str]:
+        token_tags = set()
+        for text in (title, content):
+            if text is None:
+                continue
+            for token, tag in pos_tag(word_tokenize(text)):
+                normalized = custom.normalize(token)
+                if normalized != "":
+                    token_tags.add(normalized + '_' + tag)
+        return token_tags
+
+    return get_normalized_tokens
+
+
+# name -> (factory of a get_normalized_tokens like function, name of the reference analyzer)
+ANALYZERS: Dict[str, tuple] = {
+    "nltk": (lambda: TextProcessing.from_nltk(tokenizer="nltk").get_normalized_tokens, "nltk"),
+    "regex": (lambda: TextProcessing.from_nltk(tokenizer="regex").get_normalized_tokens, "nltk"),
+    "custom-legacy": (legacy_custom_analyzer, "custom-legacy"),
+    "custom": (lambda: CustomizedTextProcessing.from_customized().get_normalized_tokens, "custom-legacy"),
+    "custom-fast": (lambda: CustomizedTextProcessing.from_customized(
+        tokenizer=RegexTokenizer(), tag_cache_size=200000).get_normalized_tokens, "custom-legacy"),
+}
+
+
+def run(analyze: Callable, docs: List[Dict]) -> tuple:
+    start_t = time.perf_counter()
+    term_sets = [analyze(doc['title'], doc['content_str']) for doc in docs]
+    return time.perf_counter() - start_t, term_sets
+
+
+def jaccard(a: Set[str], b: Set[str]) -> float:
+    return len(a & b) / len(a | b) if a or b else 1.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="tokenizer benchmark")
+    parser.add_argument("--wapo", type=str,
+                        default=str(Path(__file__).resolve().parent.parent / "pa3_data" / "wapo_pa3.jl"))
+    parser.add_argument("--docs", type=int, default=1000, help="number of documents in the sample")
+    parser.add_argument("--analyzers", nargs="+", default=list(ANALYZERS), choices=list(ANALYZERS))
+    args = parser.parse_args()
+
+    docs = list(islice(load_wapo(args.wapo), args.docs))
+    # throughput is reported in reference (word_tokenize) tokens so that all analyzers are comparable
+    num_tokens = sum(len(word_tokenize(doc['title'] or "")) + len(word_tokenize(doc['content_str'] or ""))
+                     for doc in docs)
+    results = {}
+    print(f"{len(docs)} docs, {num_tokens} tokens")
+    print(f"{'analyzer':<16}{'seconds':>10}{'tokens/sec':>14}{'doc jaccard':>14}{'vocab jaccard':>15}")
+    for name in args.analyzers:
+        factory, reference = ANALYZERS[name]
+        elapsed_t, term_sets = run(factory(), docs)
+        results[name] = term_sets
+        if reference not in results:
+            results[reference] = run(ANALYZERS[reference][0](), docs)[1]
+        ref_sets = results[reference]
+        doc_agreement = sum(jaccard(a, b) for a, b in zip(term_sets, ref_sets)) / len(docs)
+        vocab_agreement = jaccard(set().union(*term_sets), set().union(*ref_sets))
+        print(f"{name:<16}{elapsed_t:>10.2f}{num_tokens / elapsed_t:>14.0f}{doc_agreement:>14.4f}"
+              f"{vocab_agreement:>15.4f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""
+closed-loop load test of the search endpoints: concurrent clients send a mixed workload of boolean, phrase and ranked
+queries over keep-alive connections and the requests/sec and latency percentiles are reported
+run against a running server, e.g. to compare the flask pages with the async API:
+    python benchmarks/load_test.py --url http://localhost:5000/results
+    python benchmarks/load_test.py --url http://localhost:5001/api/search
+"""
+import argparse
+import http.client
+import random
+import threading
+import time
+from typing import List, Tuple
+from urllib.parse import urlencode, urlsplit
+
+# (query, mode), the page is drawn separately
+WORKLOAD = [
+    ("police", "boolean"),
+    ("homicide police", "boolean"),
+    ("election OR campaign", "boolean"),
+    ("court NOT supreme", "boolean"),
+    ('"white house"', "boolean"),
+    ('"prince george\'s county"', "boolean"),
+    ("(school OR education) AND budget", "boolean"),
+    ("police shooting", "ranked"),
+    ("climate change policy", "ranked"),
+    ("washington redskins", "ranked"),
+]
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(int(len(sorted_values) * p / 100), len(sorted_values) - 1)]
+
+
+def client(url: str, workload: List[Tuple[str, str]], deadline: float, seed: int, timeout: float,
+           latencies: List[float], errors: List[int]) -> None:
+    parts = urlsplit(url)
+    rng = random.Random(seed)
+    conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=timeout)
+    while time.perf_counter() < deadline:
+        query, mode = rng.choice(workload)
+        # most users stay on the first page
+        page = 1 if rng.random() < 0.8 else rng.randint(2, 5)
+        path = parts.path + "?" + urlencode({"q": query, "mode": mode, "page": page})
+        start_t = time.perf_counter()
+        try:
+            conn.request("GET", path)
+            response = conn.getresponse()
+            response.read()
+            ok = response.status == 200
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=timeout)
+            ok = False
+        if ok:
+            latencies.append(time.perf_counter() - start_t)
+        else:
+            errors.append(1)
+    conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="search endpoint load test")
+    parser.add_argument("--url", type=str, default="http://localhost:5001/api/search")
+    parser.add_argument("--concurrency", type=int, default=32, help="number of concurrent clients")
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds")
+    parser.add_argument("--timeout", type=float, default=10.0, help="client side timeout of a request in seconds")
+    parser.add_argument("--queries", type=str, default=None,
+                        help="file of 'mode<TAB>query' lines to use instead of the built-in workload")
+    args = parser.parse_args()
+
+    workload = WORKLOAD
+    if args.queries:
+        with open(args.queries, encoding="utf-8") as f:
+            workload = [tuple(reversed(line.rstrip("\n").split("\t", 1))) for line in f if "\t" in line]
+
+    latencies = []
+    errors = []
+    deadline = time.perf_counter() + args.duration
+    threads = [threading.Thread(target=client, args=(args.url, workload, deadline, seed, args.timeout, latencies,
+                                                     errors))
+               for seed in range(args.concurrency)]
+    start_t = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed_t = time.perf_counter() - start_t
+
+    latencies.sort()
+    print(f"{args.url}: {args.concurrency} clients, {elapsed_t:.1f} seconds")
+    print(f"requests {len(latencies)}, errors {len(errors)}, {len(latencies) / elapsed_t:.1f} requests/sec")
+    print("latency ms: " + ", ".join(f"p{p} {percentile(latencies, p) * 1000:.1f}" for p in (50, 95, 99)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+import heapq
+import re
+from itertools import groupby
+from typing import Dict, Iterable, List, Union
+
+# a posting list is dense, and gets a bitmap, when it holds at least one doc id in DENSE_RATIO of its id range.
+# a bitmap costs one bit per doc id in the range, a list of ints about 8 bytes per doc id (the small int objects
+# below 256 are shared, the others take 28 more bytes), so the bitmap is the smaller one well below this ratio; the
+# threshold is set by the speed of the kernels instead (see benchmarks/bench_bitmaps.py)
+DENSE_RATIO = 32
+# shorter lists are always kept as lists, their set operations are cheap anyway
+MIN_DENSE_DF = 1024
+
+_ONE = re.compile("1")
+
+
+class Bitmap:
+    __slots__ = ("buf", "count")
+
+    def __init__(self, buf: bytes, count: int):
+        """
+        compressed representation of a dense posting list: bit doc_id (little endian) of buf is set for each doc id.
+        the bitwise kernels convert buf to a python int, so that AND / OR / NOT over two bitmaps run in C over
+        machine words instead of one doc id at a time
+        :param buf:
+        :param count: number of doc ids
+        """
+        self.buf = buf
+        self.count = count
+
+    @classmethod
+    def from_doc_ids(cls, doc_ids: Iterable[int]) -> "Bitmap":
+        doc_ids = list(doc_ids)
+        buf = bytearray((doc_ids[-1] >> 3) + 1 if doc_ids else 0)
+        for doc_id in doc_ids:
+            buf[doc_id >> 3] |= 1 << (doc_id & 7)
+        return cls(bytes(buf), len(doc_ids))
+
+    @classmethod
+    def from_int(cls, bits: int) -> "Bitmap":
+        return cls(bits.to_bytes((bits.bit_length() + 7) >> 3, "little"), bin(bits).count("1"))
+
+    def to_int(self) -> int:
+        return int.from_bytes(self.buf, "little")
+
+    def to_list(self) -> List[int]:
+        """
+        the ascending doc ids. the bits are scanned in C as a string of 0 and 1
+        :return:
+        """
+        bits = self.to_int()
+        if not bits:
+            return []
+        return [match.start() for match in _ONE.finditer(bin(bits)[:1:-1])]
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __contains__(self, doc_id: int) -> bool:
+        byte = doc_id >> 3
+        return byte < len(self.buf) and bool(self.buf[byte] >> (doc_id & 7) & 1)
+
+    @property
+    def nbytes(self) -> int:
+        return len(self.buf)
+
+    def filter(self, doc_ids: List[int]) -> List[int]:
+        """
+        the doc ids of the list that are in the bitmap, a probe of one byte per doc id
+        :param doc_ids: ascending doc ids
+        :return: ascending doc ids
+        """
+        buf = self.buf
+        limit = len(buf) << 3
+        return [doc_id for doc_id in doc_ids if doc_id < limit and buf[doc_id >> 3] >> (doc_id & 7) & 1]
+
+    def exclude(self, doc_ids: List[int]) -> List[int]:
+        """
+        the doc ids of the list that are not in the bitmap
+        :param doc_ids: ascending doc ids
+        :return: ascending doc ids
+        """
+        buf = self.buf
+        limit = len(buf) << 3
+        return [doc_id for doc_id in doc_ids if doc_id >= limit or not buf[doc_id >> 3] >> (doc_id & 7) & 1]
+
+
+Postings = Union[List[int], Bitmap]
+
+
+class DensePostingDict(dict):
+    """
+    posting dict of a dense term that holds its bitmap instead of the list of its doc ids, the form in which the
+    caches keep dense terms (see compact). the list is rebuilt from the bitmap whenever post_dict['doc_ids'] is read
+    and is not kept, so the evaluator works on the bitmap and only the ranking and the phrases pay for the list
+    """
+
+    def __missing__(self, key: str):
+        if key == 'doc_ids':
+            return self['bitmap'].to_list()
+        raise KeyError(key)
+
+
+def is_dense(doc_ids: List[int]) -> bool:
+    """
+    whether the posting list is better represented as a bitmap
+    :param doc_ids: ascending doc ids
+    :return:
+    """
+    return len(doc_ids) >= MIN_DENSE_DF and len(doc_ids) * DENSE_RATIO > doc_ids[-1]
+
+
+def hybrid(doc_ids: List[int]) -> Postings:
+    """
+    a bitmap for a dense posting list, the list itself otherwise
+    :param doc_ids: ascending doc ids
+    :return:
+    """
+    return Bitmap.from_doc_ids(doc_ids) if is_dense(doc_ids) else doc_ids
+
+
+def term_postings(post_dict: Dict) -> Postings:
+    """
+    the hybrid representation of a posting dict as returned by mongo_db.query_db_index. the bitmap of a dense term
+    is built once and kept in the posting dict under "bitmap"
+    :param post_dict:
+    :return:
+    """
+    bitmap = post_dict.get('bitmap')
+    if bitmap is not None:
+        return bitmap
+    doc_ids = post_dict['doc_ids']
+    if not is_dense(doc_ids):
+        return doc_ids
+    bitmap = post_dict['bitmap'] = Bitmap.from_doc_ids(doc_ids)
+    return bitmap
+
+
+def compact(post_dict: Dict) -> Dict:
+    """
+    the posting dict to cache: a dense term keeps its bitmap and drops its list of doc ids, a DensePostingDict
+    :param post_dict: posting dict as returned by mongo_db.query_db_index
+    :return:
+    """
+    if isinstance(post_dict, DensePostingDict) or not isinstance(term_postings(post_dict), Bitmap):
+        return post_dict
+    return DensePostingDict((key, value) for key, value in post_dict.items() if key != 'doc_ids')
+
+
+def doc_count(post_dict: Dict) -> int:
+    """
+    document frequency of a posting dict, without rebuilding the doc ids of a DensePostingDict
+    :param post_dict:
+    :return:
+    """
+    bitmap = post_dict.get('bitmap')
+    return len(bitmap) if bitmap is not None else len(post_dict['doc_ids'])
+
+
+def to_list(postings: Postings) -> List[int]:
+    return postings.to_list() if isinstance(postings, Bitmap) else postings
+
+
+def _to_int(postings: Postings) -> int:
+    return postings.to_int() if isinstance(postings, Bitmap) else Bitmap.from_doc_ids(postings).to_int()
+
+
+def and_postings(a: Postings, b: Postings) -> Postings:
+    """
+    intersection kernel over both representations: bitwise AND of two bitmaps, a probe of the bitmap for each doc id
+    of a list, a hash probe of the longer list for two lists (inverted_index.intersect_two gallops instead)
+    :param a:
+    :param b:
+    :return: a bitmap when both operands are bitmaps, a list otherwise
+    """
+    if isinstance(a, Bitmap) and isinstance(b, Bitmap):
+        return Bitmap.from_int(a.to_int() & b.to_int())
+    if isinstance(a, Bitmap):
+        return a.filter(b)
+    if isinstance(b, Bitmap):
+        return b.filter(a)
+    short, long = (a, b) if len(a) <= len(b) else (b, a)
+    long_set = set(long)
+    return [doc_id for doc_id in short if doc_id in long_set]
+
+
+def or_postings(operands: List[Postings]) -> Postings:
+    """
+    union kernel: the lists are merged when no operand is a bitmap, otherwise every operand is ORed into one bitmap
+    :param operands:
+    :return:
+    """
+    if not any(isinstance(operand, Bitmap) for operand in operands):
+        return [doc_id for doc_id, _ in groupby(heapq.merge(*operands))]
+    bits = 0
+    for operand in operands:
+        bits |= _to_int(operand)
+    return Bitmap.from_int(bits)
+
+
+def andnot_postings(a: Postings, b: Postings) -> Postings:
+    """
+    difference kernel, the doc ids of a that are not in b
+    :param a:
+    :param b:
+    :return: a bitmap when a is a bitmap, a list otherwise
+    """
+    if isinstance(a, Bitmap):
+        return Bitmap.from_int(a.to_int() & ~_to_int(b))
+    if isinstance(b, Bitmap):
+        return b.exclude(a)
+    b_set = set(b)
+    return [doc_id for doc_id in a if doc_id not in b_set]
@@ -1,7 +1,16 @@
-from typing import Set, List
+from collections import Counter
+from typing import Dict, Set, List, Tuple, Optional
+import os
 import re
-from nltk import pos_tag, word_tokenize
-from nltk.corpus import stopwords
+
+from utils import LRUCache
+from tracing import span
+from tokenization import NLTKTokenizer
+from text_processing import nltk_stop_words
+
+# default size of the tag cache (see CustomizedTextProcessing), off unless set: the memoized tags don't depend on the
+# context, so the index has to be built and queried with the same setting
+TAG_CACHE_SIZE = int(os.environ.get("BRS_TAG_CACHE_SIZE", 0))
 
 
 class CustomizedTextProcessing:
@@ -16,11 +25,19 @@ class CustomizedTextProcessing:
         be based on heuristics, the usage of a tool from nltk or some new feature you implemented using Python. Be creative!
 
         # TODO:
-        :param args:
-        :param kwargs:
+        :param args: the stop words, nltk english stop words by default
+        :param kwargs: tokenizer: tokenization.Tokenizer (nltk word_tokenize by default),
+            tag_cache_size: when > 0, the part of speech of a surface form is memoized the first time it is tagged and
+            only unseen surface forms are sent to the tagger. much faster, but the tags no longer depend on the context.
+            TAG_CACHE_SIZE by default
         """
+        self.tokenizer = kwargs.get('tokenizer') or NLTKTokenizer()
+        tag_cache_size = kwargs.get('tag_cache_size', TAG_CACHE_SIZE)
+        self.tag_cache = LRUCache(tag_cache_size) if tag_cache_size else None
+        # the perceptron model is loaded on first use, see tagger
+        self._tagger = None
         # use list of stop words in addition to converting basic digits to alphabetized versions
-        self.STOP_WORDS = set(stopwords.words('english'))
+        self.STOP_WORDS = set(args[0]) if args else set(nltk_stop_words())
         self.num_dict = {'1': 'one', '2': 'two', '3': 'three', '4': 'four', '5': 'five', '6': 'six', '7': 'seven',
                          '8': 'eight', '9': 'nine', '10': 'ten', '11': 'eleven', '12': 'twelve', '13': 'thirteen',
                          '14': 'fourteen', '15': 'fifteen', '16': 'sixteen', '17': 'seventeen', '18': 'eighteen',
@@ -28,16 +45,81 @@ class CustomizedTextProcessing:
                          '70': 'seventy', '80': 'eighty', '90': 'ninety', '100': 'hundred', '0': 'zero'}
 
     @classmethod
-    def from_customized(cls, stop_words: List[str] = stopwords.words("english"), *args, **kwargs) \
+    def from_customized(cls, stop_words: Optional[List[str]] = None, *args, **kwargs) \
             -> "CustomizedTextProcessing":
         """
         You don't necessarily need to implement a class method, but if you do, please use this boilerplate.
-        :param stop_words:
+        :param stop_words: nltk english stop words by default
         :param args:
         :param kwargs:
         :return:
         """
-        return cls(set(stop_words))
+        if stop_words is None:
+            stop_words = nltk_stop_words()
+        return cls(set(stop_words), *args, **kwargs)
+
+    @classmethod
+    def from_state(cls, state: Dict, **kwargs) -> "CustomizedTextProcessing":
+        """
+        analyzer restored from its state (see state and analyzer_snapshot), without loading nltk
+        :param state:
+        :param kwargs: see __init__, the tag cache size is the one of the state
+        :return:
+        """
+        kwargs['tag_cache_size'] = state['tag_cache_size']
+        custom = cls(state['stop_words'], **kwargs)
+        custom.num_dict = state['num_dict']
+        for token, tag in state['tag_cache']:
+            custom.tag_cache.put(token, tag)
+        return custom
+
+    def state(self) -> Dict:
+        """
+        stop words, number map and memoized tags of the analyzer
+        :return: dict of builtin types, so that it is serialized and loaded without importing nltk
+        """
+        return {'stop_words': set(self.STOP_WORDS), 'num_dict': dict(self.num_dict),
+                'tag_cache_size': self.tag_cache.maxsize if self.tag_cache is not None else 0,
+                'tag_cache': list(self.tag_cache.items()) if self.tag_cache is not None else []}
+
+    @property
+    def tagger(self):
+        # nltk.pos_tag loads the perceptron model on every call, keep one loaded tagger instead
+        if self._tagger is None:
+            from nltk.tag.perceptron import PerceptronTagger
+            self._tagger = PerceptronTagger()
+        return self._tagger
+
+    def tag_sents(self, sents: List[List[str]]) -> List[List[Tuple[str, str]]]:
+        """
+        part of speech tagging of several token lists with the same tagger, like nltk.pos_tag on each of them
+        :param sents:
+        :return:
+        """
+        with span("pos_tag"):
+            return self._tag_sents(sents)
+
+    def _tag_sents(self, sents: List[List[str]]) -> List[List[Tuple[str, str]]]:
+        if self.tag_cache is None:
+            return self.tagger.tag_sents(sents)
+        tagged = []
+        for sent in sents:
+            # the cached tags are read before the new ones are inserted, which may evict them
+            tags = {}
+            unseen = []
+            for token in dict.fromkeys(sent):
+                tag = self.tag_cache.get(token)
+                if tag is None:
+                    unseen.append(token)
+                else:
+                    tags[token] = tag
+            if unseen:
+                new_tags = dict(self.tagger.tag(unseen))
+                for token, tag in new_tags.items():
+                    self.tag_cache.put(token, tag)
+                tags.update(new_tags)
+            tagged.append([(token, tags[token]) for token in sent])
+        return tagged
 
     def normalize(self, token: str) -> str:
         """
@@ -71,22 +153,77 @@ class CustomizedTextProcessing:
         # TODO:
         # the customized text processing class adds part of speech tags to the tokens using pos_tag()
         tags_and_pos = []
-        if title is not None:
-            tags_and_pos.extend(pos_tag(word_tokenize(title)))
-        if content is not None:
-            tags_and_pos.extend(pos_tag(word_tokenize(content)))
+        with span("tokenize"):
+            sents = [self.tokenizer.tokenize(text) for text in (title, content) if text is not None]
+        for tagged in self.tag_sents(sents):
+            tags_and_pos.extend(tagged)
 
         token_tags = set()
 
         # concatenate POS tag to token
-        for token_and_tag in tags_and_pos:
-            normalized = self.normalize(token_and_tag[0])
-            if normalized != "":
-                concat = normalized + '_' + token_and_tag[1]
-                token_tags.add(concat)
+        with span("normalize"):
+            for token_and_tag in tags_and_pos:
+                normalized = self.normalize(token_and_tag[0])
+                if normalized != "":
+                    concat = normalized + '_' + token_and_tag[1]
+                    token_tags.add(concat)
 
         return token_tags
 
+    def get_normalized_positions(self, title: str, content: str,
+                                 forms: Optional[Counter] = None) -> Dict[str, List[int]]:
+        """
+        positional version of get_normalized_tokens, with the same position numbering as
+        TextProcessing.get_normalized_positions: every token counts, and the content starts one position after the
+        end of the title
+        :param title:
+        :param content:
+        :param forms: see TextProcessing.get_normalized_positions
+        :return:
+        """
+        positions = {}
+        pos = 0
+        with span("tokenize"):
+            sents = [self.tokenizer.tokenize(text) for text in (title, content) if text is not None]
+        tagged_sents = self.tag_sents(sents)
+        with span("normalize"):
+            for tagged in tagged_sents:
+                for token, tag in tagged:
+                    normalized = self.normalize(token)
+                    if normalized != "":
+                        term = normalized + '_' + tag
+                        positions.setdefault(term, []).append(pos)
+                        if forms is not None:
+                            forms[term, token.lower()] += 1
+                    pos += 1
+                pos += 1
+        return positions
+
+    def normalize_in_context(self, texts: List[str]) -> List[Dict[str, List[int]]]:
+        """
+        positional normalization of several short texts, e.g. the words and phrases of a query, tagged together as
+        one sentence: a word tagged alone often gets another tag than in the documents, whose tokens are tagged in
+        the context of their sentence
+        :param texts:
+        :return: for each text, normalized token -> positions from the start of the text
+        """
+        with span("tokenize"):
+            sents = [self.tokenizer.tokenize(text) for text in texts]
+        tokens = [token for sent in sents for token in sent]
+        tagged = self.tag_sents([tokens])[0] if tokens else []
+        results = []
+        start = 0
+        with span("normalize"):
+            for sent in sents:
+                positions = {}
+                for pos, (token, tag) in enumerate(tagged[start:start + len(sent)]):
+                    normalized = self.normalize(token)
+                    if normalized != "":
+                        positions.setdefault(normalized + '_' + tag, []).append(pos)
+                results.append(positions)
+                start += len(sent)
+        return results
+
 
 if __name__ == "__main__":
     custom = CustomizedTextProcessing.from_customized()
@@ -1,80 +1,275 @@
-from pathlib import Path
-import argparse
-from flask import Flask, render_template, request
-from utils import load_wapo
-from inverted_index import build_inverted_index, query_inverted_index
-from mongo_db import db, insert_docs, query_doc
+import time
+# start of the import of the app, the imports below are part of the startup time recorded as "startup"
+START_T = time.perf_counter()
+from pathlib import Path  # noqa: E402
+from typing import Dict, List, Tuple  # noqa: E402
+import argparse  # noqa: E402
+import os  # noqa: E402
+import re  # noqa: E402
+import threading  # noqa: E402
+from flask import Flask, Response, g, jsonify, render_template, request, url_for  # noqa: E402
+from utils import load_wapo, TTLCache  # noqa: E402
+from inverted_index import (  # noqa: E402
+    build_inverted_index, build_inverted_index_parallel, query_inverted_index, query_key, stopwords_in_query,
+    rank_inverted_index, analyzer_index_path, warm_up, positive_terms, suggest_terms, check_index_generation, ANALYZERS,
+    DEFAULT_ANALYZER, POSTINGS_CACHES, get_term_dictionary, index_collection)
+from postings_file import PostingsFile  # noqa: E402
+from segments import SegmentedIndex  # noqa: E402
+from sharding import ShardCoordinator, build_shards  # noqa: E402
+from mongo_db import has_docs, insert_docs, query_doc, query_docs, resume_id, next_doc_id, query_index_generation, \
+    SNIPPET_STORE  # noqa: E402
+from query_parser import parse_query, AND, OR, NOT  # noqa: E402
+from snippet_store import SnippetStore, SnippetStoreWriter  # noqa: E402
+from tracing import span, record, start_trace, finish_trace, configure_slow_query_log, metrics_text  # noqa: E402
+from analyzer_snapshot import save_snapshot, warm_up_analyzers, preload  # noqa: E402
 
 app = Flask(__name__)
 
-MATCHES = []
-SW = []
-UNKNOWNS = []
-QUERY = []
+PAGE_SIZE = 8
+# ranked results are computed by blocks of this many pages
+RANKED_DEPTH_PAGES = 5
+
+
+
+def open_indexes() -> Dict[str, object]:
+    """
+    the index backend of each analyzer that can be searched: the compressed postings file or incrementally updated
+    segments backend, the indexes of the other analyzers are next to the one of the default analyzer (see
+    inverted_index.analyzer_index_path). queries go to the mongo "inverted_index" collections when neither is set,
+    the other analyzers are offered once a build stored a generation of their collection
+    :return: analyzer name -> index, None for mongo
+    """
+    if os.environ.get("BRS_SEGMENTS_DIR"):
+        path = os.environ["BRS_SEGMENTS_DIR"]
+        open_index = lambda name: SegmentedIndex(analyzer_index_path(path, name), analyzer=ANALYZERS[name])
+    elif os.environ.get("BRS_INDEX_FILE"):
+        path = os.environ["BRS_INDEX_FILE"]
+        open_index = lambda name: PostingsFile(analyzer_index_path(path, name))
+    else:
+        return {name: None for name in ANALYZERS
+                if name == DEFAULT_ANALYZER or query_index_generation(index_collection(name)) is not None}
+    return {name: open_index(name) for name in ANALYZERS
+            if name == DEFAULT_ANALYZER or os.path.exists(analyzer_index_path(path, name))}
+
+
+with span("startup.open_indexes"):
+    INDEXES = open_indexes()
+# shard servers to send the queries to instead of INDEXES, see sharding
+SHARDS = ShardCoordinator.from_env(os.environ["BRS_SHARDS"]) if os.environ.get("BRS_SHARDS") else None
+# past queries, one per line, whose terms are loaded into the postings caches of the mongo indexes at startup
+if os.environ.get("BRS_QUERY_LOG"):
+    with open(os.environ["BRS_QUERY_LOG"], encoding="utf-8") as f:
+        query_log = f.readlines()
+    with span("startup.warm_up"):
+        for name, index in INDEXES.items():
+            if index is None:
+                warm_up(query_log, name)
+# requests slower than BRS_SLOW_QUERY_MS milliseconds are logged with their stage breakdown to BRS_SLOW_QUERY_LOG
+if os.environ.get("BRS_SLOW_QUERY_MS"):
+    configure_slow_query_log(float(os.environ["BRS_SLOW_QUERY_MS"]), os.environ.get("BRS_SLOW_QUERY_LOG"))
+# matched ids and unknown words of recent queries, keyed by normalized query. each worker process has its own
+RESULT_CACHE = TTLCache(maxsize=1024, ttl=300)
 
 data_dir = Path(__file__).parent.joinpath("pa3_data")
 wapo_path = data_dir.joinpath("wapo_pa3.jl")
 
-if "wapo_docs" not in db.list_collection_names():
-    # if wapo_docs collection is not existed, create a new one and insert docs into it
-    insert_docs(load_wapo(wapo_path))
+# titles and highlighted snippets of the results pages, the snippets of the documents missing from it are read from
+# the doc store
+SNIPPETS = SnippetStore(SNIPPET_STORE) if SNIPPET_STORE and os.path.exists(SNIPPET_STORE) else None
+
+# importing the app does not connect to the storage nor ingest the corpus (see --ingest), the time until the app can
+# serve is recorded under "startup" in /metrics
+STARTUP_SECONDS = time.perf_counter() - START_T
+record("startup", STARTUP_SECONDS)
+print(f"'startup' ready in {STARTUP_SECONDS:0.3f} seconds")
+# the nltk resources the analyzers did not need at startup are loaded in the background, before the first query does
+if os.environ.get("BRS_PRELOAD", "1") == "1":
+    threading.Thread(target=preload, args=(list(ANALYZERS.values()),), daemon=True).start()
+
+
+def search(query_text: str, mode: str = "boolean", page_id: int = 1,
+           analyzer: str = DEFAULT_ANALYZER) -> Tuple[List[int], List[str], List[str], bool]:
+    """
+    query_inverted_index behind the result cache, so paging and repeated queries don't touch the index
+    in ranked mode only the top documents up to the requested page (rounded up to RANKED_DEPTH_PAGES pages) are
+    computed, plus one to know whether there is a next page
+    :param query_text:
+    :param mode: "boolean" or "ranked"
+    :param page_id: 1-based page number
+    :param analyzer: key of INDEXES, the index to search
+    :return: matched ids, stop words and unknown words as returned by query_inverted_index, and whether some shards
+        did not answer (the partial results are not cached)
+    """
+    ranked = mode == "ranked"
+    k = -(-page_id // RANKED_DEPTH_PAGES) * RANKED_DEPTH_PAGES * PAGE_SIZE + 1 if ranked else None
+    index = INDEXES[analyzer]
+    # a segmented index changes while the app runs, and a mongo index when it is rebuilt: their results are only valid
+    # for one generation
+    if index is None and SHARDS is None:
+        generation = check_index_generation(analyzer)
+    else:
+        generation = getattr(index, 'generation', 0)
+    key = (analyzer, query_key(query_text, analyzer), generation, k)
+    cached = RESULT_CACHE.get(key)
+    partial = False
+    if cached is None:
+        if SHARDS is not None and ranked:
+            ranked_ids, _, unknowns, partial = SHARDS.rank(query_text, k, analyzer=analyzer)
+            matching_ids = [doc_id for doc_id, _ in ranked_ids] or [-1]
+        elif SHARDS is not None:
+            matching_ids, _, unknowns, partial = SHARDS.query(query_text, analyzer=analyzer)
+        elif ranked:
+            ranked_ids, _, unknowns = rank_inverted_index(query_text, k, index=index, analyzer=analyzer)
+            matching_ids = [doc_id for doc_id, _ in ranked_ids] or [-1]
+        else:
+            matching_ids, _, unknowns = query_inverted_index(query_text, index=index, analyzer=analyzer)
+        cached = (matching_ids, unknowns)
+        if not partial:
+            RESULT_CACHE.put(key, cached)
+    matching_ids, unknowns = cached
+    return matching_ids, stopwords_in_query(query_text, analyzer), unknowns, partial
+
+
+def page_matches(matching_ids: List[int], page_id: int, query_text: str = ""):
+    """
+    load the [id, title, snippet] of the matches shown on a page, only those documents are fetched. the snippet is a
+    list of (text, is a query term) parts, the query terms are only highlighted for the documents of the snippet store
+    :param matching_ids:
+    :param page_id: 1-based page number
+    :param query_text: query whose terms are highlighted
+    :return:
+    """
+    page_ids = matching_ids[(page_id - 1) * PAGE_SIZE:page_id * PAGE_SIZE]
+    stored = {}
+    if SNIPPETS is not None:
+        with span("query_snippets"):
+            terms = positive_terms(parse_query(query_text, ANALYZERS[DEFAULT_ANALYZER]))
+            stored = SNIPPETS.get_many(page_ids, terms)
+    missing = [doc_id for doc_id in page_ids if doc_id not in stored]
+    if missing:
+        with span("query_doc"):
+            for doc in query_docs(missing):
+                stored[doc['id']] = dict(doc, highlighted=[(doc['snippet'], False)])
+    return [[doc_id, stored[doc_id]['title'], stored[doc_id]['highlighted']] for doc_id in page_ids
+            if doc_id in stored]
+
+
+def corrected_query(query_text: str, suggestions: Dict[str, List[str]], analyzer: str = DEFAULT_ANALYZER) -> str:
+    """
+    the query with every word normalized to an unknown term replaced by the first spelling suggestion of the term,
+    written as its most frequent surface form in the documents rather than as a stem. the suggestions without a known
+    surface form (an index built without them) are skipped. the operators, parentheses and quotes are kept
+    :param query_text:
+    :param suggestions: unknown term -> suggestions, see inverted_index.suggest_terms
+    :param analyzer:
+    :return:
+    """
+    dictionary = get_term_dictionary(INDEXES.get(analyzer), analyzer)
+
+    def correct(m) -> str:
+        word = m.group(0)
+        if word in (AND, OR, NOT):
+            return word
+        terms = ANALYZERS[analyzer].get_normalized_tokens('', word)
+        if len(terms) != 1 or next(iter(terms)) not in suggestions:
+            return word
+        forms = (dictionary.form(term) for term in suggestions[next(iter(terms))])
+        return next((form for form in forms if form), word)
+
+    return re.sub(r'[^\s()"]+', correct, query_text)
+
+
+def render_results(query_text: str, page_id: int, mode: str = "boolean", analyzer: str = DEFAULT_ANALYZER):
+    """
+    render a page of results. the query and the page are both in the url, so any worker can serve any page
+    :param query_text:
+    :param page_id: 1-based page number
+    :param mode: "boolean" or "ranked"
+    :param analyzer: index to search, the default analyzer's when it has no index
+    :return:
+    """
+    if analyzer not in INDEXES:
+        analyzer = DEFAULT_ANALYZER
+    matching_ids, stop_words, unknowns, partial = search(query_text, mode, page_id, analyzer)
+    # "did you mean": the closest terms of the index to the unknown words, the shards have no local term dictionary
+    suggestions = suggest_terms(unknowns, INDEXES[analyzer], analyzer) if unknowns and SHARDS is None else {}
+    correction = corrected_query(query_text, suggestions, analyzer) if suggestions else ""
+    if correction == query_text:
+        correction = ""
+    correction_url = url_for("results", q=correction, mode=mode, analyzer=analyzer) if correction else ""
+    # if query inverted index did not find any results
+    if -1 in matching_ids:
+        with span("render"):
+            return render_template("results.html", er="NOTHING FOUND: Make your query more informative!",
+                                   query_text=query_text, matches=[], more_content="false", page_id=page_id,
+                                   num_matches=0, stopwords=stop_words, unknown=unknowns, mode=mode,
+                                   analyzer=analyzer, analyzers=list(INDEXES), partial=partial,
+                                   correction=correction, correction_url=correction_url)
+
+    more_content = len(matching_ids) > page_id * PAGE_SIZE  # check if next page will be needed
+    matches = page_matches(matching_ids, page_id, query_text)
+    # the total number of matches is unknown in ranked mode, only the top documents are computed
+    with span("render"):
+        return render_template("results.html", er="", query_text=query_text, matches=matches,
+                               more_content="true" if more_content else "false",
+                               url=url_for("results", q=query_text, page=page_id + 1, mode=mode, analyzer=analyzer),
+                               page_id=page_id, num_matches=len(matching_ids) if mode != "ranked" else None,
+                               stopwords=stop_words, unknown=unknowns, mode=mode, analyzer=analyzer,
+                               analyzers=list(INDEXES), partial=partial, correction=correction,
+                               correction_url=correction_url)
+
+
+@app.before_request
+def start_request_trace():
+    # every request is traced, the stages recorded while it is served are added to its trace
+    g.trace = start_trace(f"request.{request.endpoint}", path=request.full_path, query=request.values.get("q"),
+                          mode=request.values.get("mode"), analyzer=request.values.get("analyzer"))
+
+
+@app.teardown_request
+def finish_request_trace(exc):
+    trace = g.pop("trace", None)
+    if trace is not None:
+        finish_trace(trace)
+
+
+# stage latency histograms, in the prometheus text format
+@app.route("/metrics")
+def metrics():
+    return Response(metrics_text(), mimetype="text/plain; version=0.0.4")
 
 
 # home page
 @app.route("/")
 def home():
-    return render_template("home.html")
+    return render_template("home.html", analyzer=DEFAULT_ANALYZER, analyzers=list(INDEXES))
 
 
 # result page
 @app.route("/results", methods=["GET", "POST"])
 def results():
     # TODO:
-    # clear past search info
-    MATCHES.clear()
-    SW.clear()
-    UNKNOWNS.clear()
-    QUERY.clear()
-
-    query_text = request.form["query"]
-    QUERY.append(query_text)
-    result = query_inverted_index(query_text)
-
-    matching_ids = result[0]
-    SW.append(result[1])
-    UNKNOWNS.append(result[2])
-
-    # if query inverted index did not find any results
-    if -1 in result[0]:
-        return render_template("results.html", er="NOTHING FOUND: Make your query more informative!",
-                               query_text=query_text, matches=MATCHES[:8], more_content="false",
-                               url="results/", page_id=1, num_matches=len(MATCHES), stopwords=SW, unknown=UNKNOWNS)
-
-    for doc_id in matching_ids:
-        match = query_doc(doc_id)
-        MATCHES.append([match['id'], match['title'], match['content_str'][:150]])
-
-    if len(MATCHES) > 8:  # check if next page will be needed
-        return render_template("results.html", er="", query_text=query_text, matches=MATCHES[:8], more_content="true",
-                               url="results/2", page_id=1, num_matches=len(MATCHES), stopwords=SW, unknown=UNKNOWNS)
-    else:
-        return render_template("results.html", er="", query_text=query_text, matches=MATCHES, more_content="false",
-                               page_id=2, num_matches=len(MATCHES), stopwords=SW, unknown=UNKNOWNS)
+    # the search form posts "query", result links carry the query and the page as url parameters
+    query_text = request.values.get("q", request.values.get("query", ""))
+    page_id = max(request.args.get("page", 1, type=int), 1)
+    return render_results(query_text, page_id, request.values.get("mode", "boolean"),
+                          request.values.get("analyzer", DEFAULT_ANALYZER))
 
 
 # "next page" to show more results
 @app.route("/results/<int:page_id>", methods=["GET", "POST"])
 def next_page(page_id):
     # TODO:
-    if len(MATCHES) <= page_id * 8:
-        return render_template("results.html", query_text=QUERY[0], matches=MATCHES[(page_id - 1) * 8:page_id * 8],
-                               page_id=page_id + 1, more_content="false", num_matches=len(MATCHES),
-                               stopwords=SW, unknown=UNKNOWNS)
-    else:
-        nextp = page_id + 1
-        return render_template("results.html", query_text=QUERY[0], matches=MATCHES[(page_id - 1) * 8:page_id * 8],
-                               page_id=page_id, more_content="true", url=f'{nextp}', num_matches=len(MATCHES),
-                               stopwords=SW, unknown=UNKNOWNS)
+    return render_results(request.values.get("q", ""), max(page_id, 1), request.values.get("mode", "boolean"),
+                          request.values.get("analyzer", DEFAULT_ANALYZER))
+
+
+# hit rates of the result cache and of the postings caches, and the fetch time the postings caches saved
+@app.route("/cache_stats")
+def cache_stats():
+    return jsonify({"results": RESULT_CACHE.stats(),
+                    "postings": {name: POSTINGS_CACHES[name].stats() for name, index in INDEXES.items()
+                                 if index is None}})
 
 
 # document page
@@ -82,7 +277,8 @@ def next_page(page_id):
 def doc_data(doc_id):
     # TODO:
     # get info to display on doc page
-    doc = query_doc(doc_id)
+    with span("query_doc"):
+        doc = query_doc(doc_id)
     title = doc['title']
     author = doc['author']
     date = doc['published_date']
@@ -94,9 +290,76 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Boolean IR system")
     parser.add_argument("--build", action="store_true")
     parser.add_argument("--run", action="store_true")
+    parser.add_argument("--ingest", action="store_true",
+                        help="insert the documents into mongo, resuming an interrupted ingestion")
+    parser.add_argument("--batch-size", type=int, default=1000, help="documents per insert batch")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="build the index on a pool of worker processes (0: serial build)")
+    parser.add_argument("--index-file", type=str, default=None,
+                        help="build/query a memory-mapped postings file instead of the mongo index")
+    parser.add_argument("--segments", type=str, default=None,
+                        help="directory of an incrementally updated index, see --append and --delete")
+    parser.add_argument("--append", type=str, default=None,
+                        help="insert the documents of a .jl file and add them to the --segments index")
+    parser.add_argument("--delete", type=int, nargs="+", default=[],
+                        help="ids of documents to remove from the --segments index")
+    parser.add_argument("--snippet-store", type=str, default=None,
+                        help="write the snippet store of the documents already ingested, see BRS_SNIPPET_STORE")
+    parser.add_argument("--shards", type=int, default=0,
+                        help="with --build, split the index into this many doc id ranges, see sharding")
+    parser.add_argument("--shard-dir", type=str, default="shards", help="directory of the --shards indexes")
+    parser.add_argument("--analyzers", nargs="+", default=[DEFAULT_ANALYZER], choices=list(ANALYZERS),
+                        help="analyzers to build an index with, the documents are only read once")
+    parser.add_argument("--analyzer-snapshot", type=str, default=None,
+                        help="write the analyzers, warmed up with the titles of the corpus and BRS_QUERY_LOG, to this "
+                             "file for a fast startup, see BRS_ANALYZER_SNAPSHOT")
     args = parser.parse_args()
 
-    if args.build:
-        build_inverted_index(load_wapo(wapo_path))
+    if args.ingest:
+        insert_docs(load_wapo(wapo_path, start=resume_id(args.batch_size)), batch_size=args.batch_size)
+    elif (args.build or args.run) and not has_docs():
+        # if wapo_docs collection is not existed, create a new one and insert docs into it
+        insert_docs(load_wapo(wapo_path))
+    if args.analyzer_snapshot:
+        titles = (doc['title'] or "" for doc in load_wapo(wapo_path))
+        warm_up_analyzers(ANALYZERS.values(), titles)
+        if os.environ.get("BRS_QUERY_LOG"):
+            warm_up_analyzers(ANALYZERS.values(), query_log)
+        save_snapshot(ANALYZERS, args.analyzer_snapshot)
+    if args.snippet_store:
+        with SnippetStoreWriter(args.snippet_store, ANALYZERS[DEFAULT_ANALYZER]) as writer:
+            for doc in load_wapo(wapo_path):
+                writer.add(doc)
+    if args.build and args.shards:
+        with open(wapo_path, "rb") as f:
+            num_docs = sum(1 for _ in f)
+        build_shards(load_wapo(wapo_path), args.shard_dir, num_docs, args.shards, workers=args.workers or None,
+                     analyzers=args.analyzers)
+    elif args.build:
+        if args.workers or args.index_file:
+            build_inverted_index_parallel(load_wapo(wapo_path), workers=args.workers or None,
+                                          index_file=args.index_file, analyzers=args.analyzers)
+        else:
+            build_inverted_index(load_wapo(wapo_path), analyzers=args.analyzers)
+    if args.segments:
+        INDEXES = {name: SegmentedIndex(analyzer_index_path(args.segments, name), analyzer=ANALYZERS[name])
+                   for name in args.analyzers}
+        new_docs = list(load_wapo(args.append, id_offset=next_doc_id())) if args.append else []
+        if new_docs:
+            insert_docs(new_docs, batch_size=args.batch_size)
+        for name, index in INDEXES.items():
+            if args.build and args.index_file:
+                # the full build is the first segment of the index
+                index.add_segment(analyzer_index_path(args.index_file, name))
+            if new_docs:
+                index.add_documents(new_docs)
+            if args.delete:
+                index.delete_documents(args.delete)
+            index.maybe_merge(background=args.run)
     if args.run:
+        if args.index_file and not args.segments:
+            INDEXES = {name: PostingsFile(analyzer_index_path(args.index_file, name)) for name in args.analyzers}
+        elif args.build and not args.segments:
+            # the analyzers built above are offered as well
+            INDEXES = open_indexes()
         app.run(debug=True, port=5000)
@@ -1,100 +1,837 @@
-from collections import defaultdict
-from functools import reduce
-from typing import Union, List, Tuple, Iterable
-
-from nltk import word_tokenize
+import heapq
+import os
+import tempfile
+import time
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from functools import partial, reduce
+from typing import Union, List, Tuple, Iterable, Optional, Dict
 
 from utils import timer, load_wapo, cleanhtml, CLEANR
 from text_processing import TextProcessing
 from customized_text_processing import CustomizedTextProcessing
-from mongo_db import insert_db_index, query_db_index
+from mongo_db import insert_db_index, query_db_index_many, insert_doc_stats, query_doc_stats, bump_index_generation, \
+    query_index_generation, drop_collection, rename_collection
+from spimi import build_runs, compact_runs, merge_runs
+from postings_file import write_postings_file
+from query_parser import parse_query, Term, Phrase, Wildcard, And, Or, Not, combine
+from ranking import DocLengths, bm25_top_k, doc_lengths_path
+from postings_cache import PostingsCache
+from bitmap_postings import Bitmap, Postings, term_postings, and_postings, or_postings, andnot_postings, to_list, \
+    doc_count
+from tracing import span
+from analyzer_snapshot import ANALYZER_SNAPSHOT, load_snapshot
+from term_dictionary import MAX_EXPANSIONS, TermDictionary, is_wildcard, most_frequent_forms, terms_path
+
+# the analyzers are restored from the BRS_ANALYZER_SNAPSHOT file when there is one, nltk is then not loaded at import
+_snapshot = load_snapshot(ANALYZER_SNAPSHOT) if ANALYZER_SNAPSHOT and os.path.exists(ANALYZER_SNAPSHOT) else {}
 
-text_processor = TextProcessing.from_nltk()
+text_processor = _snapshot['nltk'] if 'nltk' in _snapshot else TextProcessing.from_nltk()
 
-custom = CustomizedTextProcessing.from_customized()
+custom = _snapshot['custom'] if 'custom' in _snapshot else CustomizedTextProcessing.from_customized()
 # include your customized text processing class
 
+# analyzers the index can be built and queried with, by name (see spimi.ANALYZER_FACTORIES). each analyzer has its
+# own index store
+ANALYZERS = {"nltk": text_processor, "custom": custom}
+DEFAULT_ANALYZER = "nltk"
+
+
+def index_collection(analyzer: str = DEFAULT_ANALYZER) -> str:
+    """
+    mongo collection of the index built with the analyzer: "inverted_index", "inverted_index_custom", ...
+    :param analyzer:
+    :return:
+    """
+    return "inverted_index" if analyzer == DEFAULT_ANALYZER else f"inverted_index_{analyzer}"
+
+
+def stats_collection(analyzer: str = DEFAULT_ANALYZER) -> str:
+    return "doc_stats" if analyzer == DEFAULT_ANALYZER else f"doc_stats_{analyzer}"
+
+
+def analyzer_index_path(path: str, analyzer: str = DEFAULT_ANALYZER) -> str:
+    """
+    path of the postings file (or segments directory) of the index built with the analyzer, next to the one of the
+    default analyzer: index.idx, index.idx.custom, ...
+    :param path: path of the default analyzer's index
+    :param analyzer:
+    :return:
+    """
+    return str(path) if analyzer == DEFAULT_ANALYZER else f"{path}.{analyzer}"
+
+
+# directory of the term dictionaries of the mongo indexes, written by the builds (see mongo_terms_path)
+TERMS_DIR = os.environ.get("BRS_TERMS_DIR", ".")
+
+
+def mongo_terms_path(analyzer: str = DEFAULT_ANALYZER) -> str:
+    """
+    the terms of a mongo collection can't be listed without a scan, so the builds also write them to a terms file:
+    inverted_index.terms, inverted_index_custom.terms, ...
+    :param analyzer:
+    :return:
+    """
+    return os.path.join(TERMS_DIR, f"{index_collection(analyzer)}.terms")
+
+
+# query-side cache of the term dictionary and the posting lists of each mongo collection
+POSTINGS_CACHES = {name: PostingsCache(partial(query_db_index_many, collection=index_collection(name)))
+                   for name in ANALYZERS}
+# every build of a mongo index stores a new generation of it (see mongo_db.bump_index_generation). the processes
+# serving queries read it at most every BRS_INDEX_CHECK_INTERVAL seconds and drop what they cached of an older build:
+# the posting lists, doc lengths and term dictionary
+INDEX_CHECK_INTERVAL = float(os.environ.get("BRS_INDEX_CHECK_INTERVAL", 5.0))
+# analyzer -> (generation, time.monotonic() time it was read)
+_generations = {}
+
+
+def set_index_generation(analyzer: str, generation: Optional[str]) -> None:
+    """
+    record the current generation of the mongo index of the analyzer, the cached entries of other generations are
+    dropped
+    :param analyzer:
+    :param generation:
+    :return:
+    """
+    _generations[analyzer] = (generation, time.monotonic())
+    POSTINGS_CACHES[analyzer].set_generation(generation)
+
+
+def index_check_due(analyzer: str) -> bool:
+    """
+    whether the generation of the mongo index of the analyzer should be read again
+    :param analyzer:
+    :return:
+    """
+    checked_t = _generations.get(analyzer, (None, None))[1]
+    return checked_t is None or time.monotonic() - checked_t >= INDEX_CHECK_INTERVAL
+
+
+def index_generation(analyzer: str = DEFAULT_ANALYZER) -> Optional[str]:
+    """
+    :param analyzer:
+    :return: the generation of the mongo index of the analyzer read by the last check, None before the first one
+    """
+    return _generations.get(analyzer, (None, None))[0]
+
+
+def check_index_generation(analyzer: str = DEFAULT_ANALYZER) -> Optional[str]:
+    """
+    the generation of the mongo index of the analyzer, read from the storage when the last check is older than
+    INDEX_CHECK_INTERVAL
+    :param analyzer:
+    :return:
+    """
+    if index_check_due(analyzer):
+        set_index_generation(analyzer, query_index_generation(collection=index_collection(analyzer)))
+    return index_generation(analyzer)
+
+
+def _build_collections(analyzer: str) -> List[Tuple[str, str]]:
+    # a build writes the collections of an index under temporary names and swaps them in once complete, the queries
+    # use the previous build in the meantime
+    return [(collection + "_build", collection) for collection in (index_collection(analyzer),
+                                                                    stats_collection(analyzer))]
+
+
+def _start_build(analyzer: str) -> Tuple[str, str]:
+    """
+    :param analyzer:
+    :return: the collections to write the posting lists and the doc lengths of the new build to
+    """
+    for building, _ in _build_collections(analyzer):
+        # the leftovers of an interrupted build
+        drop_collection(building)
+    (index_building, _), (stats_building, _) = _build_collections(analyzer)
+    return index_building, stats_building
+
+
+def _finish_build(analyzer: str, dictionary: TermDictionary) -> None:
+    """
+    swap the collections written since _start_build in, with the terms file of the new build, and store a new
+    generation of the index so that the processes serving queries drop what they cached of the previous one
+    :param analyzer:
+    :param dictionary: terms of the new build
+    :return:
+    """
+    for building, collection in _build_collections(analyzer):
+        rename_collection(building, collection)
+    path = mongo_terms_path(analyzer)
+    dictionary.save(path + ".tmp")
+    os.replace(path + ".tmp", path)
+    set_index_generation(analyzer, bump_index_generation(collection=index_collection(analyzer)))
+
 
 @timer
-def build_inverted_index(wapo_docs: Iterable) -> None:
+def build_inverted_index(wapo_docs: Iterable, analyzers: Iterable[str] = (DEFAULT_ANALYZER,)) -> None:
     """
     load wapo_pa3.jl to build the inverted index and insert the index by using mongo_db.insert_db_index method
     :param wapo_docs:
+    :param analyzers: keys of ANALYZERS, the documents are read once and the index of each analyzer is inserted
+        into its own collection (see index_collection)
     :return:
     """
     # TODO:
-    index_list = []
-    prev_tokens = set()
-    tok_doc_dict = defaultdict()
+    analyzers = list(analyzers)
+    tok_doc_dicts = {name: defaultdict(list) for name in analyzers}
+    doc_lengths = {name: {} for name in analyzers}
+    form_counts = {name: Counter() for name in analyzers}
 
-    # get all tokens mapped to their respective postings list
+    # get all tokens mapped to their respective postings list, with the positions of the token in each doc
 
     for doc in wapo_docs:
-        normalized_doc = text_processor.get_normalized_tokens(doc['title'], doc['content_str'])
-        for token in normalized_doc:
-            if token not in prev_tokens:
-                tok_doc_dict[token] = [doc['id']]
-                prev_tokens.add(token)
-            else:
-                tok_doc_dict[token].append(doc['id'])
+        for name in analyzers:
+            normalized_doc = ANALYZERS[name].get_normalized_positions(doc['title'], doc['content_str'],
+                                                                      form_counts[name])
+            doc_lengths[name][doc['id']] = sum(len(positions) for positions in normalized_doc.values())
+            for token, positions in normalized_doc.items():
+                tok_doc_dicts[name][token].append((doc['id'], positions))
 
     # convert dict of tokens and posting lists to correct format
-    for tok, doc in tok_doc_dict.items():
-        set_doc = set(doc)
-        index_list.append({'token': tok, 'doc_ids': sorted(list(set_doc))})
+    for name in analyzers:
+        index_list = []
+        for tok, doc in tok_doc_dicts[name].items():
+            doc.sort()
+            index_list.append({'token': tok, 'doc_ids': [d[0] for d in doc], 'positions': [d[1] for d in doc]})
+
+        index_building, stats_building = _start_build(name)
+        with span("build.insert"):
+            insert_db_index(sorted(index_list, key=lambda i: len(i['doc_ids'])), collection=index_building)
+            insert_doc_stats(doc_lengths[name], collection=stats_building)
+        terms = sorted(tok_doc_dicts[name])
+        forms = most_frequent_forms(form_counts[name])
+        _finish_build(name, TermDictionary(terms, [len(tok_doc_dicts[name][term]) for term in terms],
+                                           [forms.get(term, "") for term in terms]))
+
+
+@timer
+def build_inverted_index_parallel(wapo_docs: Iterable, workers: Optional[int] = None, chunk_size: int = 1000,
+                                  max_postings: int = 2000000, fan_in: int = 64, batch_size: int = 10000,
+                                  index_file: Optional[str] = None,
+                                  analyzers: Iterable[str] = (DEFAULT_ANALYZER,)) -> None:
+    """
+    parallel, sharded version of build_inverted_index
+    - the documents are split into chunks that are tokenized on a pool of worker processes, once per analyzer
+    - every worker writes sorted partial positional postings runs to a temporary directory, holding at most
+      max_postings token positions in memory
+    - the runs are k-way merged and the final posting lists are inserted by batches of batch_size tokens, or written
+      to a compressed postings file when index_file is given
+    - the number of indexed tokens of each doc is stored for the ranked retrieval mode
+    - the terms are written to a terms file along with their most frequent surface form (see mongo_terms_path and
+      term_dictionary.terms_path). the collections of a mongo index are replaced once the build is complete
+    :param wapo_docs: WAPO docs iterator (utils.load_wapo(...))
+    :param workers: number of worker processes, defaults to the number of cpus
+    :param chunk_size:
+    :param max_postings:
+    :param fan_in: maximum number of runs merged at once
+    :param batch_size:
+    :param index_file: path of a postings file to write instead of the mongo "inverted_index" collection, the
+        other analyzers' files are written next to it (see analyzer_index_path)
+    :param analyzers: keys of ANALYZERS
+    :return:
+    """
+    with tempfile.TemporaryDirectory(prefix="spimi_") as run_dir:
+        with span("build.invert"):
+            analyzer_runs = build_runs(wapo_docs, run_dir, workers=workers, chunk_size=chunk_size,
+                                       max_postings=max_postings, analyzers=analyzers)
+        for name, (runs, doc_lengths, form_counts) in analyzer_runs.items():
+            forms = most_frequent_forms(form_counts)
+            with span("build.compact"):
+                runs = compact_runs(runs, run_dir, fan_in)
+            if index_file is not None:
+                path = analyzer_index_path(index_file, name)
+                terms = []
+                dfs = []
+
+                def merged_postings():
+                    for tok, doc_ids, positions in merge_runs(runs):
+                        terms.append(tok)
+                        dfs.append(len(doc_ids))
+                        yield tok, doc_ids, positions
+
+                with span("build.merge"):
+                    write_postings_file(path, merged_postings())
+                lengths = DocLengths()
+                lengths.update(doc_lengths)
+                lengths.save(doc_lengths_path(path))
+                TermDictionary(terms, dfs, [forms.get(term, "") for term in terms]).save(terms_path(path))
+                continue
+            index_building, stats_building = _start_build(name)
+            with span("build.insert"):
+                insert_doc_stats(doc_lengths, collection=stats_building)
+            batch = []
+            terms = []
+            dfs = []
+            # the merge time is the build.merge time minus the build.insert time
+            with span("build.merge"):
+                for tok, doc_ids, positions in merge_runs(runs):
+                    batch.append({'token': tok, 'doc_ids': doc_ids, 'positions': positions})
+                    terms.append(tok)
+                    dfs.append(len(doc_ids))
+                    if len(batch) >= batch_size:
+                        with span("build.insert"):
+                            insert_db_index(batch, collection=index_building)
+                        batch = []
+                if batch:
+                    with span("build.insert"):
+                        insert_db_index(batch, collection=index_building)
+            _finish_build(name, TermDictionary(terms, dfs, [forms.get(term, "") for term in terms]))
+
+
+# galloping only pays off when the longer list is this many times longer than the shorter one
+GALLOP_RATIO = 16
+
+
+def gallop(postings: List[int], target: int, lo: int = 0) -> int:
+    """
+    galloping (exponential) search: index of the first element >= target in postings[lo:]
+    the probe step doubles until it overshoots the target, then the bracketed range is binary searched
+    :param postings: ascending doc ids
+    :param target:
+    :param lo: position to start searching from
+    :return:
+    """
+    n = len(postings)
+    step = 1
+    hi = lo
+    while hi < n and postings[hi] < target:
+        lo = hi + 1
+        hi += step
+        step <<= 1
+    return bisect_left(postings, target, lo, min(hi, n))
 
-    insert_db_index(sorted(index_list, key=lambda i: len(i['doc_ids'])))
+
+def intersect_two(short: List[int], long: List[int]) -> List[int]:
+    """
+    intersection of two ascending posting lists. each element of the shorter list is galloped for in the longer one,
+    unless both lists have a similar length: the galloping steps are then too short to pay off and a hash probe of
+    the longer list is cheaper
+    :param short:
+    :param long:
+    :return:
+    """
+    if len(long) < GALLOP_RATIO * len(short):
+        long_set = set(long)
+        return [doc_id for doc_id in short if doc_id in long_set]
+    result = []
+    pos = 0
+    n = len(long)
+    for doc_id in short:
+        pos = gallop(long, doc_id, pos)
+        if pos == n:
+            break
+        if long[pos] == doc_id:
+            result.append(doc_id)
+            pos += 1
+    return result
 
 
 def intersection(posting_lists: List[List[int]]) -> List[int]:
     """
     implementation of the intersection of a list of posting lists that have been ordered from the shortest to the longest
-    :param posting_lists:
-    :return:
+    the lists are intersected from the rarest term up and the candidates are galloped for in each longer list,
+    an empty list short-circuits to an empty result
+    :param posting_lists: ascending doc ids
+    :return: ascending doc ids
     """
     # TODO:
-    # use set intersection starting from shortest postings list
+    if not posting_lists:
+        return []
+    posting_lists = sorted(posting_lists, key=len)
     intersect = posting_lists[0]
+    for postings in posting_lists[1:]:
+        if not intersect:
+            break
+        intersect = intersect_two(intersect, postings)
+    return list(intersect)
 
-    for i in range(len(posting_lists)-1):
-        if len(posting_lists[i+1]) > 0:
-            intersect = list(set(intersect) & set(posting_lists[i+1]))
 
+def set_intersection(posting_lists: List[List[int]]) -> List[int]:
+    """
+    the former set based intersection, kept as a baseline for benchmarks/bench_intersection.py
+    :param posting_lists:
+    :return:
+    """
+    intersect = posting_lists[0]
+    for i in range(len(posting_lists) - 1):
+        if len(posting_lists[i + 1]) > 0:
+            intersect = list(set(intersect) & set(posting_lists[i + 1]))
     return intersect
 
 
-def query_inverted_index(query: str) -> Tuple[List[int], List[str], List[str]]:
+def intersect_postings(posting_sets: List[Postings]) -> List[int]:
+    """
+    intersection of hybrid posting lists (see bitmap_postings): from the rarest one up, two bitmaps are ANDed
+    bitwise, a list is probed into a bitmap and two lists are galloped
+    :param posting_sets: doc id lists and bitmaps
+    :return: ascending doc ids
+    """
+    posting_sets = sorted(posting_sets, key=len)
+    intersect = posting_sets[0]
+    for postings in posting_sets[1:]:
+        if not len(intersect):
+            break
+        if isinstance(intersect, list) and isinstance(postings, list):
+            intersect = intersect_two(intersect, postings)
+        else:
+            intersect = and_postings(intersect, postings)
+    return to_list(intersect)
+
+
+def filter_term(candidates: List[int], post_dict: Dict) -> List[int]:
+    """
+    the candidates in the posting list: probed into the bitmap of a dense term, galloped for otherwise
+    :param candidates: ascending doc ids
+    :param post_dict:
+    :return:
+    """
+    postings = term_postings(post_dict)
+    if isinstance(postings, Bitmap):
+        return postings.filter(candidates)
+    return intersect_two(candidates, postings)
+
+
+def _is_dense(node, postings: Dict[str, Dict]) -> bool:
+    return isinstance(node, Term) and isinstance(term_postings(postings[node.term]), Bitmap)
+
+
+def plan_cost(node, postings: Dict[str, Dict]) -> float:
+    """
+    estimated number of documents a node can match, used to order the operands of the query plan
+    :param node: query_parser node
+    :param postings: token -> posting dict as returned by query_db_index
+    :return:
+    """
+    if isinstance(node, Term):
+        return doc_count(postings[node.term])
+    if isinstance(node, Phrase):
+        return min(doc_count(postings[term]) for term, _ in node.terms_offsets)
+    if isinstance(node, And):
+        return min((plan_cost(child, postings) for child in node.children if not isinstance(child, Not)),
+                   default=float('inf'))
+    if isinstance(node, Or):
+        return sum(plan_cost(child, postings) for child in node.children)
+    # a negation can't drive the evaluation
+    return float('inf')
+
+
+def prune_unknown(node, postings: Dict[str, Dict]):
+    """
+    drop the terms (and phrases with a term) missing from the index. like the former conjunctive queries, unknown
+    words are reported to the user and ignored instead of emptying the result
+    :param node:
+    :param postings:
+    :return: pruned node, None if nothing is left
+    """
+    if isinstance(node, (Term, Phrase)):
+        return node if all(term in postings for term in node.terms()) else None
+    if isinstance(node, Not):
+        child = prune_unknown(node.child, postings)
+        return Not(child) if child is not None else None
+    children = [child for child in (prune_unknown(c, postings) for c in node.children) if child is not None]
+    return combine(type(node), children)
+
+
+def phrase_filter(node: Phrase, candidates: List[int], postings: Dict[str, Dict]) -> List[int]:
     """
-    conjunctive query over the built index by using mongo_db.query_db_index method
+    keep the candidates in which the phrase terms occur at their offsets from a common start position
+    :param node:
+    :param candidates: ascending doc ids containing all terms of the phrase
+    :param postings:
+    :return:
+    """
+    if any('positions' not in postings[term] for term, _ in node.terms_offsets):
+        # index built without positions, the phrase degrades to the AND of its terms
+        return candidates
+    # the doc ids of a dense term are rebuilt from its bitmap on every read
+    doc_ids = {term: postings[term]['doc_ids'] for term, _ in node.terms_offsets}
+    matches = []
+    for doc_id in candidates:
+        starts = None
+        for term, offset in node.terms_offsets:
+            positions = postings[term]['positions'][bisect_left(doc_ids[term], doc_id)]
+            term_starts = {pos - offset for pos in positions}
+            starts = term_starts if starts is None else starts & term_starts
+            if not starts:
+                break
+        if starts:
+            matches.append(doc_id)
+    return matches
+
+
+def filter_candidates(node, candidates: List[int], postings: Dict[str, Dict]) -> List[int]:
+    """
+    the candidates matched by node. the node is never materialized: terms are galloped for in their posting list
+    and OR branches only test the candidates that no cheaper branch matched yet
+    :param node:
+    :param candidates: ascending doc ids
+    :param postings:
+    :return: ascending doc ids
+    """
+    if not candidates:
+        return candidates
+    if isinstance(node, Term):
+        return filter_term(candidates, postings[node.term])
+    if isinstance(node, Phrase):
+        for term in node.terms():
+            candidates = filter_term(candidates, postings[term])
+        return phrase_filter(node, candidates, postings)
+    if isinstance(node, And):
+        for child in sorted(node.children, key=lambda c: plan_cost(c, postings)):
+            candidates = filter_candidates(child, candidates, postings)
+            if not candidates:
+                break
+        return candidates
+    if isinstance(node, Or):
+        matched = []
+        remaining = candidates
+        # the most frequent branches are tested first since they remove the most candidates
+        for child in sorted(node.children, key=lambda c: plan_cost(c, postings), reverse=True):
+            hits = filter_candidates(child, remaining, postings)
+            if hits:
+                matched.append(hits)
+                hit_set = set(hits)
+                remaining = [doc_id for doc_id in remaining if doc_id not in hit_set]
+                if not remaining:
+                    break
+        return list(heapq.merge(*matched))
+    if _is_dense(node.child, postings):
+        return term_postings(postings[node.child.term]).exclude(candidates)
+    excluded = set(filter_candidates(node.child, candidates, postings))
+    return [doc_id for doc_id in candidates if doc_id not in excluded]
+
+
+def evaluate(node, postings: Dict[str, Dict]) -> List[int]:
+    """
+    cost based evaluation of a query tree: an AND materializes only its cheapest operand and filters the candidates
+    through the others by increasing cost, negations last. an OR is only materialized at the top of the plan or
+    when it is the cheapest operand of an AND
+    :param node:
+    :param postings:
+    :return: ascending doc ids
+    """
+    if isinstance(node, Term):
+        return postings[node.term]['doc_ids']
+    if isinstance(node, Phrase):
+        candidates = intersect_postings([term_postings(postings[term]) for term in node.terms()])
+        return phrase_filter(node, candidates, postings)
+    if isinstance(node, And):
+        children = sorted(node.children, key=lambda c: plan_cost(c, postings))
+        if isinstance(children[0], Not):
+            # pure negations would have to be evaluated against every document
+            return []
+        if _is_dense(children[0], postings):
+            # even the rarest operand is a dense term: the dense terms are ANDed and the negated dense terms removed
+            # as bitmaps, before the other operands filter the result
+            dense = [child for child in children if _is_dense(child, postings)]
+            negated = [child for child in children if isinstance(child, Not) and _is_dense(child.child, postings)]
+            result = reduce(and_postings, [term_postings(postings[child.term]) for child in dense])
+            for child in negated:
+                result = andnot_postings(result, term_postings(postings[child.child.term]))
+            candidates = to_list(result)
+            rest = [child for child in children if not any(child is other for other in dense + negated)]
+        else:
+            candidates = evaluate(children[0], postings)
+            rest = children[1:]
+        for child in rest:
+            candidates = filter_candidates(child, candidates, postings)
+            if not candidates:
+                break
+        return candidates
+    if isinstance(node, Or):
+        # the lists are merged, unless a dense term makes the union a bitmap OR
+        results = [term_postings(postings[child.term]) if isinstance(child, Term) else evaluate(child, postings)
+                   for child in node.children]
+        return to_list(or_postings(results))
+    return []
+
+
+def phrase_terms(node) -> set:
+    """
+    the terms of the phrases of the query, the only ones whose positions are needed
+    :param node:
+    :return:
+    """
+    if isinstance(node, Phrase):
+        return node.terms()
+    if isinstance(node, Not):
+        return phrase_terms(node.child)
+    if isinstance(node, (And, Or)):
+        return set().union(*(phrase_terms(child) for child in node.children))
+    return set()
+
+
+def stopwords_in_query(query: str, analyzer: str = DEFAULT_ANALYZER) -> List[str]:
+    """
+    the words of the query that are ignored as stop words
+    :param query:
+    :param analyzer: key of ANALYZERS
+    :return:
+    """
+    processor = ANALYZERS[analyzer]
+    return [token for token in processor.tokenizer.tokenize(query) if token in processor.STOP_WORDS]
+
+
+def query_key(query: str, analyzer: str = DEFAULT_ANALYZER) -> str:
+    """
+    normalized form of the query: two queries with the same key match the same documents of an index
+    :param query:
+    :param analyzer: key of ANALYZERS
+    :return:
+    """
+    return str(parse_query(query, ANALYZERS[analyzer]))
+
+
+def positive_terms(node) -> set:
+    """
+    the terms of the query that are not negated
+    :param node:
+    :return:
+    """
+    if isinstance(node, Not) or node is None:
+        return set()
+    if isinstance(node, (And, Or)):
+        return set().union(*(positive_terms(child) for child in node.children))
+    return node.terms()
+
+
+# (generation, lengths of the docs) indexed in mongo by analyzer, loaded on the first ranked query of a generation
+_mongo_doc_lengths = {}
+
+
+def get_doc_lengths(index=None, analyzer: str = DEFAULT_ANALYZER) -> DocLengths:
+    """
+    the doc lengths of an index backend (see query_inverted_index), from the "doc_stats" collection for mongo
+    :param index:
+    :param analyzer: key of ANALYZERS, selects the mongo collection
+    :return:
+    """
+    if index is not None:
+        return index.doc_lengths or DocLengths()
+    generation = check_index_generation(analyzer)
+    cached = _mongo_doc_lengths.get(analyzer)
+    if cached is None or cached[0] != generation:
+        doc_lengths = DocLengths()
+        doc_lengths.update(query_doc_stats(collection=stats_collection(analyzer)))
+        cached = _mongo_doc_lengths[analyzer] = (generation, doc_lengths)
+    return cached[1]
+
+
+# (generation, term dictionary) of the mongo indexes by analyzer, loaded on the first wildcard or spelling lookup of
+# a generation
+_mongo_term_dictionaries = {}
+
+
+def get_term_dictionary(index=None, analyzer: str = DEFAULT_ANALYZER) -> TermDictionary:
+    """
+    the term dictionary of an index backend (see query_inverted_index), from the terms file of the collection for
+    mongo, empty if the index was built without one
+    :param index:
+    :param analyzer: key of ANALYZERS, selects the mongo collection
+    :return:
+    """
+    if index is not None:
+        return index.term_dictionary()
+    generation = check_index_generation(analyzer)
+    cached = _mongo_term_dictionaries.get(analyzer)
+    if cached is None or cached[0] != generation:
+        path = mongo_terms_path(analyzer)
+        cached = _mongo_term_dictionaries[analyzer] = \
+            (generation, TermDictionary.load(path) if os.path.exists(path) else TermDictionary())
+    return cached[1]
+
+
+def wildcard_patterns(node) -> set:
+    if isinstance(node, Wildcard):
+        return {node.pattern}
+    if isinstance(node, Not):
+        return wildcard_patterns(node.child)
+    if isinstance(node, (And, Or)):
+        return set().union(*(wildcard_patterns(child) for child in node.children))
+    return set()
+
+
+def wildcard_expansions(node, index=None, analyzer: str = DEFAULT_ANALYZER,
+                        limit: int = MAX_EXPANSIONS) -> Dict[str, List[str]]:
+    """
+    look up the wildcards of the query in the term dictionary of the index, the dictionary is only loaded when the
+    query has a wildcard
+    :param node:
+    :param index:
+    :param analyzer:
+    :param limit: most terms a wildcard expands to, the most frequent ones
+    :return: pattern -> matching terms
+    """
+    patterns = wildcard_patterns(node)
+    if not patterns:
+        return {}
+    dictionary = get_term_dictionary(index, analyzer)
+    with span("expand"):
+        return {pattern: dictionary.expand(pattern, limit) for pattern in sorted(patterns)}
+
+
+def expand_wildcards(node, expansions: Dict[str, List[str]]):
+    """
+    replace the wildcards of the query with the OR of the terms they expand to, which are then fetched and
+    intersected like the other terms. a wildcard without terms is dropped like an unknown word
+    :param node:
+    :param expansions: pattern -> terms, see wildcard_expansions
+    :return: expanded node, None if nothing is left
+    """
+    if isinstance(node, Wildcard):
+        return combine(Or, [Term(term) for term in expansions.get(node.pattern, [])])
+    if isinstance(node, Not):
+        child = expand_wildcards(node.child, expansions)
+        return Not(child) if child is not None else None
+    if isinstance(node, (And, Or)):
+        children = [child for child in (expand_wildcards(c, expansions) for c in node.children) if child is not None]
+        return combine(type(node), children)
+    return node
+
+
+def suggest_terms(words: Iterable[str], index=None, analyzer: str = DEFAULT_ANALYZER,
+                  limit: int = 3) -> Dict[str, List[str]]:
+    """
+    spelling suggestions for the unknown words of a query, from the term dictionary of the index
+    :param words: normalized terms missing from the index, the wildcards among them are skipped
+    :param index:
+    :param analyzer:
+    :param limit: number of suggestions per word
+    :return: word -> closest terms of the index, the words without suggestion are left out
+    """
+    words = [word for word in words if not is_wildcard(word)]
+    if not words:
+        return {}
+    dictionary = get_term_dictionary(index, analyzer)
+    suggestions = {}
+    with span("suggest"):
+        for word in words:
+            terms = dictionary.suggest(word, limit=limit)
+            if terms:
+                suggestions[word] = terms
+    return suggestions
+
+
+def fetch_postings(terms: Iterable[str], index=None, analyzer: str = DEFAULT_ANALYZER,
+                   positions: Iterable[str] = ()) -> Dict[str, Dict]:
+    """
+    the posting lists of the terms in an index backend (see query_inverted_index). mongo is queried through the
+    postings cache of the analyzer: the terms that are not cached cost one $in query for those whose positions are
+    needed and one for the others
+    :param terms:
+    :param index:
+    :param analyzer:
+    :param positions: the terms whose positions are needed
+    :return: term -> posting dict, the unknown terms are left out
+    """
+    terms = list(terms)
+    positions = set(positions)
+    with span("fetch_postings"):
+        if index is None:
+            check_index_generation(analyzer)
+            cache = POSTINGS_CACHES[analyzer]
+            postings = cache.query_many([term for term in terms if term not in positions], positions=False)
+            postings.update(cache.query_many([term for term in terms if term in positions], positions=True))
+            return postings
+        postings = {}
+        for term in terms:
+            post_dict = index.query(term, positions=term in positions)
+            if post_dict:
+                postings[term] = post_dict
+        return postings
+
+
+def warm_up(queries: Iterable[str], analyzer: str = DEFAULT_ANALYZER, max_terms: int = 10000,
+            batch_size: int = 1000) -> int:
+    """
+    load the posting lists of the terms that are the most frequent in past queries into the postings cache of the
+    analyzer, e.g. at startup from a query log
+    :param queries: one query per item, e.g. the lines of a query log file
+    :param analyzer:
+    :param max_terms: number of terms to load
+    :param batch_size: number of terms fetched per $in query
+    :return: number of terms looked up
+    """
+    counts = Counter()
+    for query in queries:
+        node = parse_query(query.strip(), ANALYZERS[analyzer])
+        if node is not None:
+            counts.update(node.terms())
+    terms = [term for term, _ in counts.most_common(max_terms)]
+    check_index_generation(analyzer)
+    for i in range(0, len(terms), batch_size):
+        POSTINGS_CACHES[analyzer].query_many(terms[i:i + batch_size], positions=True)
+    return len(terms)
+
+
+def rank_inverted_index(query: str, k: int, index=None,
+                        analyzer: str = DEFAULT_ANALYZER) -> Tuple[List[Tuple[int, float]], List[str], List[str]]:
+    """
+    ranked retrieval: the top k documents by BM25 score over the (not negated) terms of the query, any document with
+    at least one of the terms can match
+    return a list of (doc id, score) pairs, a list of stop words and a list of unknown words separately
+    :param query: user input query
+    :param k: number of documents to return
+    :param index: see query_inverted_index
+    :param analyzer: see query_inverted_index
+    :return:
+    """
+    with span("parse"):
+        sw_in_query = stopwords_in_query(query, analyzer)
+        node = parse_query(query, ANALYZERS[analyzer])
+    if hasattr(index, 'snapshot'):
+        index = index.snapshot()
+    expansions = wildcard_expansions(node, index, analyzer)
+    terms = sorted(positive_terms(expand_wildcards(node, expansions)))
+    postings = fetch_postings(terms, index, analyzer, positions=terms)
+    unknown_words = [pattern for pattern, expanded in expansions.items() if not expanded]
+    unknown_words += [token for token in terms if token not in postings]
+    doc_lengths = get_doc_lengths(index, analyzer)
+    with span("rank"):
+        return bm25_top_k(postings, doc_lengths, k), sw_in_query, unknown_words
+
+
+def query_inverted_index(query: str, index=None,
+                         analyzer: str = DEFAULT_ANALYZER) -> Tuple[List[int], List[str], List[str]]:
+    """
+    boolean query over the built index by using mongo_db.query_db_index_many method behind the postings cache (see
+    fetch_postings), see query_parser for the syntax.
+    adjacent words are ANDed, so a plain query is still a conjunctive query. a wildcard (e.g. "elect*") is the OR of
+    the most frequent matching terms of the index (see wildcard_expansions), a wildcard matching nothing is unknown
     return a list of matched document ids, a list of stop words and a list of unknown words separately
     :param query: user input query
+    :param index: index to query instead of mongo: a memory-mapped postings_file.PostingsFile or a
+        segments.SegmentedIndex, whose terms are all looked up in the same snapshot. it has to be built with the
+        analyzer
+    :param analyzer: key of ANALYZERS used to normalize the query, and to pick the mongo collection
     :return:
     """
     # TODO:
-    matched_doc_ids = []
-    sw_in_query = []
     unknown_words = []
     # check if word is a stopword
-    for token in word_tokenize(query):
-        if token in text_processor.STOP_WORDS:
-            sw_in_query.append(token)
-    # normalize query
-    for token in text_processor.get_normalized_tokens('', query):
-        result = query_db_index(token)
-        if result:
-            post_dict = query_db_index(token)
-            post_list = post_dict['doc_ids']
-            matched_doc_ids.append(post_list)
-
-        else:   # if token can't be queried
-            unknown_words.append(token)
-    if matched_doc_ids:
-        # intersect postings lists
-        intersected_ids = intersection(matched_doc_ids)
-
-        # if postings exist but too specific of a search
-        if len(intersected_ids) == 0:
-            intersected_ids = [-1]
-    else:
+    with span("parse"):
+        sw_in_query = stopwords_in_query(query, analyzer)
+        node = parse_query(query, ANALYZERS[analyzer])
+    if hasattr(index, 'snapshot'):
+        index = index.snapshot()
+    # the wildcards become ORs of the terms of the index they match
+    expansions = wildcard_expansions(node, index, analyzer)
+    node = expand_wildcards(node, expansions)
+    unknown_words = [pattern for pattern, expanded in expansions.items() if not expanded]
+    if node is None:
+        return [-1], sw_in_query, unknown_words
+
+    # fetch the posting lists of all terms, positions are only needed for the phrases
+    terms = sorted(node.terms())
+    postings = fetch_postings(terms, index, analyzer, positions=phrase_terms(node))
+    # if token can't be queried
+    unknown_words += [token for token in terms if token not in postings]
+
+    with span("evaluate"):
+        node = prune_unknown(node, postings)
+        intersected_ids = evaluate(node, postings) if node is not None else []
+    # if postings exist but too specific of a search
+    if len(intersected_ids) == 0:
         intersected_ids = [-1]
     return intersected_ids, sw_in_query, unknown_words
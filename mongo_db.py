@@ -1,40 +1,147 @@
-from typing import Dict, List, Iterable
+import os
+import uuid
+from typing import Dict, List, Iterable, Optional
 from utils import load_wapo, cleanhtml, CLEANR
-import pymongo
+from storage import get_storage, MongoStorage
+from snippet_store import SnippetStoreWriter
+from text_processing import TextProcessing
 
-client = pymongo.MongoClient(
-    "localhost", 27017
-)  # connect to the mongodb server running on your localhost
-db = client["ir_2022_wapo"]  # create a new database called "ir_2022_wapo"
+# the functions of this module run on the storage configured with BRS_STORAGE (see storage.get_storage): mongo on
+# localhost by default, or an embedded sqlite file. nothing is connected at import time
+# snippet store written along with the documents by insert_docs, see snippet_store
+SNIPPET_STORE = os.environ.get("BRS_SNIPPET_STORE")
 
 
-def insert_docs(docs: Iterable) -> None:
+def __getattr__(name: str):
+    # mongo_db.db, the database of the mongo storage, connected on first access
+    if name == "db":
+        storage = get_storage()
+        if not isinstance(storage, MongoStorage):
+            raise AttributeError(f"the configured storage {type(storage).__name__} is not a mongo database")
+        return storage.db
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def insert_docs(docs: Iterable, batch_size: int = 1000, snippet_store: Optional[str] = SNIPPET_STORE) -> None:
     """
     - create a collection called "wapo_docs"
     - add a unique ascending index on the key "id"
     - insert documents into the "wapo_docs" collection
+    documents are inserted by unordered insert_many batches. documents that are already stored (when a crashed
+    ingestion is resumed, see resume_id) are skipped
     :param docs: WAPO docs iterator (utils.load_wapo(...))
+    :param batch_size: number of documents per insert_many
+    :param snippet_store: path of the snippet store to write the documents to as well, none by default
     :return:
     """
     # TODO:
-    wapo_docs = db['wapo_docs']
-    wapo_docs.create_index([('id', pymongo.ASCENDING)], unique=True)
-    for doc in docs:
-        db['wapo_docs'].insert_one(doc)
+    if snippet_store:
+        # the snippet terms are normalized like the queries of the default analyzer
+        with SnippetStoreWriter(snippet_store, TextProcessing.from_nltk()) as writer:
+            get_storage().insert_docs(writer.add_all(docs), batch_size)
+    else:
+        get_storage().insert_docs(docs, batch_size)
+
+
+def resume_id(batch_size: int = 1000) -> int:
+    """
+    id of the document an interrupted insert_docs should restart from: load_wapo(..., start=resume_id()).
+    the batches are inserted one after the other, so only the last batch may be partially committed. ingestion
+    restarts at the beginning of that batch and insert_docs skips the documents already stored
+    :param batch_size: batch size of the interrupted insert_docs
+    :return:
+    """
+    return max(next_doc_id() - batch_size, 0)
+
+
+def next_doc_id() -> int:
+    """
+    id following the largest id stored in "wapo_docs", 0 if the collection is empty
+    :return:
+    """
+    return get_storage().next_doc_id()
+
+
+def has_docs() -> bool:
+    """
+    whether the documents were already ingested into "wapo_docs"
+    :return:
+    """
+    return get_storage().has_docs()
 
 
-def insert_db_index(index_list: List[Dict]) -> None:
+def insert_db_index(index_list: List[Dict], collection: str = "inverted_index") -> None:
     """
     - create a collection called "inverted_index"
     - add a unique ascending index on the key "token"
     - insert posting lists (index_list) into the "inverted_index" collection
-    :param index_list: posting lists in the format of [{"token": "post", "doc_ids": [0, 3, 113, 444, ...]}, {...}, ...]
+    :param index_list: posting lists in the format of
+        [{"token": "post", "doc_ids": [0, 3, 113, 444, ...], "positions": [[4, 17], [2], ...]}, {...}, ...]
+    :param collection: name of the collection, one per analyzer (see inverted_index.index_collection)
     :return:
     """
     # TODO:
-    db_index = db["inverted_index"]
-    idx = db_index.create_index([('token', pymongo.ASCENDING)], unique=True)
-    result = db['inverted_index'].insert_many(index_list)
+    get_storage().insert_index(index_list, collection)
+
+
+def insert_doc_stats(doc_lengths: Dict[int, int], collection: str = "doc_stats") -> None:
+    """
+    - create a collection called "doc_stats"
+    - store the number of indexed tokens of each document, used by the ranked retrieval mode
+    :param doc_lengths: doc id -> length
+    :param collection: name of the collection, one per analyzer
+    :return:
+    """
+    get_storage().insert_doc_stats(doc_lengths, collection)
+
+
+def query_doc_stats(collection: str = "doc_stats") -> Dict[int, int]:
+    """
+    the lengths stored by insert_doc_stats
+    :param collection:
+    :return: doc id -> length
+    """
+    return get_storage().query_doc_stats(collection)
+
+
+def drop_collection(collection: str) -> None:
+    """
+    drop an index or doc stats collection, e.g. the leftover of an interrupted build
+    :param collection:
+    :return:
+    """
+    get_storage().drop_collection(collection)
+
+
+def rename_collection(collection: str, new_name: str) -> None:
+    """
+    rename a collection over new_name, which is replaced
+    :param collection:
+    :param new_name:
+    :return:
+    """
+    get_storage().rename_collection(collection, new_name)
+
+
+def bump_index_generation(collection: str = "inverted_index") -> str:
+    """
+    store a new generation of the index collection once a build has written it, see query_index_generation
+    :param collection: name of the collection, one per analyzer
+    :return: the new generation
+    """
+    generation = uuid.uuid4().hex
+    get_storage().set_index_generation(collection, generation)
+    return generation
+
+
+def query_index_generation(collection: str = "inverted_index") -> Optional[str]:
+    """
+    generation of the last build of the index collection: what a process cached of the collection (posting lists,
+    doc lengths, terms) is stale once it changes
+    :param collection:
+    :return: None if the index was built before generations were stored
+    """
+    return get_storage().query_index_generation(collection)
 
 
 def query_doc(doc_id: int) -> Dict:
@@ -44,16 +151,41 @@ def query_doc(doc_id: int) -> Dict:
     :return:
     """
     # TODO:
-    doc = db["wapo_docs"].find_one({'id': doc_id})
+    doc = get_storage().query_doc(doc_id)
     return doc
 
 
-def query_db_index(token: str) -> Dict:
+def query_docs(doc_ids: List[int], snippet_len: int = 150) -> List[Dict]:
+    """
+    bulk version of query_doc for the results page: fetch the documents with a single query, projected to their
+    id, title and the first snippet_len characters of content_str (as "snippet")
+    :param doc_ids:
+    :param snippet_len:
+    :return: the documents in the order of doc_ids
+    """
+    return get_storage().query_docs(doc_ids, snippet_len)
+
+
+def query_db_index(token: str, positions: bool = True, collection: str = "inverted_index") -> Dict:
     """
     query the posting list from "inverted_index" collection based on the token
     :param token:
+    :param positions: whether to load the positions of the token in each doc along with the doc ids
+    :param collection: name of the collection, one per analyzer
     :return:
     """
     # TODO:
-    posting_list = db["inverted_index"].find_one({'token': token})
+    posting_list = get_storage().query_index_many([token], positions, collection).get(token)
     return posting_list
+
+
+def query_db_index_many(tokens: List[str], positions: bool = True,
+                        collection: str = "inverted_index") -> Dict[str, Dict]:
+    """
+    bulk version of query_db_index: fetch the posting lists of several tokens with a single query
+    :param tokens:
+    :param positions: whether to load the positions of the tokens in each doc along with the doc ids
+    :param collection: name of the collection, one per analyzer
+    :return: token -> posting list, the unknown tokens are left out
+    """
+    return get_storage().query_index_many(tokens, positions, collection)
@@ -0,0 +1,187 @@
+import threading
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Tuple, Union
+
+from bitmap_postings import compact, doc_count
+from tracing import span
+from utils import LRUCache
+
+
+def postings_size(post_dict: Dict) -> int:
+    """
+    number of integers held by a posting dict: its doc ids and their positions. a bitmap counts as one integer per
+    8 bytes, the size of an item of a list
+    :param post_dict:
+    :return:
+    """
+    size = sum(len(positions) for positions in post_dict.get('positions', ()))
+    if 'doc_ids' in post_dict:
+        size += len(post_dict['doc_ids'])
+    bitmap = post_dict.get('bitmap')
+    if bitmap is not None:
+        size += -(-bitmap.nbytes // 8)
+    return size
+
+
+class PostingsCache:
+    def __init__(self, fetch_many: Optional[Callable[[List[str], bool], Dict[str, Dict]]] = None,
+                 max_terms: int = 200000, max_postings: int = 5000000,
+                 afetch_many: Optional[Callable[[List[str], bool], Awaitable[Dict[str, Dict]]]] = None):
+        """
+        query-side cache in front of an index backend with a per-request cost (the mongo collections):
+        - the term dictionary: term -> document frequency, 0 for a term that is not indexed, so that the unknown words
+          of a query are answered from memory
+        - the posting lists of the recently queried terms, evicted least recently used first once they hold more than
+          max_postings doc ids and positions (see postings_size). a dense term is kept as a bitmap without its list
+          of doc ids, see bitmap_postings.compact
+        the terms of a query that are not cached are fetched together with a single fetch_many call. the fetch
+        latency is measured to estimate the time saved by the hits. the entries are dropped when the index is rebuilt,
+        see set_generation
+        :param fetch_many: (terms, positions) -> term -> posting dict, e.g. mongo_db.query_db_index_many
+        :param max_terms: size of the term dictionary
+        :param max_postings:
+        :param afetch_many: coroutine version of fetch_many used by aquery_many, e.g. with the motor driver
+        """
+        self.fetch_many = fetch_many
+        self.afetch_many = afetch_many
+        self.max_postings = max_postings
+        self.dictionary = LRUCache(max_terms)
+        self._postings = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.generation = None
+        # incremented by clear: a fetch that was running when the entries were dropped may have read the old index,
+        # its results are not cached
+        self._epoch = 0
+        self.hits = 0
+        self.misses = 0
+        self.fetches = 0
+        self.fetched_terms = 0
+        self.fetch_time = 0.0
+
+    def _put(self, term: str, post_dict: Dict) -> None:
+        # callers hold self._lock
+        size = postings_size(post_dict)
+        if size > self.max_postings:
+            return
+        old = self._postings.pop(term, None)
+        if old is not None:
+            self._size -= postings_size(old)
+        self._postings[term] = post_dict
+        self._size += size
+        while self._size > self.max_postings:
+            _, evicted = self._postings.popitem(last=False)
+            self._size -= postings_size(evicted)
+
+    def _cached(self, terms: Iterable[str], positions: bool) -> Tuple[Dict[str, Dict], List[str], int]:
+        # the cached posting lists of the terms, the terms to fetch and the epoch they are fetched in
+        found = {}
+        missing = []
+        with self._lock:
+            epoch = self._epoch
+            for term in terms:
+                df = self.dictionary.get(term)
+                post_dict = self._postings.get(term)
+                if df == 0:
+                    self.hits += 1
+                elif post_dict is not None and (not positions or 'positions' in post_dict):
+                    self._postings.move_to_end(term)
+                    self.hits += 1
+                    found[term] = post_dict
+                else:
+                    missing.append(term)
+        return found, missing, epoch
+
+    def _store(self, found: Dict[str, Dict], missing: List[str], fetched: Dict[str, Dict], elapsed_t: float,
+               epoch: int) -> None:
+        with self._lock:
+            self.misses += len(missing)
+            self.fetches += 1
+            self.fetched_terms += len(missing)
+            self.fetch_time += elapsed_t
+            for term in missing:
+                post_dict = fetched.get(term)
+                if post_dict:
+                    post_dict = compact(post_dict)
+                    found[term] = post_dict
+                if epoch != self._epoch:
+                    continue
+                self.dictionary.put(term, doc_count(post_dict) if post_dict else 0)
+                if post_dict:
+                    self._put(term, post_dict)
+
+    def query_many(self, terms: Iterable[str], positions: bool = True) -> Dict[str, Dict]:
+        """
+        the posting lists of the terms, the unknown terms are left out
+        :param terms:
+        :param positions: whether the positions of the terms are needed. a posting list cached without its positions
+            is fetched again when they are
+        :return: term -> posting dict as returned by mongo_db.query_db_index
+        """
+        found, missing, epoch = self._cached(terms, positions)
+        if missing:
+            with span("query_db_index") as fetch_span:
+                fetched = self.fetch_many(missing, positions)
+            self._store(found, missing, fetched, fetch_span.elapsed, epoch)
+        return found
+
+    async def aquery_many(self, terms: Iterable[str], positions: bool = True) -> Dict[str, Dict]:
+        """
+        query_many for asyncio code, the terms that are not cached are fetched with afetch_many
+        :param terms:
+        :param positions:
+        :return:
+        """
+        found, missing, epoch = self._cached(terms, positions)
+        if missing:
+            with span("query_db_index") as fetch_span:
+                fetched = await self.afetch_many(missing, positions)
+            self._store(found, missing, fetched, fetch_span.elapsed, epoch)
+        return found
+
+    def query(self, term: str, positions: bool = True) -> Optional[Dict]:
+        """
+        same contract as mongo_db.query_db_index
+        :param term:
+        :param positions:
+        :return:
+        """
+        return self.query_many([term], positions).get(term)
+
+    def clear(self) -> None:
+        """
+        drop the cached entries, e.g. after the index was rebuilt
+        :return:
+        """
+        with self._lock:
+            self._clear()
+
+    def _clear(self) -> None:
+        # callers hold self._lock
+        self.dictionary.clear()
+        self._postings.clear()
+        self._size = 0
+        self._epoch += 1
+
+    def set_generation(self, generation) -> None:
+        """
+        drop the cached entries if the index was rebuilt (e.g. by another process) since they were fetched
+        :param generation: generation of the index, see mongo_db.query_index_generation
+        :return:
+        """
+        with self._lock:
+            if generation != self.generation:
+                self.generation = generation
+                self._clear()
+
+    def stats(self) -> Dict[str, Union[int, float]]:
+        """
+        hit rate, and the fetch latency saved by the hits estimated with the mean fetch latency of a term
+        :return:
+        """
+        lookups = self.hits + self.misses
+        term_latency = self.fetch_time / self.fetched_terms if self.fetched_terms else 0.0
+        return {"terms": len(self.dictionary), "posting_lists": len(self._postings), "postings": self._size,
+                "max_postings": self.max_postings, "hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0, "fetches": self.fetches,
+                "fetch_time": self.fetch_time, "saved_time": self.hits * term_latency}
@@ -0,0 +1,379 @@
+import mmap
+import os
+import struct
+import threading
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+try:
+    # optional, the long blobs are then decoded with vectorized kernels
+    import numpy as np
+except ImportError:
+    np = None
+
+from bitmap_postings import Bitmap, DensePostingDict, is_dense
+from ranking import DocLengths, doc_lengths_path
+from term_dictionary import TermDictionary, terms_path
+from utils import LRUCache
+
+# file layout:
+#   header       MAGIC, flags (u32), number of terms (u32), offset of the term dictionary (u64)
+#   postings     one variable-byte encoded blob per term: the delta-encoded doc ids, followed for a positional index
+#                by the number of positions and the delta-encoded positions of the term in each doc
+#   dictionary   per term: term length (u16), utf-8 term, document frequency (u32), blob offset (u64), blob size (u32),
+#                size of the doc ids part of the blob (u32)
+MAGIC = b"BRSIDX02"
+# number of bitmaps of dense terms kept by a PostingsFile, see bitmap_postings
+BITMAP_CACHE_SIZE = 1024
+POSITIONAL = 1
+HEADER = struct.Struct("<8sIIQ")
+TERM_LEN = struct.Struct("<H")
+ENTRY = struct.Struct("<IQII")
+# blobs shorter than this are decoded in python even when numpy is installed, the array set up costs more
+NUMPY_MIN_BYTES = 64
+
+
+def vbyte_encode(numbers: Iterable[int]) -> bytes:
+    """
+    variable-byte encoding of non-negative integers, 7 bits per byte with the high bit set on the last byte
+    :param numbers:
+    :return:
+    """
+    out = bytearray()
+    for n in numbers:
+        while n >= 128:
+            out.append(n & 127)
+            n >>= 7
+        out.append(n | 128)
+    return bytes(out)
+
+
+def vbyte_decode(buf: Union[bytes, mmap.mmap], start: int = 0, end: Optional[int] = None) -> List[int]:
+    """
+    decode the variable-byte encoded integers of buf[start:end]
+    :param buf:
+    :param start:
+    :param end:
+    :return:
+    """
+    end = len(buf) if end is None else end
+    if np is not None and end - start >= NUMPY_MIN_BYTES:
+        return vbyte_decode_array(buf, start, end).tolist()
+    numbers = []
+    n = 0
+    shift = 0
+    for b in buf[start:end]:
+        if b & 128:
+            numbers.append(n | ((b & 127) << shift))
+            n = 0
+            shift = 0
+        else:
+            n |= b << shift
+            shift += 7
+    return numbers
+
+
+def vbyte_decode_array(buf: Union[bytes, mmap.mmap], start: int = 0, end: Optional[int] = None):
+    """
+    numpy version of vbyte_decode: the bytes are grouped by number from the positions of their high bits, and the 7
+    bit groups of each number shifted and summed at once
+    :param buf:
+    :param start:
+    :param end:
+    :return: int64 array
+    """
+    end = len(buf) if end is None else end
+    data = np.frombuffer(buf, dtype=np.uint8, count=end - start, offset=start)
+    last = np.flatnonzero(data >= 128)
+    if len(last) == len(data):
+        # only numbers below 128, e.g. the gaps of a dense posting list
+        return (data & 127).astype(np.int64)
+    if not len(last):
+        return np.zeros(0, dtype=np.int64)
+    first = np.empty_like(last)
+    first[0] = 0
+    first[1:] = last[:-1] + 1
+    shifts = 7 * (np.arange(last[-1] + 1) - np.repeat(first, last - first + 1))
+    return np.add.reduceat((data[:last[-1] + 1] & 127).astype(np.int64) << shifts, first)
+
+
+def encode_postings(doc_ids: List[int]) -> bytes:
+    """
+    delta + variable-byte encoding of an ascending doc id list
+    :param doc_ids:
+    :return:
+    """
+    prev = 0
+    gaps = []
+    for doc_id in doc_ids:
+        gaps.append(doc_id - prev)
+        prev = doc_id
+    return vbyte_encode(gaps)
+
+
+def decode_postings(buf: Union[bytes, mmap.mmap], start: int = 0, end: Optional[int] = None) -> List[int]:
+    if np is not None and (len(buf) if end is None else end) - start >= NUMPY_MIN_BYTES:
+        return decode_postings_array(buf, start, end).tolist()
+    doc_ids = vbyte_decode(buf, start, end)
+    for i in range(1, len(doc_ids)):
+        doc_ids[i] += doc_ids[i - 1]
+    return doc_ids
+
+
+def decode_postings_array(buf: Union[bytes, mmap.mmap], start: int = 0, end: Optional[int] = None):
+    """
+    the ascending doc ids of an encoded posting list as a numpy array
+    :param buf:
+    :param start:
+    :param end:
+    :return: int64 array
+    """
+    return np.cumsum(vbyte_decode_array(buf, start, end))
+
+
+def encode_positions(positions: List[List[int]]) -> bytes:
+    """
+    variable-byte encoding of the positions of a term in each doc of its posting list: the number of positions
+    followed by the delta-encoded positions
+    :param positions:
+    :return:
+    """
+    numbers = []
+    for doc_positions in positions:
+        numbers.append(len(doc_positions))
+        prev = 0
+        for pos in doc_positions:
+            numbers.append(pos - prev)
+            prev = pos
+    return vbyte_encode(numbers)
+
+
+def decode_positions(buf: Union[bytes, mmap.mmap], start: int = 0, end: Optional[int] = None) -> List[List[int]]:
+    numbers = vbyte_decode(buf, start, end)
+    positions = []
+    i = 0
+    while i < len(numbers):
+        count = numbers[i]
+        doc_positions = numbers[i + 1:i + 1 + count]
+        for j in range(1, count):
+            doc_positions[j] += doc_positions[j - 1]
+        positions.append(doc_positions)
+        i += 1 + count
+    return positions
+
+
+def decode_positions_arrays(buf: Union[bytes, mmap.mmap], start: int = 0, end: Optional[int] = None):
+    """
+    numpy version of decode_positions, as flat arrays
+    :param buf:
+    :param start:
+    :param end:
+    :return: number of positions in each doc (int64 array), and the positions of all docs one after the other
+        (int64 array)
+    """
+    numbers = vbyte_decode_array(buf, start, end)
+    # the counts are found one doc at a time, each count tells where the next one is
+    count_idx = []
+    values = numbers.tolist()
+    i = 0
+    while i < len(values):
+        count_idx.append(i)
+        i += 1 + values[i]
+    is_count = np.zeros(len(numbers), dtype=bool)
+    is_count[count_idx] = True
+    counts = numbers[is_count]
+    gaps = numbers[~is_count]
+    # cumulative sum of the gaps, restarted at the first position of each doc
+    cumsum = np.concatenate(([0], np.cumsum(gaps)))
+    doc_start = np.cumsum(counts) - counts
+    return counts, cumsum[1:] - np.repeat(cumsum[doc_start], counts)
+
+
+class PostingsFileWriter:
+    def __init__(self, path: Union[str, os.PathLike], positional: bool = True):
+        """
+        streaming writer of a compressed postings file. terms have to be added in ascending order, the term
+        dictionary is appended when the writer is closed
+        :param path:
+        :param positional: whether the positions of the terms are stored along with the doc ids
+        """
+        self.path = path
+        self.flags = POSITIONAL if positional else 0
+        self._f = open(path, "wb")
+        self._f.write(HEADER.pack(MAGIC, 0, 0, 0))
+        self._entries = []
+        self._last_term = None
+
+    def add(self, term: str, doc_ids: List[int], positions: Optional[List[List[int]]] = None) -> None:
+        if self._last_term is not None and term <= self._last_term:
+            raise ValueError(f"terms must be added in ascending order: {term!r} after {self._last_term!r}")
+        if (positions is not None) != bool(self.flags & POSITIONAL):
+            raise ValueError("positions must be given if and only if the postings file is positional")
+        blob = encode_postings(doc_ids)
+        doc_bytes = len(blob)
+        if positions is not None:
+            blob += encode_positions(positions)
+        self._entries.append((term, len(doc_ids), self._f.tell(), len(blob), doc_bytes))
+        self._f.write(blob)
+        self._last_term = term
+
+    def close(self) -> None:
+        dict_offset = self._f.tell()
+        for term, df, offset, size, doc_bytes in self._entries:
+            encoded = term.encode("utf-8")
+            self._f.write(TERM_LEN.pack(len(encoded)))
+            self._f.write(encoded)
+            self._f.write(ENTRY.pack(df, offset, size, doc_bytes))
+        self._f.seek(0)
+        self._f.write(HEADER.pack(MAGIC, self.flags, len(self._entries), dict_offset))
+        self._f.close()
+
+    def __enter__(self) -> "PostingsFileWriter":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def write_postings_file(path: Union[str, os.PathLike],
+                        postings: Iterable[Tuple[str, List[int], List[List[int]]]]) -> None:
+    """
+    write (term, doc_ids, positions) records sorted by term (e.g. spimi.merge_runs(...)) to a compressed postings file
+    :param path:
+    :param postings:
+    :return:
+    """
+    with PostingsFileWriter(path) as writer:
+        for term, doc_ids, positions in postings:
+            writer.add(term, doc_ids, positions)
+
+
+class PostingsFile:
+    def __init__(self, path: Union[str, os.PathLike]):
+        """
+        read-only, memory-mapped view of a postings file written by PostingsFileWriter. the term dictionary is
+        loaded at startup, posting lists are only decoded when a term is queried. the doc lengths written next to
+        the file (see ranking.doc_lengths_path) are loaded as well when they exist. the bitmaps of the dense terms
+        that were queried recently are kept, the file never changes: their doc ids are not decoded again
+        :param path:
+        """
+        self.path = path
+        self._bitmaps = LRUCache(BITMAP_CACHE_SIZE)
+        self._bitmaps_lock = threading.Lock()
+        lens_path = doc_lengths_path(path)
+        self.doc_lengths = DocLengths.load(lens_path) if os.path.exists(lens_path) else None
+        self._f = open(path, "rb")
+        self._mm = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.flags, num_terms, dict_offset = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a postings file")
+        self._dictionary = {}
+        self._term_dictionary = None
+        pos = dict_offset
+        for _ in range(num_terms):
+            (term_len,) = TERM_LEN.unpack_from(self._mm, pos)
+            pos += TERM_LEN.size
+            term = self._mm[pos:pos + term_len].decode("utf-8")
+            pos += term_len
+            self._dictionary[term] = ENTRY.unpack_from(self._mm, pos)
+            pos += ENTRY.size
+
+    def __len__(self) -> int:
+        return len(self._dictionary)
+
+    def __contains__(self, term: str) -> bool:
+        return term in self._dictionary
+
+    def terms(self) -> Iterator[str]:
+        return iter(self._dictionary)
+
+    def df(self, term: str) -> int:
+        entry = self._dictionary.get(term)
+        return entry[0] if entry else 0
+
+    @property
+    def positional(self) -> bool:
+        return bool(self.flags & POSITIONAL)
+
+    def postings(self, term: str) -> List[int]:
+        entry = self._dictionary.get(term)
+        if entry is None:
+            return []
+        _, offset, _, doc_bytes = entry
+        return decode_postings(self._mm, offset, offset + doc_bytes)
+
+    def postings_array(self, term: str):
+        """
+        the doc ids of the term as a numpy array, decoded without going through a list
+        :param term:
+        :return: int64 array
+        """
+        entry = self._dictionary.get(term)
+        if entry is None:
+            return np.zeros(0, dtype=np.int64)
+        _, offset, _, doc_bytes = entry
+        return decode_postings_array(self._mm, offset, offset + doc_bytes)
+
+    def positions_arrays(self, term: str):
+        """
+        the positions of the term as numpy arrays, see decode_positions_arrays
+        :param term:
+        :return: number of positions in each doc and flat positions, None if the term is unknown or the index has no
+            positions
+        """
+        entry = self._dictionary.get(term)
+        if entry is None or not self.positional:
+            return None
+        _, offset, size, doc_bytes = entry
+        return decode_positions_arrays(self._mm, offset + doc_bytes, offset + size)
+
+    def positions(self, term: str) -> List[List[int]]:
+        entry = self._dictionary.get(term)
+        if entry is None or not self.positional:
+            return []
+        _, offset, size, doc_bytes = entry
+        return decode_positions(self._mm, offset + doc_bytes, offset + size)
+
+    def query(self, term: str, positions: bool = True) -> Optional[Dict]:
+        """
+        same contract as mongo_db.query_db_index: the posting list of the term or None if the term is unknown. a dense
+        term is returned as a bitmap_postings.DensePostingDict
+        :param term:
+        :param positions: whether to decode the positions of the term along with the doc ids
+        :return:
+        """
+        if term not in self._dictionary:
+            return None
+        with self._bitmaps_lock:
+            bitmap = self._bitmaps.get(term)
+        if bitmap is None:
+            doc_ids = self.postings(term)
+            if is_dense(doc_ids):
+                bitmap = Bitmap.from_doc_ids(doc_ids)
+                with self._bitmaps_lock:
+                    self._bitmaps.put(term, bitmap)
+        if bitmap is not None:
+            post_dict = DensePostingDict(token=term, bitmap=bitmap)
+        else:
+            post_dict = {'token': term, 'doc_ids': doc_ids}
+        if positions and self.positional:
+            post_dict['positions'] = self.positions(term)
+        return post_dict
+
+    def term_dictionary(self) -> TermDictionary:
+        """
+        the terms of the file with their document frequency for wildcard and spelling lookups, loaded on the first
+        call from the terms file written next to the postings file by the build (see term_dictionary.terms_path), or
+        built from the term dictionary of the file, whose terms are already in ascending order, when there is none
+        :return:
+        """
+        if self._term_dictionary is None:
+            path = terms_path(self.path)
+            dictionary = TermDictionary.load(path) if os.path.exists(path) else None
+            if dictionary is None or len(dictionary) != len(self._dictionary):
+                dictionary = TermDictionary(self._dictionary, (entry[0] for entry in self._dictionary.values()))
+            self._term_dictionary = dictionary
+        return self._term_dictionary
+
+    def close(self) -> None:
+        self._mm.close()
+        self._f.close()
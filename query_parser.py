@@ -0,0 +1,271 @@
+import re
+from typing import Dict, List, Optional, Set, Tuple
+
+from term_dictionary import WILDCARDS
+
+# the operators are only recognized in upper case, so that "and", "or" and "not" are still ordinary (stop) words
+AND, OR, NOT = "AND", "OR", "NOT"
+LEXER = re.compile(r'"([^"]*)"?|(\()|(\))|([^\s()"]+)')
+# characters kept in a wildcard pattern, the others are dropped like the analyzer drops punctuation
+WILDCARD_CHARS = re.compile(r"[^a-z0-9_*?-]")
+
+
+class Term:
+    __slots__ = ("term",)
+
+    def __init__(self, term: str):
+        """
+        a single normalized term
+        :param term:
+        """
+        self.term = term
+
+    def terms(self) -> Set[str]:
+        return {self.term}
+
+    def __str__(self) -> str:
+        return self.term
+
+
+class Wildcard:
+    __slots__ = ("pattern",)
+
+    def __init__(self, pattern: str):
+        """
+        word with * (any characters) or ? (one character), expanded to the OR of the matching terms of the term
+        dictionary before evaluation (see inverted_index.expand_wildcards). it has no terms of its own
+        :param pattern: lower case pattern
+        """
+        self.pattern = pattern
+
+    def terms(self) -> Set[str]:
+        return set()
+
+    def __str__(self) -> str:
+        return self.pattern
+
+
+class Phrase:
+    __slots__ = ("terms_offsets",)
+
+    def __init__(self, terms_offsets: List[Tuple[str, int]]):
+        """
+        exact phrase, stored as its normalized terms with their offset from the start of the phrase. stop words are
+        dropped by the analyzer but still count in the offsets
+        :param terms_offsets: [(term, offset), ...]
+        """
+        self.terms_offsets = terms_offsets
+
+    def terms(self) -> Set[str]:
+        return {term for term, _ in self.terms_offsets}
+
+    def __str__(self) -> str:
+        return '"' + " ".join(f"{term}@{offset}" for term, offset in self.terms_offsets) + '"'
+
+
+class And:
+    __slots__ = ("children",)
+
+    def __init__(self, children: List):
+        self.children = children
+
+    def terms(self) -> Set[str]:
+        return set().union(*(child.terms() for child in self.children))
+
+    def __str__(self) -> str:
+        return "(" + " AND ".join(str(child) for child in self.children) + ")"
+
+
+class Or:
+    __slots__ = ("children",)
+
+    def __init__(self, children: List):
+        self.children = children
+
+    def terms(self) -> Set[str]:
+        return set().union(*(child.terms() for child in self.children))
+
+    def __str__(self) -> str:
+        return "(" + " OR ".join(str(child) for child in self.children) + ")"
+
+
+class Not:
+    __slots__ = ("child",)
+
+    def __init__(self, child):
+        self.child = child
+
+    def terms(self) -> Set[str]:
+        return self.child.terms()
+
+    def __str__(self) -> str:
+        return f"NOT {self.child}"
+
+
+def tokenize_query(query: str) -> List[Tuple[str, str]]:
+    """
+    split the query into ("phrase", text), ("(", "("), (")", ")"), ("op", AND/OR/NOT) and ("word", text) tokens.
+    an unterminated quote runs to the end of the query
+    :param query:
+    :return:
+    """
+    tokens = []
+    for m in LEXER.finditer(query):
+        phrase, lparen, rparen, word = m.groups()
+        if phrase is not None:
+            tokens.append(("phrase", phrase))
+        elif lparen:
+            tokens.append(("(", lparen))
+        elif rparen:
+            tokens.append((")", rparen))
+        elif word in (AND, OR, NOT):
+            tokens.append(("op", word))
+        else:
+            tokens.append(("word", word))
+    return tokens
+
+
+class QueryParser:
+    def __init__(self, analyzer):
+        """
+        recursive descent parser of the boolean query language:
+
+            expr    := and_expr (OR and_expr)*
+            and_expr:= not_expr ([AND] not_expr)*
+            not_expr:= NOT not_expr | primary
+            primary := "(" expr ")" | "exact phrase" | wildcard | word
+
+        adjacent operands are implicitly ANDed. the parser is lenient since queries come from a search box: unbalanced
+        parentheses and dangling operators are ignored. words and phrases are normalized with the analyzer; a word
+        normalized to several terms (e.g. "George's") is the AND of them, a stop word is dropped from the query. a word
+        with * or ? is a wildcard, it is lower cased but not normalized since it is matched against the index terms. a
+        trailing ? alone (e.g. "who won?") is punctuation, not a wildcard
+        :param analyzer: TextProcessing like object with get_normalized_positions. with normalize_in_context, the words
+            and phrases are normalized together in the context of the query
+        """
+        self.analyzer = analyzer
+        self._tokens = []
+        self._pos = 0
+        # normalized terms -> positions of the words and phrases, by token index
+        self._normalized = {}
+
+    def parse(self, query: str) -> Optional[object]:
+        """
+        :param query: user input query
+        :return: root node of the query tree, None if nothing searchable is left
+        """
+        self._tokens = tokenize_query(query)
+        self._pos = 0
+        self._normalized = self._normalize_texts()
+        nodes = []
+        while self._pos < len(self._tokens):
+            node = self._expr()
+            if node is not None:
+                nodes.append(node)
+            elif self._pos < len(self._tokens):
+                # skip a stray ")" or operator
+                self._pos += 1
+        return combine(And, nodes)
+
+    def _normalize_texts(self) -> Dict[int, Dict[str, List[int]]]:
+        # the words and phrases are normalized at once when the analyzer can use the context of the whole query (see
+        # CustomizedTextProcessing.normalize_in_context), one by one otherwise
+        indexes = [i for i, (kind, value) in enumerate(self._tokens)
+                   if kind == "phrase" or (kind == "word" and not _is_wildcard_word(value))]
+        texts = [self._tokens[i][1] for i in indexes]
+        if hasattr(self.analyzer, "normalize_in_context"):
+            normalized = self.analyzer.normalize_in_context(texts)
+        else:
+            normalized = [self.analyzer.get_normalized_positions('', text) for text in texts]
+        return dict(zip(indexes, normalized))
+
+    def _peek(self) -> Tuple[Optional[str], Optional[str]]:
+        if self._pos < len(self._tokens):
+            return self._tokens[self._pos]
+        return None, None
+
+    def _expr(self):
+        nodes = [self._and_expr()]
+        while self._peek() == ("op", OR):
+            self._pos += 1
+            nodes.append(self._and_expr())
+        return combine(Or, [node for node in nodes if node is not None])
+
+    def _and_expr(self):
+        nodes = [self._not_expr()]
+        while True:
+            kind, value = self._peek()
+            if kind == "op" and value == AND:
+                self._pos += 1
+            elif kind not in ("word", "phrase", "(") and (kind, value) != ("op", NOT):
+                break
+            nodes.append(self._not_expr())
+        return combine(And, [node for node in nodes if node is not None])
+
+    def _not_expr(self):
+        if self._peek() == ("op", NOT):
+            self._pos += 1
+            child = self._not_expr()
+            return Not(child) if child is not None else None
+        return self._primary()
+
+    def _primary(self):
+        kind, value = self._peek()
+        if kind == "(":
+            self._pos += 1
+            node = self._expr()
+            if self._peek()[0] == ")":
+                self._pos += 1
+            return node
+        if kind == "phrase":
+            self._pos += 1
+            return self._phrase(self._normalized[self._pos - 1])
+        if kind == "word":
+            self._pos += 1
+            if _is_wildcard_word(value):
+                pattern = WILDCARD_CHARS.sub("", value.lower())
+                return Wildcard(pattern) if WILDCARDS.sub("", pattern) else None
+            return combine(And, [Term(term) for term in sorted(self._normalized[self._pos - 1])])
+        return None
+
+    def _phrase(self, normalized: Dict[str, List[int]]):
+        terms_offsets = sorted(((term, pos) for term, positions in normalized.items() for pos in positions),
+                               key=lambda t: t[1])
+        if not terms_offsets:
+            return None
+        if len(terms_offsets) == 1:
+            return Term(terms_offsets[0][0])
+        start = terms_offsets[0][1]
+        return Phrase([(term, pos - start) for term, pos in terms_offsets])
+
+
+def _is_wildcard_word(word: str) -> bool:
+    # a trailing ? alone is punctuation
+    return WILDCARDS.search(word.rstrip("?")) is not None
+
+
+def combine(cls, nodes: List):
+    """
+    :param cls: And or Or
+    :param nodes:
+    :return: the node of the operator over the nodes, the node itself if there is one, None if there is none
+    """
+    if not nodes:
+        return None
+    if len(nodes) == 1:
+        return nodes[0]
+    # flatten nested nodes of the same operator
+    children = []
+    for node in nodes:
+        children.extend(node.children if isinstance(node, cls) else [node])
+    return cls(children)
+
+
+def parse_query(query: str, analyzer) -> Optional[object]:
+    """
+    parse a user query into a tree of Term, Phrase, Wildcard, And, Or and Not nodes, see QueryParser
+    :param query:
+    :param analyzer:
+    :return:
+    """
+    return QueryParser(analyzer).parse(query)
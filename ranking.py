@@ -0,0 +1,149 @@
+import heapq
+import math
+import os
+from array import array
+from bisect import bisect_left
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+K1 = 1.2
+B = 0.75
+
+
+class DocLengths:
+    def __init__(self, lengths: Optional[array] = None):
+        """
+        number of indexed tokens of each document, stored in an array indexed by doc id (the ids are dense)
+        :param lengths: array('I') of lengths, 0 for an unknown doc
+        """
+        self.lengths = lengths if lengths is not None else array('I')
+        self.num_docs = sum(1 for length in self.lengths if length)
+        self.total = sum(self.lengths)
+
+    def __getitem__(self, doc_id: int) -> int:
+        return self.lengths[doc_id] if doc_id < len(self.lengths) else 0
+
+    def __len__(self) -> int:
+        return self.num_docs
+
+    @property
+    def avgdl(self) -> float:
+        return self.total / self.num_docs if self.num_docs else 0.0
+
+    def update(self, doc_lengths: Union[Dict[int, int], Iterable[Tuple[int, int]]]) -> None:
+        """
+        set the length of some documents
+        :param doc_lengths: doc id -> length
+        :return:
+        """
+        items = doc_lengths.items() if isinstance(doc_lengths, dict) else doc_lengths
+        for doc_id, length in items:
+            if doc_id >= len(self.lengths):
+                self.lengths.extend([0] * (doc_id + 1 - len(self.lengths)))
+            old = self.lengths[doc_id]
+            self.num_docs += bool(length) - bool(old)
+            self.total += length - old
+            self.lengths[doc_id] = length
+
+    def copy(self) -> "DocLengths":
+        return DocLengths(array('I', self.lengths))
+
+    def save(self, path: Union[str, os.PathLike]) -> None:
+        with open(path, "wb") as f:
+            self.lengths.tofile(f)
+
+    @classmethod
+    def load(cls, path: Union[str, os.PathLike]) -> "DocLengths":
+        lengths = array('I')
+        with open(path, "rb") as f:
+            lengths.frombytes(f.read())
+        return cls(lengths)
+
+
+def doc_lengths_path(index_file: Union[str, os.PathLike]) -> str:
+    """
+    doc lengths are written next to a postings file, in <index_file>.lens
+    :param index_file:
+    :return:
+    """
+    return f"{index_file}.lens"
+
+
+def idf(df: int, num_docs: int) -> float:
+    return math.log(1 + (num_docs - df + 0.5) / (df + 0.5))
+
+
+def bm25_top_k(postings: Dict[str, Dict], doc_lengths: DocLengths, k: int, k1: float = K1,
+               b: float = B, collection_stats: Optional[Tuple[int, float, Dict[str, int]]] = None
+               ) -> List[Tuple[int, float]]:
+    """
+    top k documents by BM25 score over the union of the terms, computed with WAND dynamic pruning:
+    each term has an upper bound of its score contribution, idf * (k1 + 1). the cursors are kept ordered by their
+    current doc and a document is only scored when the upper bounds of the terms that can still reach it exceed the
+    score of the current k-th best document; the other cursors are moved straight to the pivot doc by binary search
+    :param postings: term -> posting dict with doc ids and positions (the term frequency is the number of positions)
+    :param doc_lengths:
+    :param k:
+    :param k1:
+    :param b:
+    :param collection_stats: number of docs, average doc length and term -> df to score with instead of those of
+        doc_lengths and postings, e.g. the statistics of the whole collection when the postings are those of a shard
+    :return: [(doc_id, score), ...] sorted by decreasing score
+    """
+    if collection_stats is None:
+        num_docs = max(len(doc_lengths), 1)
+        avgdl = doc_lengths.avgdl or 1.0
+        dfs = {}
+    else:
+        num_docs, avgdl, dfs = collection_stats
+        num_docs = max(num_docs, 1)
+        avgdl = avgdl or 1.0
+    # cursor: [current position, doc ids, term frequencies, idf, upper bound]
+    cursors = []
+    for term, post_dict in postings.items():
+        doc_ids = post_dict['doc_ids']
+        if not doc_ids:
+            continue
+        tfs = [len(positions) for positions in post_dict['positions']] if 'positions' in post_dict \
+            else [1] * len(doc_ids)
+        term_idf = idf(dfs.get(term, len(doc_ids)), num_docs)
+        cursors.append([0, doc_ids, tfs, term_idf, term_idf * (k1 + 1)])
+
+    top = []  # min-heap of (score, -doc_id)
+    threshold = 0.0
+    while cursors:
+        cursors.sort(key=lambda c: c[1][c[0]])
+        # pivot: first cursor at which the accumulated upper bounds can beat the threshold
+        bound = 0.0
+        pivot = None
+        for i, cursor in enumerate(cursors):
+            bound += cursor[4]
+            if bound > threshold:
+                pivot = i
+                break
+        if pivot is None:
+            break
+        pivot_doc = cursors[pivot][1][cursors[pivot][0]]
+        if cursors[0][1][cursors[0][0]] == pivot_doc:
+            # every cursor up to the pivot is on the pivot doc: score it
+            dl = doc_lengths[pivot_doc]
+            norm = k1 * (1 - b + b * dl / avgdl)
+            score = 0.0
+            for cursor in cursors:
+                pos, doc_ids, tfs, term_idf, _ = cursor
+                if doc_ids[pos] != pivot_doc:
+                    break
+                tf = tfs[pos]
+                score += term_idf * tf * (k1 + 1) / (tf + norm)
+                cursor[0] += 1
+            if len(top) < k:
+                heapq.heappush(top, (score, -pivot_doc))
+            elif score > top[0][0]:
+                heapq.heapreplace(top, (score, -pivot_doc))
+            if len(top) == k:
+                threshold = top[0][0]
+        else:
+            # skip the cursors before the pivot to the pivot doc
+            for cursor in cursors[:pivot]:
+                cursor[0] = bisect_left(cursor[1], pivot_doc, cursor[0])
+        cursors = [cursor for cursor in cursors if cursor[0] < len(cursor[1])]
+    return [(-neg_doc_id, score) for score, neg_doc_id in sorted(top, reverse=True)]
@@ -0,0 +1,365 @@
+import heapq
+import json
+import os
+import tempfile
+import threading
+import weakref
+from collections import Counter
+from itertools import groupby
+from operator import itemgetter
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+from postings_file import PostingsFile, PostingsFileWriter
+from ranking import DocLengths, doc_lengths_path
+from term_dictionary import TermDictionary, most_frequent_forms, terms_path
+from text_processing import TextProcessing
+
+MANIFEST = "manifest.json"
+TOMBSTONES = "deleted.bin"
+LENGTHS = "lengths.bin"
+
+
+def _write_atomic(path: Path, data: bytes) -> None:
+    tmp_path = path.with_suffix(path.suffix + ".tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def is_deleted(tombstones: bytes, doc_id: int) -> bool:
+    byte = doc_id >> 3
+    return byte < len(tombstones) and bool(tombstones[byte] & (1 << (doc_id & 7)))
+
+
+def _purge_tombstones(tombstones: bytes, purged: bytes) -> bytes:
+    """
+    :param tombstones: current deletion bitmap
+    :param purged: deletion bitmap of the docs that are no longer in any segment
+    :return: the tombstones without the purged docs, trailing zero bytes dropped so that no deletion is empty
+    """
+    remaining = bytes(byte & ~(purged[i] if i < len(purged) else 0) for i, byte in enumerate(tombstones))
+    return remaining.rstrip(b"\0")
+
+
+def _without_docs(doc_lengths: DocLengths, tombstones: bytes) -> Optional[DocLengths]:
+    """
+    :param doc_lengths:
+    :param tombstones: deletion bitmap
+    :return: a copy of doc_lengths where the deleted docs have no length, so that the number of docs and the average
+        doc length of BM25 only count the live ones. None when no deleted doc has a length
+    """
+    deleted = []
+    for byte, bits in enumerate(tombstones):
+        for bit in range(8) if bits else ():
+            doc_id = (byte << 3) + bit
+            if bits >> bit & 1 and doc_lengths[doc_id]:
+                deleted.append(doc_id)
+    if not deleted:
+        return None
+    doc_lengths = doc_lengths.copy()
+    doc_lengths.update((doc_id, 0) for doc_id in deleted)
+    return doc_lengths
+
+
+class _SegmentRefs:
+    def __init__(self):
+        """
+        number of snapshots using each segment: a segment replaced by a merge (or by another process' merge, see
+        refresh) is closed once the last snapshot using it is garbage collected, queries may still run on old
+        snapshots until then
+        """
+        self._counts = {}
+        # finalizers run in whichever thread drops the last reference, possibly while this one holds the lock
+        self._lock = threading.RLock()
+
+    def track(self, snapshot: "IndexSnapshot") -> "IndexSnapshot":
+        with self._lock:
+            for segment in snapshot.segments:
+                self._counts[id(segment)] = self._counts.get(id(segment), 0) + 1
+        weakref.finalize(snapshot, self._release, snapshot.segments)
+        return snapshot
+
+    def _release(self, segments: Tuple[PostingsFile, ...]) -> None:
+        with self._lock:
+            for segment in segments:
+                self._counts[id(segment)] -= 1
+                if not self._counts[id(segment)]:
+                    del self._counts[id(segment)]
+                    segment.close()
+
+
+class IndexSnapshot:
+    def __init__(self, segments: Tuple[PostingsFile, ...], tombstones: bytes, generation: int,
+                 doc_lengths: Optional[DocLengths] = None):
+        """
+        consistent, read-only view of a SegmentedIndex: the segments and deletions at the time it was taken.
+        it has the same query method as PostingsFile, so it can be passed to query_inverted_index
+        :param segments:
+        :param tombstones: deletion bitmap, bit doc_id is set for a deleted doc
+        :param generation:
+        :param doc_lengths: lengths of the docs of all segments
+        """
+        self.segments = segments
+        self.tombstones = tombstones
+        self.generation = generation
+        self.doc_lengths = doc_lengths or DocLengths()
+        self._term_dictionary = None
+
+    def __contains__(self, term: str) -> bool:
+        return any(term in segment for segment in self.segments)
+
+    def term_dictionary(self) -> TermDictionary:
+        """
+        the term dictionaries of the segments merged, built on the first call. the document frequencies still count
+        the deleted docs until the segments are merged
+        :return:
+        """
+        if self._term_dictionary is None:
+            self._term_dictionary = TermDictionary.merge(segment.term_dictionary() for segment in self.segments)
+        return self._term_dictionary
+
+    def query(self, term: str, positions: bool = True) -> Optional[Dict]:
+        """
+        the posting list of the term merged over all segments, without the deleted docs
+        :param term:
+        :param positions:
+        :return: posting dict as returned by mongo_db.query_db_index, None if the term is unknown
+        """
+        parts = [post_dict for post_dict in (segment.query(term, positions) for segment in self.segments) if post_dict]
+        if not parts:
+            return None
+        with_positions = all('positions' in post_dict for post_dict in parts)
+        entries = heapq.merge(*(zip(post_dict['doc_ids'], post_dict['positions']) if with_positions
+                                else ((doc_id, None) for doc_id in post_dict['doc_ids']) for post_dict in parts),
+                              key=itemgetter(0))
+        if self.tombstones:
+            entries = (entry for entry in entries if not is_deleted(self.tombstones, entry[0]))
+        entries = list(entries)
+        if not entries:
+            return None
+        post_dict = {'token': term, 'doc_ids': [doc_id for doc_id, _ in entries]}
+        if with_positions:
+            post_dict['positions'] = [doc_positions for _, doc_positions in entries]
+        return post_dict
+
+
+class SegmentedIndex:
+    def __init__(self, directory: Union[str, os.PathLike], analyzer: Optional[TextProcessing] = None,
+                 max_segments: int = 8):
+        """
+        incrementally updatable index made of immutable postings file segments:
+        - add_documents writes the new documents as a new segment
+        - delete_documents marks documents in a tombstone bitmap, they are purged at the next merge
+        - merge combines all segments into one, in the background when the index has more than max_segments segments
+        the state is kept in a directory with a manifest listing the segments. there must be a single writer process,
+        any number of reader processes pick up the changes of the writer (see refresh)
+        :param directory:
+        :param analyzer: TextProcessing used to tokenize added documents
+        :param max_segments:
+        """
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.analyzer = analyzer or TextProcessing.from_nltk()
+        self.max_segments = max_segments
+        self._lock = threading.Lock()
+        self._merge_lock = threading.Lock()
+        self._manifest_mtime = None
+        self._names = []
+        self._next_segment = 0
+        self._refs = _SegmentRefs()
+        self._snapshot = IndexSnapshot((), b"", 0)
+        self.refresh()
+
+    @property
+    def generation(self) -> int:
+        """
+        counter incremented by every change of the index, e.g. to invalidate cached results
+        :return:
+        """
+        return self._snapshot.generation
+
+    def refresh(self) -> None:
+        """
+        reload the manifest and the deletions if another process changed them
+        :return:
+        """
+        manifest_path = self.directory / MANIFEST
+        try:
+            mtime = manifest_path.stat().st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime == self._manifest_mtime:
+            return
+        with self._lock:
+            manifest = json.loads(manifest_path.read_text())
+            opened = {name: segment for name, segment in zip(self._names, self._snapshot.segments)}
+            try:
+                segments = tuple(opened[name] if name in opened else PostingsFile(self.directory / name)
+                                 for name in manifest["segments"])
+            except FileNotFoundError:
+                # the writer merged the segments away in the meantime, the next refresh sees its newer manifest
+                return
+            tombstones_path = self.directory / TOMBSTONES
+            tombstones = tombstones_path.read_bytes() if tombstones_path.exists() else b""
+            lengths_path = self.directory / LENGTHS
+            doc_lengths = DocLengths.load(lengths_path) if lengths_path.exists() else None
+            self._names = list(manifest["segments"])
+            self._next_segment = manifest["next_segment"]
+            self._snapshot = self._refs.track(IndexSnapshot(segments, tombstones, manifest["generation"],
+                                                            doc_lengths))
+            self._manifest_mtime = mtime
+
+    def snapshot(self) -> IndexSnapshot:
+        self.refresh()
+        return self._snapshot
+
+    def query(self, term: str, positions: bool = True) -> Optional[Dict]:
+        return self.snapshot().query(term, positions)
+
+    def _commit(self, names: List[str], segments: Tuple[PostingsFile, ...], tombstones: bytes,
+                doc_lengths: Optional[DocLengths] = None) -> None:
+        # callers hold self._lock. the tombstones and lengths are written before the manifest, whose change readers
+        # watch
+        generation = self._snapshot.generation + 1
+        if tombstones != self._snapshot.tombstones:
+            _write_atomic(self.directory / TOMBSTONES, tombstones)
+        if doc_lengths is None:
+            doc_lengths = self._snapshot.doc_lengths
+        else:
+            _write_atomic(self.directory / LENGTHS, doc_lengths.lengths.tobytes())
+        manifest = {"segments": names, "next_segment": self._next_segment, "generation": generation}
+        _write_atomic(self.directory / MANIFEST, json.dumps(manifest).encode("utf-8"))
+        self._manifest_mtime = (self.directory / MANIFEST).stat().st_mtime_ns
+        self._names = names
+        self._snapshot = self._refs.track(IndexSnapshot(segments, tombstones, generation, doc_lengths))
+
+    def _new_segment_path(self) -> Path:
+        with self._lock:
+            name = f"seg_{self._next_segment:06d}.idx"
+            self._next_segment += 1
+        return self.directory / name
+
+    def add_segment(self, path: Union[str, os.PathLike]) -> None:
+        """
+        add an existing postings file (e.g. written by inverted_index.build_inverted_index_parallel) as a segment,
+        the file, its doc lengths and its terms file are moved into the index directory
+        :param path:
+        :return:
+        """
+        segment_path = self._new_segment_path()
+        if os.path.exists(terms_path(path)):
+            os.replace(terms_path(path), terms_path(segment_path))
+        os.replace(path, segment_path)
+        lens_path = doc_lengths_path(path)
+        segment = PostingsFile(segment_path)
+        with self._lock:
+            doc_lengths = None
+            if os.path.exists(lens_path):
+                doc_lengths = self._snapshot.doc_lengths.copy()
+                added = DocLengths.load(lens_path).lengths
+                doc_lengths.update((doc_id, length) for doc_id, length in enumerate(added) if length)
+                os.remove(lens_path)
+            self._commit(self._names + [segment_path.name], self._snapshot.segments + (segment,),
+                         self._snapshot.tombstones, doc_lengths)
+
+    def add_documents(self, wapo_docs: Iterable) -> None:
+        """
+        tokenize the documents and make them searchable as a new segment
+        :param wapo_docs: documents whose ids are not in the index yet
+        :return:
+        """
+        postings = {}
+        doc_lengths = DocLengths()
+        form_counts = Counter()
+        for doc in wapo_docs:
+            tokens = self.analyzer.get_normalized_positions(doc['title'], doc['content_str'], form_counts)
+            doc_lengths.update([(doc['id'], sum(len(positions) for positions in tokens.values()))])
+            for token, positions in tokens.items():
+                postings.setdefault(token, []).append((doc['id'], positions))
+        if not postings:
+            return
+        fd, segment_path = tempfile.mkstemp(suffix=".idx.tmp", dir=self.directory)
+        os.close(fd)
+        terms = sorted(postings)
+        with PostingsFileWriter(segment_path) as writer:
+            for token in terms:
+                entries = sorted(postings[token], key=itemgetter(0))
+                writer.add(token, [doc_id for doc_id, _ in entries], [positions for _, positions in entries])
+        doc_lengths.save(doc_lengths_path(segment_path))
+        forms = most_frequent_forms(form_counts)
+        TermDictionary(terms, [len(postings[term]) for term in terms],
+                       [forms.get(term, "") for term in terms]).save(terms_path(segment_path))
+        self.add_segment(segment_path)
+
+    def delete_documents(self, doc_ids: Iterable[int]) -> None:
+        """
+        mark the documents as deleted, they disappear from the query results and from the doc lengths immediately
+        :param doc_ids:
+        :return:
+        """
+        with self._lock:
+            tombstones = bytearray(self._snapshot.tombstones)
+            for doc_id in doc_ids:
+                byte = doc_id >> 3
+                if byte >= len(tombstones):
+                    tombstones.extend(bytes(byte + 1 - len(tombstones)))
+                tombstones[byte] |= 1 << (doc_id & 7)
+            self._commit(self._names, self._snapshot.segments, bytes(tombstones),
+                         _without_docs(self._snapshot.doc_lengths, bytes(tombstones)))
+
+    def merge(self) -> None:
+        """
+        merge the current segments into a single one without the deleted documents, whose tombstones are cleared.
+        queries keep using the old segments until the merged one is committed, the old files are closed once no
+        snapshot uses them; segments added in the meantime are kept as they are
+        :return:
+        """
+        with self._merge_lock:
+            with self._lock:
+                snapshot = self._snapshot
+                names = list(self._names)
+            if len(names) < 2 and not snapshot.tombstones:
+                return
+            segment_path = self._new_segment_path()
+            terms = heapq.merge(*(segment.terms() for segment in snapshot.segments))
+            dictionary = snapshot.term_dictionary()
+            merged_terms = []
+            dfs = []
+            with PostingsFileWriter(segment_path) as writer:
+                for term, _ in groupby(terms):
+                    post_dict = snapshot.query(term)
+                    if post_dict:
+                        writer.add(term, post_dict['doc_ids'], post_dict.get('positions'))
+                        merged_terms.append(term)
+                        dfs.append(len(post_dict['doc_ids']))
+            TermDictionary(merged_terms, dfs,
+                           [dictionary.form(term) for term in merged_terms]).save(terms_path(segment_path))
+            with self._lock:
+                merged = PostingsFile(segment_path)
+                # docs deleted during the merge are still in the merged segment and keep their tombstones. the lengths
+                # of the purged docs are dropped too, an index written by an older version still has them
+                self._commit([segment_path.name] + self._names[len(names):],
+                             (merged,) + self._snapshot.segments[len(names):],
+                             _purge_tombstones(self._snapshot.tombstones, snapshot.tombstones),
+                             _without_docs(self._snapshot.doc_lengths, snapshot.tombstones))
+            # open snapshots still map the old files, unlinking them is safe
+            for name in names:
+                os.remove(self.directory / name)
+                if os.path.exists(terms_path(self.directory / name)):
+                    os.remove(terms_path(self.directory / name))
+
+    def maybe_merge(self, background: bool = True) -> None:
+        """
+        merge the segments if there are more than max_segments of them
+        :param background: merge on a daemon thread instead of blocking the caller
+        :return:
+        """
+        if len(self._names) <= self.max_segments or self._merge_lock.locked():
+            return
+        if background:
+            threading.Thread(target=self.merge, daemon=True).start()
+        else:
+            self.merge()
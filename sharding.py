@@ -0,0 +1,425 @@
+import argparse
+import heapq
+import json
+import multiprocessing
+import os
+import socket
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from itertools import groupby
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Connection, Listener, answer_challenge, deliver_challenge
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+from inverted_index import build_inverted_index_parallel, analyzer_index_path, expand_wildcards, fetch_postings, \
+    prune_unknown, evaluate, positive_terms, stopwords_in_query, wildcard_patterns, phrase_terms, ANALYZERS, \
+    DEFAULT_ANALYZER
+from postings_file import PostingsFile
+from query_parser import parse_query
+from ranking import bm25_top_k
+from term_dictionary import MAX_EXPANSIONS
+
+# document partitioned index: the documents are split by ranges of doc ids into shards, each one a postings file (per
+# analyzer) served by its own process, possibly on another machine. a coordinator sends every query to all shards at
+# once and merges their results:
+#   python hw3.py --build --shard-dir shards --shards 4
+#   python sharding.py shards 0 --port 7000 & ... & python sharding.py shards 3 --port 7003 &
+#   BRS_SHARDS=localhost:7000,localhost:7001,localhost:7002,localhost:7003 gunicorn -w 4 hw3:app
+# the shard servers and the coordinator authenticate each other with the shared secret BRS_SHARD_AUTHKEY, which has
+# no default: anyone who can reach a shard and knows the key can send it pickles. the local shards of
+# start_local_shards use a random key of the process instead
+MANIFEST = "shards.json"
+AUTHKEY = os.environ["BRS_SHARD_AUTHKEY"].encode() if os.environ.get("BRS_SHARD_AUTHKEY") else None
+_LOCAL_AUTHKEY = os.urandom(32)
+# a query is answered with the results of the shards that replied within this many seconds
+SHARD_TIMEOUT = float(os.environ.get("BRS_SHARD_TIMEOUT", 1.0))
+
+
+def build_shards(wapo_docs: Iterable, directory: Union[str, os.PathLike], num_docs: int, num_shards: int,
+                 workers: Optional[int] = None, analyzers: Iterable[str] = (DEFAULT_ANALYZER,)) -> List[Dict]:
+    """
+    build the index of each doc id range [start, end) in its own postings file, with build_inverted_index_parallel.
+    the docs of a shard are numbered from 0 in its index, so that its doc lengths and bitmaps only span its own range;
+    the shard server adds start back to the doc ids it returns
+    :param wapo_docs: WAPO docs iterator in id order (utils.load_wapo(...))
+    :param directory:
+    :param num_docs: number of docs, to split the ids into num_shards ranges of the same size
+    :param num_shards:
+    :param workers: see build_inverted_index_parallel
+    :param analyzers: see build_inverted_index_parallel
+    :return: the shards of the manifest: index file name, start and end doc id
+    """
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    shard_size = max(-(-num_docs // num_shards), 1)
+    shards = []
+    for shard_id, docs in groupby(wapo_docs, key=lambda doc: doc['id'] // shard_size):
+        start = shard_id * shard_size
+        name = f"shard_{shard_id:03d}.idx"
+        build_inverted_index_parallel((dict(doc, id=doc['id'] - start) for doc in docs), workers=workers,
+                                      index_file=str(directory / name), analyzers=analyzers)
+        shards.append({"index": name, "start": start, "end": start + shard_size})
+    (directory / MANIFEST).write_text(json.dumps({"shards": shards, "analyzers": list(analyzers)}, indent=1))
+    return shards
+
+
+def read_manifest(directory: Union[str, os.PathLike]) -> List[Dict]:
+    return json.loads((Path(directory) / MANIFEST).read_text())["shards"]
+
+
+class ShardServer:
+    def __init__(self, directory: Union[str, os.PathLike], shard_id: int):
+        """
+        answers the queries of a coordinator over one shard of a build_shards index, with the indexes of all the
+        analyzers built for it
+        :param directory:
+        :param shard_id: position of the shard in the manifest
+        """
+        shard = read_manifest(directory)[shard_id]
+        self.start = shard["start"]
+        path = str(Path(directory) / shard["index"])
+        self.indexes = {name: PostingsFile(analyzer_index_path(path, name)) for name in ANALYZERS
+                        if os.path.exists(analyzer_index_path(path, name))}
+
+    def stats(self, terms: List[str], analyzer: str) -> Tuple[int, int, Dict[str, int]]:
+        """
+        :param terms:
+        :param analyzer:
+        :return: number of docs, total doc length and document frequency of the terms in the shard
+        """
+        index = self.indexes[analyzer]
+        doc_lengths = index.doc_lengths
+        return len(doc_lengths), doc_lengths.total, {term: index.df(term) for term in terms}
+
+    def expand(self, patterns: List[str], analyzer: str, limit: int) -> Dict[str, List[Tuple[str, int]]]:
+        """
+        :param patterns: wildcard patterns
+        :param analyzer:
+        :param limit: most terms per pattern
+        :return: pattern -> the most frequent matching terms of the shard with their document frequency
+        """
+        index = self.indexes[analyzer]
+        return {pattern: [(term, index.df(term)) for term in index.term_dictionary().expand(pattern, limit)]
+                for pattern in patterns}
+
+    def match(self, query: str, analyzer: str, unknown: Iterable[str],
+              expansions: Optional[Dict[str, List[str]]] = None) -> List[int]:
+        """
+        boolean query over the shard, see query_inverted_index
+        :param query:
+        :param analyzer:
+        :param unknown: the terms missing from every shard. they are ignored like by a single index, the terms that
+            are only missing from this shard match nothing instead
+        :param expansions: terms of the wildcards of the query, chosen by the coordinator so that every shard
+            expands them alike
+        :return: ascending doc ids
+        """
+        index = self.indexes[analyzer]
+        node = expand_wildcards(parse_query(query, ANALYZERS[analyzer]), expansions or {})
+        if node is None:
+            return []
+        terms = node.terms()
+        postings = fetch_postings(terms, index, analyzer, positions=phrase_terms(node))
+        unknown = set(unknown)
+        for term in terms:
+            if term not in postings and term not in unknown:
+                postings[term] = {'token': term, 'doc_ids': [], 'positions': []}
+        node = prune_unknown(node, postings)
+        return [doc_id + self.start for doc_id in evaluate(node, postings)] if node is not None else []
+
+    def rank(self, query: str, k: int, analyzer: str, collection_stats: Tuple[int, float, Dict[str, int]],
+             expansions: Optional[Dict[str, List[str]]] = None) -> List[Tuple[int, float]]:
+        """
+        top k documents of the shard, scored with the statistics of the whole collection so that the scores of all
+        shards can be compared
+        :param query:
+        :param k:
+        :param analyzer:
+        :param collection_stats: see ranking.bm25_top_k
+        :param expansions: see match
+        :return:
+        """
+        index = self.indexes[analyzer]
+        terms = positive_terms(expand_wildcards(parse_query(query, ANALYZERS[analyzer]), expansions or {}))
+        postings = fetch_postings(terms, index, analyzer, positions=terms)
+        return [(doc_id + self.start, score)
+                for doc_id, score in bm25_top_k(postings, index.doc_lengths, k, collection_stats=collection_stats)]
+
+    def handle(self, request: Tuple):
+        method, *args = request
+        if method not in ("stats", "expand", "match", "rank"):
+            raise ValueError(f"unknown method {method!r}")
+        return getattr(self, method)(*args)
+
+    def serve(self, listener: Listener) -> None:
+        """
+        answer the requests of every connection in its own thread, until the process is stopped
+        :param listener:
+        :return:
+        """
+        while True:
+            try:
+                conn = listener.accept()
+            except (EOFError, OSError, AuthenticationError):
+                # the client went away or failed the authentication, e.g. a coordinator that gave up on a slow shard
+                continue
+            threading.Thread(target=self._serve_connection, args=(conn,), daemon=True).start()
+
+    def _serve_connection(self, conn) -> None:
+        with conn:
+            while True:
+                try:
+                    request = conn.recv()
+                except (EOFError, OSError):
+                    return
+                try:
+                    response = ("ok", self.handle(request))
+                except Exception as e:
+                    response = ("error", repr(e))
+                try:
+                    conn.send(response)
+                except OSError:
+                    # the coordinator timed out and closed the connection
+                    return
+
+
+def serve_shard(directory: Union[str, os.PathLike], shard_id: int, address: Tuple[str, int] = ("localhost", 0),
+                ready=None, authkey: Optional[bytes] = None) -> None:
+    """
+    run a shard server, the target of a shard process
+    :param directory:
+    :param shard_id:
+    :param address: (host, port) to listen on, port 0 for any free port
+    :param ready: connection the listening address is sent to once the server accepts connections
+    :param authkey: shared secret of the coordinator, BRS_SHARD_AUTHKEY by default
+    :return:
+    """
+    authkey = authkey or AUTHKEY
+    if not authkey:
+        raise ValueError("set BRS_SHARD_AUTHKEY to the secret shared by the shard servers and the coordinator")
+    server = ShardServer(directory, shard_id)
+    with Listener(address, authkey=authkey) as listener:
+        if ready is not None:
+            ready.send(listener.address)
+        server.serve(listener)
+
+
+def start_local_shards(directory: Union[str, os.PathLike]) -> Tuple[List[multiprocessing.Process], List[Tuple]]:
+    """
+    one shard server process per shard on this machine, standing in for the nodes of a cluster
+    :param directory:
+    :return: the processes and their addresses, in shard order
+    """
+    processes = []
+    addresses = []
+    for shard_id in range(len(read_manifest(directory))):
+        receiver, sender = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.Process(target=serve_shard, args=(directory, shard_id),
+                                          kwargs={"ready": sender, "authkey": AUTHKEY or _LOCAL_AUTHKEY}, daemon=True)
+        process.start()
+        processes.append(process)
+        addresses.append(receiver.recv())
+    return processes, addresses
+
+
+class ShardCoordinator:
+    def __init__(self, addresses: List[Tuple[str, int]], timeout: float = SHARD_TIMEOUT,
+                 authkey: Optional[bytes] = None):
+        """
+        scatter-gather execution of the queries over shard servers. every request is sent to all shards in parallel
+        and the coordinator waits for at most timeout seconds: the shards that did not answer by then, or failed,
+        are left out of the results, which are flagged as partial
+        :param addresses: (host, port) of the shard servers
+        :param timeout: seconds
+        :param authkey: shared secret of the shard servers, BRS_SHARD_AUTHKEY by default, or the key of the shards
+            of start_local_shards when it is not set
+        """
+        self.addresses = list(addresses)
+        self.timeout = timeout
+        self.authkey = authkey or AUTHKEY or _LOCAL_AUTHKEY
+        self._idle = [[] for _ in self.addresses]
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=4 * len(self.addresses), thread_name_prefix="shard")
+
+    @classmethod
+    def from_env(cls, shards: str) -> "ShardCoordinator":
+        """
+        :param shards: comma separated host:port of the shard servers, e.g. the BRS_SHARDS environment variable
+        :return:
+        """
+        if not AUTHKEY:
+            raise ValueError("set BRS_SHARD_AUTHKEY to the secret shared by the shard servers and the coordinator")
+        addresses = []
+        for shard in shards.split(","):
+            host, port = shard.strip().rsplit(":", 1)
+            addresses.append((host, int(port)))
+        return cls(addresses)
+
+    def _connect(self, shard_id: int, deadline: float) -> Connection:
+        """
+        multiprocessing.connection.Client with timeouts: connecting gives up at the deadline, and every blocking
+        send and receive of the socket (the authentication included) after timeout seconds, so that a stalled shard
+        never holds a thread of the pool for long
+        :param shard_id:
+        :param deadline: time.monotonic() time
+        :return:
+        """
+        sock = socket.create_connection(self.addresses[shard_id], timeout=max(deadline - time.monotonic(), 0.001))
+        try:
+            sock.setblocking(True)
+            seconds = max(self.timeout, 0.001)
+            timeval = struct.pack("ll", int(seconds), int(seconds % 1 * 1000000))
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVTIMEO, timeval)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDTIMEO, timeval)
+            conn = Connection(sock.detach())
+        finally:
+            sock.close()
+        try:
+            answer_challenge(conn, self.authkey)
+            deliver_challenge(conn, self.authkey)
+        except BaseException:
+            conn.close()
+            raise
+        return conn
+
+    def _call(self, shard_id: int, request: Tuple, deadline: float):
+        # connections are reused, a connection that failed or timed out is dropped: a late answer would otherwise be
+        # read as the answer of the next request
+        with self._lock:
+            conn = self._idle[shard_id].pop() if self._idle[shard_id] else None
+        try:
+            if conn is None:
+                conn = self._connect(shard_id, deadline)
+            conn.send(request)
+            if not conn.poll(max(deadline - time.monotonic(), 0)):
+                raise TimeoutError(f"shard {shard_id} did not answer in time")
+            status, response = conn.recv()
+        except BaseException:
+            if conn is not None:
+                conn.close()
+            raise
+        with self._lock:
+            self._idle[shard_id].append(conn)
+        if status != "ok":
+            raise RuntimeError(f"shard {shard_id}: {response}")
+        return response
+
+    def scatter(self, requests: Dict[int, Tuple]) -> Tuple[Dict[int, object], bool]:
+        """
+        send the requests to their shard in parallel. the calls give up at the same deadline as the wait, so the
+        threads of the shards that did not answer are free for the next requests
+        :param requests: shard id -> request
+        :return: shard id -> response of the shards that answered in time, whether a shard is missing
+        """
+        deadline = time.monotonic() + self.timeout
+        futures = {self._executor.submit(self._call, shard_id, request, deadline): shard_id
+                   for shard_id, request in requests.items()}
+        done, _ = wait(futures, timeout=self.timeout)
+        responses = {futures[future]: future.result() for future in done if future.exception() is None}
+        return responses, len(responses) < len(requests)
+
+    def stats(self, terms: List[str],
+              analyzer: str) -> Tuple[Dict[int, Tuple], Tuple[int, float, Dict[str, int]], bool]:
+        """
+        :param terms:
+        :param analyzer:
+        :return: the statistics of each shard that answered, the collection statistics summed over them (see
+            ranking.bm25_top_k), whether a shard is missing
+        """
+        responses, partial = self.scatter({shard_id: ("stats", terms, analyzer)
+                                           for shard_id in range(len(self.addresses))})
+        num_docs = sum(num_shard_docs for num_shard_docs, _, _ in responses.values())
+        total = sum(shard_total for _, shard_total, _ in responses.values())
+        dfs = {term: sum(shard_dfs[term] for _, _, shard_dfs in responses.values()) for term in terms}
+        return responses, (num_docs, total / num_docs if num_docs else 0.0, dfs), partial
+
+    def expand(self, node, analyzer: str, limit: int = MAX_EXPANSIONS) -> Tuple[Dict[str, List[str]], bool]:
+        """
+        sharded inverted_index.wildcard_expansions: every shard sends its most frequent terms matching the wildcards
+        of the query and the most frequent of them over the shards that answered are kept
+        :param node:
+        :param analyzer:
+        :param limit:
+        :return: pattern -> terms, whether a shard is missing
+        """
+        patterns = sorted(wildcard_patterns(node))
+        if not patterns:
+            return {}, False
+        responses, partial = self.scatter({shard_id: ("expand", patterns, analyzer, limit)
+                                           for shard_id in range(len(self.addresses))})
+        expansions = {}
+        for pattern in patterns:
+            dfs = {}
+            for shard_terms in responses.values():
+                for term, df in shard_terms[pattern]:
+                    dfs[term] = dfs.get(term, 0) + df
+            expansions[pattern] = sorted(heapq.nsmallest(limit, dfs, key=lambda term: (-dfs[term], term)))
+        return expansions, partial
+
+    def query(self, query: str, analyzer: str = DEFAULT_ANALYZER) -> Tuple[List[int], List[str], List[str], bool]:
+        """
+        sharded query_inverted_index. the wildcards are expanded and the terms are looked up in every shard to know
+        the ones missing from the whole collection, then the shards evaluate the query
+        :param query:
+        :param analyzer:
+        :return: matched ids, stop words, unknown words as query_inverted_index, and whether shards are missing
+        """
+        sw_in_query = stopwords_in_query(query, analyzer)
+        parsed = parse_query(query, ANALYZERS[analyzer])
+        expansions, expand_partial = self.expand(parsed, analyzer)
+        node = expand_wildcards(parsed, expansions)
+        unknown_words = [pattern for pattern, terms in expansions.items() if not terms]
+        if node is None:
+            return [-1], sw_in_query, unknown_words, expand_partial
+        terms = sorted(node.terms())
+        responses, (_, _, dfs), partial = self.stats(terms, analyzer)
+        unknown_words += [term for term in terms if not dfs[term]]
+        results, missing = self.scatter({shard_id: ("match", query, analyzer, unknown_words, expansions)
+                                         for shard_id in responses})
+        matched_ids = list(heapq.merge(*results.values()))
+        return matched_ids or [-1], sw_in_query, unknown_words, expand_partial or partial or missing
+
+    def rank(self, query: str, k: int,
+             analyzer: str = DEFAULT_ANALYZER) -> Tuple[List[Tuple[int, float]], List[str], List[str], bool]:
+        """
+        sharded rank_inverted_index: each shard ranks its documents with the collection statistics and the top k of
+        all shards are merged
+        :param query:
+        :param k:
+        :param analyzer:
+        :return: (doc id, score) pairs, stop words, unknown words as rank_inverted_index, and whether shards are
+            missing
+        """
+        sw_in_query = stopwords_in_query(query, analyzer)
+        node = parse_query(query, ANALYZERS[analyzer])
+        expansions, expand_partial = self.expand(node, analyzer)
+        terms = sorted(positive_terms(expand_wildcards(node, expansions)))
+        responses, collection_stats, partial = self.stats(terms, analyzer)
+        unknown_words = [pattern for pattern, expanded in expansions.items() if not expanded]
+        unknown_words += [term for term in terms if not collection_stats[2][term]]
+        results, missing = self.scatter({shard_id: ("rank", query, k, analyzer, collection_stats, expansions)
+                                         for shard_id in responses})
+        top = heapq.nlargest(k, (hit for hits in results.values() for hit in hits), key=lambda hit: (hit[1], -hit[0]))
+        return top, sw_in_query, unknown_words, expand_partial or partial or missing
+
+    def close(self) -> None:
+        # the running calls end by their deadline
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        with self._lock:
+            for idle in self._idle:
+                for conn in idle:
+                    conn.close()
+                idle.clear()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="serve a shard of an index built with build_shards")
+    parser.add_argument("directory", type=str)
+    parser.add_argument("shard", type=int, help="position of the shard in the manifest")
+    parser.add_argument("--host", type=str, default="localhost")
+    parser.add_argument("--port", type=int, default=7000)
+    args = parser.parse_args()
+    serve_shard(args.directory, args.shard, (args.host, args.port))
@@ -0,0 +1,176 @@
+import mmap
+import os
+import struct
+import zlib
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple, Union
+
+from tokenization import RegexTokenizer
+
+# side store of what the results page shows of a document, written at ingestion (see mongo_db.insert_docs) so that
+# a page of results is rendered without reading the articles. two files:
+#   <path>       the records, appended one after the other:
+#                  RECORD_HEADER  lengths of the utf-8 title, author, date and snippet (u16 each), number of tokens
+#                                 (u16)
+#                  the four strings
+#                  TOKEN per indexed token of the snippet: character offset (u16) and length (u8) of the token in
+#                                 the snippet, crc32 of its normalized term (u32)
+#   <path>.idx   fixed-width entry per doc id at doc_id * ENTRY.size: offset (u64) and size (u32) of its record,
+#                size 0 for a doc that is not stored
+# a record takes a few hundred bytes, the highlighting of the query terms comes from the stored term hashes instead of
+# re-tokenizing the snippet
+RECORD_HEADER = struct.Struct("<HHHHH")
+TOKEN = struct.Struct("<HBI")
+ENTRY = struct.Struct("<QI")
+SNIPPET_LEN = 150
+
+
+def index_path(path: Union[str, os.PathLike]) -> str:
+    return f"{path}.idx"
+
+
+def term_hash(term: str) -> int:
+    return zlib.crc32(term.encode("utf-8"))
+
+
+def _encode(text: Optional[str], max_bytes: int = 0xFFFF) -> bytes:
+    return (text or "").encode("utf-8")[:max_bytes]
+
+
+class SnippetStoreWriter:
+    def __init__(self, path: Union[str, os.PathLike], analyzer, snippet_len: int = SNIPPET_LEN):
+        """
+        appends the records of documents to a snippet store, creating it if needed. a document that is written
+        again (e.g. when an ingestion is resumed) gets a new record, the entry of its id points to the last one
+        :param path:
+        :param analyzer: TextProcessing whose normalize gives the terms of the snippet tokens, the analyzer the
+            queries are highlighted with
+        :param snippet_len: number of characters of the snippet, the beginning of content_str
+        """
+        self.path = path
+        self.analyzer = analyzer
+        self.snippet_len = snippet_len
+        self.tokenizer = RegexTokenizer()
+        self._data = open(path, "ab")
+        self._index = open(index_path(path), "r+b" if os.path.exists(index_path(path)) else "w+b")
+
+    def add(self, doc: Dict) -> None:
+        snippet = (doc['content_str'] or "")[:self.snippet_len]
+        tokens = []
+        for start, end in self.tokenizer.span_tokenize(snippet):
+            term = self.analyzer.normalize(snippet[start:end])
+            if term and end - start <= 0xFF:
+                tokens.append(TOKEN.pack(start, end - start, term_hash(term)))
+        fields = [_encode(doc['title']), _encode(doc.get('author')), _encode(str(doc.get('published_date') or "")),
+                  _encode(snippet)]
+        record = RECORD_HEADER.pack(*(len(field) for field in fields), len(tokens)) + b"".join(fields) + \
+            b"".join(tokens)
+        offset = self._data.tell()
+        self._data.write(record)
+        self._index.seek(doc['id'] * ENTRY.size)
+        self._index.write(ENTRY.pack(offset, len(record)))
+
+    def add_all(self, docs: Iterable[Dict]) -> Iterator[Dict]:
+        """
+        write the documents while passing them through, to build the store in the same pass as another consumer:
+        insert_docs(writer.add_all(load_wapo(...)))
+        :param docs:
+        :return:
+        """
+        for doc in docs:
+            self.add(doc)
+            yield doc
+
+    def close(self) -> None:
+        self._data.close()
+        self._index.close()
+
+    def __enter__(self) -> "SnippetStoreWriter":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+class SnippetStore:
+    def __init__(self, path: Union[str, os.PathLike]):
+        """
+        read-only, memory-mapped view of a snippet store. a record is found from its doc id with one fixed offset
+        read of the .idx file, the documents written after the store was opened are reported as missing
+        :param path:
+        """
+        self.path = path
+        self._files = [open(path, "rb"), open(index_path(path), "rb")]
+        self._data, self._index = [mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size
+                                   else b"" for f in self._files]
+
+    def _record(self, doc_id: int) -> Optional[Tuple[List[str], List[Tuple[int, int, int]]]]:
+        entry_offset = doc_id * ENTRY.size
+        if doc_id < 0 or entry_offset + ENTRY.size > len(self._index):
+            return None
+        offset, size = ENTRY.unpack_from(self._index, entry_offset)
+        if not size or offset + size > len(self._data):
+            return None
+        *lengths, num_tokens = RECORD_HEADER.unpack_from(self._data, offset)
+        pos = offset + RECORD_HEADER.size
+        fields = []
+        for length in lengths:
+            fields.append(self._data[pos:pos + length].decode("utf-8", errors="ignore"))
+            pos += length
+        return fields, list(TOKEN.iter_unpack(self._data[pos:pos + num_tokens * TOKEN.size]))
+
+    def get(self, doc_id: int, terms: Iterable[str] = ()) -> Optional[Dict]:
+        """
+        the stored fields of a document
+        :param doc_id:
+        :param terms: normalized query terms to highlight in the snippet
+        :return: id, title, author, published_date, snippet, and the snippet split in (text, is a query term)
+            "highlighted" parts. None if the document is not stored
+        """
+        record = self._record(doc_id)
+        if record is None:
+            return None
+        (title, author, date, snippet), tokens = record
+        return {'id': doc_id, 'title': title, 'author': author, 'published_date': date, 'snippet': snippet,
+                'highlighted': highlight(snippet, tokens, {term_hash(term) for term in terms})}
+
+    def get_many(self, doc_ids: List[int], terms: Iterable[str] = ()) -> Dict[int, Dict]:
+        """
+        :param doc_ids:
+        :param terms: see get
+        :return: doc id -> stored fields, the documents that are not stored are left out
+        """
+        terms = list(terms)
+        docs = {}
+        for doc_id in doc_ids:
+            doc = self.get(doc_id, terms)
+            if doc is not None:
+                docs[doc_id] = doc
+        return docs
+
+    def close(self) -> None:
+        for view in (self._data, self._index):
+            if isinstance(view, mmap.mmap):
+                view.close()
+        for f in self._files:
+            f.close()
+
+
+def highlight(snippet: str, tokens: List[Tuple[int, int, int]], hashes: Set[int]) -> List[Tuple[str, bool]]:
+    """
+    split the snippet around the tokens whose term is a query term
+    :param snippet:
+    :param tokens: (offset, length, term hash) of the snippet tokens
+    :param hashes: term_hash of the query terms
+    :return: (text, whether it is a query term) parts, in order
+    """
+    parts = []
+    pos = 0
+    for start, length, token_hash in tokens:
+        if token_hash in hashes:
+            if start > pos:
+                parts.append((snippet[pos:start], False))
+            parts.append((snippet[start:start + length], True))
+            pos = start + length
+    if pos < len(snippet) or not parts:
+        parts.append((snippet[pos:], False))
+    return parts
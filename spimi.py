@@ -0,0 +1,176 @@
+import heapq
+import os
+import pickle
+import tempfile
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from itertools import islice, groupby
+from operator import itemgetter
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from text_processing import TextProcessing
+from customized_text_processing import CustomizedTextProcessing
+
+# analyzers an index can be built with, by name
+ANALYZER_FACTORIES = {
+    "nltk": TextProcessing.from_nltk,
+    "custom": CustomizedTextProcessing.from_customized,
+}
+# one instance of each analyzer per worker process, created on first use so it is not pickled with every chunk
+_analyzers = {}
+
+
+def _get_analyzer(name: str = "nltk"):
+    if name not in _analyzers:
+        _analyzers[name] = ANALYZER_FACTORIES[name]()
+    return _analyzers[name]
+
+
+def write_run(postings: Dict[str, Tuple[List[int], List[List[int]]]], run_dir: str) -> str:
+    """
+    write one partial postings run to disk, sorted by token
+    each record is a pickled (token, doc_ids, positions) tuple
+    :param postings: token -> (ascending doc ids, positions of the token in each doc)
+    :param run_dir: directory to create the run file in
+    :return: path of the run file
+    """
+    fd, path = tempfile.mkstemp(suffix=".run", dir=run_dir)
+    with os.fdopen(fd, "wb") as f:
+        for token in sorted(postings):
+            doc_ids, positions = postings[token]
+            pickle.dump((token, doc_ids, positions), f, protocol=pickle.HIGHEST_PROTOCOL)
+    return path
+
+
+def read_run(path: str) -> Iterator[Tuple[str, List[int], List[List[int]]]]:
+    """
+    stream the (token, doc_ids, positions) records of a run file in token order
+    :param path:
+    :return:
+    """
+    with open(path, "rb") as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
+
+
+def index_chunk(docs: List[Dict], run_dir: str, max_postings: int,
+                analyzer_name: str = "nltk") -> Tuple[List[str], Dict[int, int], Counter]:
+    """
+    SPIMI inversion of one chunk of documents inside a worker process. postings are accumulated in a dictionary
+    and flushed to a sorted run file whenever more than max_postings token positions are held in memory
+    :param docs: documents in ascending id order
+    :param run_dir:
+    :param max_postings: memory cap of the in-memory dictionary
+    :param analyzer_name: key of ANALYZER_FACTORIES
+    :return: paths of the written run files, number of indexed tokens of each doc, occurrences of the surface forms
+        of the tokens (see TextProcessing.get_normalized_positions)
+    """
+    analyzer = _get_analyzer(analyzer_name)
+    runs = []
+    doc_lengths = {}
+    forms = Counter()
+    postings = {}
+    num_postings = 0
+    for doc in docs:
+        tokens = analyzer.get_normalized_positions(doc['title'], doc['content_str'], forms)
+        doc_lengths[doc['id']] = sum(len(positions) for positions in tokens.values())
+        for token, positions in tokens.items():
+            if token in postings:
+                postings[token][0].append(doc['id'])
+                postings[token][1].append(positions)
+            else:
+                postings[token] = ([doc['id']], [positions])
+            num_postings += len(positions)
+        # only flush between documents so that a document never spans two runs
+        if num_postings >= max_postings:
+            runs.append(write_run(postings, run_dir))
+            postings = {}
+            num_postings = 0
+    if postings:
+        runs.append(write_run(postings, run_dir))
+    return runs, doc_lengths, forms
+
+
+def merge_runs(paths: List[str]) -> Iterator[Tuple[str, List[int], List[List[int]]]]:
+    """
+    k-way merge of sorted run files, the postings of a token found in several runs are merged into one sorted list
+    :param paths:
+    :return: (token, doc_ids, positions) in token order
+    """
+    merged = heapq.merge(*(read_run(path) for path in paths), key=itemgetter(0))
+    for token, group in groupby(merged, key=itemgetter(0)):
+        group = list(group)
+        if len(group) == 1:
+            yield group[0]
+        else:
+            pairs = list(heapq.merge(*(zip(doc_ids, positions) for _, doc_ids, positions in group),
+                                     key=itemgetter(0)))
+            yield token, [doc_id for doc_id, _ in pairs], [positions for _, positions in pairs]
+
+
+def compact_runs(paths: List[str], run_dir: str, fan_in: int) -> List[str]:
+    """
+    merge groups of runs into bigger runs until at most fan_in runs are left, so that the final merge never keeps
+    more than fan_in files open
+    :param paths:
+    :param run_dir:
+    :param fan_in:
+    :return: remaining run paths
+    """
+    while len(paths) > fan_in:
+        next_paths = []
+        for i in range(0, len(paths), fan_in):
+            group = paths[i:i + fan_in]
+            fd, path = tempfile.mkstemp(suffix=".run", dir=run_dir)
+            with os.fdopen(fd, "wb") as f:
+                for record in merge_runs(group):
+                    pickle.dump(record, f, protocol=pickle.HIGHEST_PROTOCOL)
+            for old in group:
+                os.remove(old)
+            next_paths.append(path)
+        paths = next_paths
+    return paths
+
+
+def build_runs(wapo_docs: Iterable, run_dir: str, workers: Optional[int] = None, chunk_size: int = 1000,
+               max_postings: int = 2000000,
+               analyzers: Iterable[str] = ("nltk",)) -> Dict[str, Tuple[List[str], Dict[int, int], Counter]]:
+    """
+    split the documents into chunks and invert the chunks on a process pool. the documents are read once and every
+    chunk is sent to one task per analyzer, so the indexes of several analyzers are built side by side. at most two
+    tasks per worker are in flight at any time, so the parent never holds more than that many chunks in memory
+    :param wapo_docs: WAPO docs iterator (utils.load_wapo(...))
+    :param run_dir:
+    :param workers: number of worker processes, defaults to the number of cpus
+    :param chunk_size: number of documents sent to a worker at once
+    :param max_postings: memory cap of each worker, see index_chunk
+    :param analyzers: keys of ANALYZER_FACTORIES
+    :return: analyzer name -> (paths of all its run files, number of indexed tokens of each doc, occurrences of the
+        surface forms of the tokens)
+    """
+    workers = workers or os.cpu_count() or 1
+    analyzers = list(analyzers)
+    docs = iter(wapo_docs)
+    results = {name: ([], {}, Counter()) for name in analyzers}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = {}
+        while True:
+            while len(pending) < 2 * workers:
+                chunk = list(islice(docs, chunk_size))
+                if not chunk:
+                    break
+                for name in analyzers:
+                    pending[executor.submit(index_chunk, chunk, run_dir, max_postings, name)] = name
+            if not pending:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                runs, doc_lengths, forms = results[pending.pop(future)]
+                chunk_runs, chunk_lengths, chunk_forms = future.result()
+                runs.extend(chunk_runs)
+                doc_lengths.update(chunk_lengths)
+                forms.update(chunk_forms)
+    return results
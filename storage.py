@@ -0,0 +1,479 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from itertools import islice
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from postings_file import encode_postings, decode_postings, encode_positions, decode_positions
+
+DUPLICATE_KEY = 11000
+# maximum size of a mongo document
+MAX_BSON_SIZE = 16 * 1024 * 1024
+# size the positions of a token are split at in mongo, see split_positions
+POSITIONS_CHUNK_SIZE = int(os.environ.get("BRS_POSITIONS_CHUNK_SIZE", 4 * 1024 * 1024))
+# generation of each index collection, see set_index_generation
+INDEX_META = "index_meta"
+
+
+class Storage:
+    """
+    doc store and index store of the search engine. the documents are in "wapo_docs", the posting lists and the doc
+    lengths of each analyzer in their own collection (see inverted_index.index_collection). the module level
+    functions of mongo_db delegate to the configured storage (see get_storage)
+    """
+
+    def insert_docs(self, docs: Iterable, batch_size: int = 1000) -> None:
+        """
+        insert documents by batches, the documents that are already stored (when a crashed ingestion is resumed, see
+        mongo_db.resume_id) are skipped
+        :param docs: WAPO docs iterator (utils.load_wapo(...))
+        :param batch_size: number of documents per insert
+        :return:
+        """
+        docs = iter(docs)
+        num_docs = 0
+        start_t = time.perf_counter()
+        while True:
+            batch = list(islice(docs, batch_size))
+            if not batch:
+                break
+            self._insert_docs(batch)
+            num_docs += len(batch)
+        elapsed_t = time.perf_counter() - start_t
+        print(f"'insert_docs' inserted {num_docs} docs in {elapsed_t:0.2f} seconds "
+              f"({num_docs / elapsed_t if elapsed_t else 0:0.0f} docs/sec)")
+
+    def _insert_docs(self, batch: List[Dict]) -> None:
+        raise NotImplementedError
+
+    def has_docs(self) -> bool:
+        raise NotImplementedError
+
+    def next_doc_id(self) -> int:
+        """
+        id following the largest stored doc id, 0 if there is no document
+        :return:
+        """
+        raise NotImplementedError
+
+    def query_doc(self, doc_id: int) -> Optional[Dict]:
+        raise NotImplementedError
+
+    def query_docs(self, doc_ids: List[int], snippet_len: int = 150) -> List[Dict]:
+        """
+        the id, title and first snippet_len characters of content_str (as "snippet") of the documents
+        :param doc_ids:
+        :param snippet_len:
+        :return: the documents in the order of doc_ids
+        """
+        raise NotImplementedError
+
+    def insert_index(self, index_list: List[Dict], collection: str = "inverted_index") -> None:
+        """
+        :param index_list: posting lists in the format of
+            [{"token": "post", "doc_ids": [0, 3, 113, 444, ...], "positions": [[4, 17], [2], ...]}, {...}, ...]
+        :param collection:
+        :return:
+        :raise ValueError: when a posting list is too large for the storage (see split_positions)
+        """
+        raise NotImplementedError
+
+    def query_index_many(self, tokens: List[str], positions: bool = True,
+                         collection: str = "inverted_index") -> Dict[str, Dict]:
+        """
+        :param tokens:
+        :param positions: whether to load the positions of the tokens in each doc along with the doc ids
+        :param collection:
+        :return: token -> posting list, the unknown tokens are left out
+        """
+        raise NotImplementedError
+
+    def insert_doc_stats(self, doc_lengths: Dict[int, int], collection: str = "doc_stats") -> None:
+        raise NotImplementedError
+
+    def query_doc_stats(self, collection: str = "doc_stats") -> Dict[int, int]:
+        raise NotImplementedError
+
+    def drop_collection(self, collection: str) -> None:
+        """
+        drop an index or doc stats collection if it exists
+        :param collection:
+        :return:
+        """
+        raise NotImplementedError
+
+    def rename_collection(self, collection: str, new_name: str) -> None:
+        """
+        rename a collection, replacing the collection new_name if there is one: a build writes a new index next to
+        the one being queried and swaps it in once complete. a collection that was never written is an empty one,
+        new_name is then dropped
+        :param collection:
+        :param new_name:
+        :return:
+        """
+        raise NotImplementedError
+
+    def set_index_generation(self, collection: str, generation: str) -> None:
+        """
+        record that the index collection was (re)built: a new generation is stored by every build, so that the
+        processes serving queries can tell that what they cached of the collection is stale
+        :param collection: index collection
+        :param generation: id of the build
+        :return:
+        """
+        raise NotImplementedError
+
+    def query_index_generation(self, collection: str) -> Optional[str]:
+        """
+        :param collection:
+        :return: the generation stored by the last build of the index collection, None if it has none
+        """
+        raise NotImplementedError
+
+
+def positions_collection(collection: str) -> str:
+    """
+    mongo collection of the positions of an index collection: "inverted_index_positions", ...
+    :param collection:
+    :return:
+    """
+    return f"{collection}_positions"
+
+
+def _bson_array_size(values: List) -> int:
+    # size of a bson array of ints (or of the arrays of positions of split_positions): length, the type byte and the
+    # key (the decimal index) of each element, and the terminator
+    return 5 + sum(2 + len(str(i)) + (_bson_array_size(value) if isinstance(value, list) else
+                                      4 if -2 ** 31 <= value < 2 ** 31 else 8)
+                   for i, value in enumerate(values))
+
+
+def split_positions(index_list: List[Dict]) -> Tuple[List[Dict], List[Dict]]:
+    """
+    the positions of a frequent token don't fit in a mongo document along with its doc ids, so they are stored apart
+    in chunks of about POSITIONS_CHUNK_SIZE bytes: {"token": "post", "chunk": 0, "positions": [[4, 17], ...]}, ...
+    :param index_list: posting lists in the format of Storage.insert_index
+    :return: the posting lists without their positions, the chunks of positions
+    :raise ValueError: when the doc ids of a token don't fit in a mongo document
+    """
+    token_docs, chunks = [], []
+    for post_dict in index_list:
+        doc_ids = post_dict['doc_ids']
+        # an array of less than 10^7 ints takes at most 18 bytes per element
+        if len(doc_ids) * 18 > MAX_BSON_SIZE - 1024 and _bson_array_size(doc_ids) > MAX_BSON_SIZE - 1024:
+            raise ValueError(f"the posting list of {post_dict['token']!r} has {len(doc_ids)} doc ids, more than a "
+                             f"mongo document can hold, use the sqlite or file backend for this corpus")
+        token_docs.append({key: value for key, value in post_dict.items() if key != 'positions'})
+        if 'positions' not in post_dict:
+            continue
+        chunk, size, number = [], 0, 0
+        for positions in post_dict['positions']:
+            positions_size = 14 + len(positions) * 12
+            if chunk and size + positions_size > POSITIONS_CHUNK_SIZE:
+                chunks.append({'token': post_dict['token'], 'chunk': number, 'positions': chunk})
+                chunk, size, number = [], 0, number + 1
+            chunk.append(positions)
+            size += positions_size
+        chunks.append({'token': post_dict['token'], 'chunk': number, 'positions': chunk})
+    return token_docs, chunks
+
+
+def join_positions(post_dicts: Dict[str, Dict], chunks: Iterable[Dict]) -> Dict[str, Dict]:
+    """
+    put the chunks of positions of split_positions back into the posting lists of their token. the positions of a
+    posting list that doesn't get one list per doc id (the index is being swapped by a build) are left out
+    :param post_dicts: token -> posting list without positions
+    :param chunks:
+    :return: post_dicts
+    """
+    positions = {}
+    for chunk in sorted(chunks, key=lambda chunk: chunk['chunk']):
+        positions.setdefault(chunk['token'], []).extend(chunk['positions'])
+    for token, post_dict in post_dicts.items():
+        if token in positions and len(positions[token]) == len(post_dict['doc_ids']):
+            post_dict['positions'] = positions[token]
+    return post_dicts
+
+
+class MongoStorage(Storage):
+    def __init__(self, host: str = "localhost", port: int = 27017, name: str = "ir_2022_wapo", db=None):
+        """
+        storage in a mongodb database, one collection per store. the client connects on first use
+        :param host: host name or mongodb:// uri
+        :param port:
+        :param name: database name
+        :param db: database object to use instead of connecting, e.g. a mongomock database
+        """
+        self.host = host
+        self.port = port
+        self.name = name
+        self._db = db
+        self._lock = threading.Lock()
+
+    @property
+    def db(self):
+        if self._db is None:
+            with self._lock:
+                if self._db is None:
+                    import pymongo
+                    client = pymongo.MongoClient(self.host, self.port)  # connect to the mongodb server
+                    self._db = client[self.name]
+        return self._db
+
+    def insert_docs(self, docs: Iterable, batch_size: int = 1000) -> None:
+        import pymongo
+        self.db['wapo_docs'].create_index([('id', pymongo.ASCENDING)], unique=True)
+        super().insert_docs(docs, batch_size)
+
+    def _insert_docs(self, batch: List[Dict]) -> None:
+        from pymongo.errors import BulkWriteError
+        try:
+            self.db['wapo_docs'].insert_many(batch, ordered=False)
+        except BulkWriteError as e:
+            if any(error['code'] != DUPLICATE_KEY for error in e.details['writeErrors']):
+                raise
+
+    def has_docs(self) -> bool:
+        return "wapo_docs" in self.db.list_collection_names()
+
+    def next_doc_id(self) -> int:
+        import pymongo
+        last = self.db['wapo_docs'].find_one({}, {'id': 1}, sort=[('id', pymongo.DESCENDING)])
+        return 0 if last is None else last['id'] + 1
+
+    def query_doc(self, doc_id: int) -> Optional[Dict]:
+        return self.db["wapo_docs"].find_one({'id': doc_id})
+
+    def query_docs(self, doc_ids: List[int], snippet_len: int = 150) -> List[Dict]:
+        cursor = self.db["wapo_docs"].aggregate([
+            {'$match': {'id': {'$in': list(doc_ids)}}},
+            {'$project': {'_id': 0, 'id': 1, 'title': 1,
+                          'snippet': {'$substrCP': ['$content_str', 0, snippet_len]}}},
+        ])
+        docs = {doc['id']: doc for doc in cursor}
+        return [docs[doc_id] for doc_id in doc_ids if doc_id in docs]
+
+    def insert_index(self, index_list: List[Dict], collection: str = "inverted_index") -> None:
+        import pymongo
+        token_docs, chunks = split_positions(index_list)
+        db_index = self.db[collection]
+        db_index.create_index([('token', pymongo.ASCENDING)], unique=True)
+        db_index.insert_many(token_docs)
+        if chunks:
+            db_positions = self.db[positions_collection(collection)]
+            db_positions.create_index([('token', pymongo.ASCENDING), ('chunk', pymongo.ASCENDING)], unique=True)
+            db_positions.insert_many(chunks)
+
+    def query_index_many(self, tokens: List[str], positions: bool = True,
+                         collection: str = "inverted_index") -> Dict[str, Dict]:
+        post_dicts = {post_dict['token']: post_dict
+                      for post_dict in self.db[collection].find({'token': {'$in': list(tokens)}}, {'_id': 0})}
+        if positions and post_dicts:
+            join_positions(post_dicts, self.db[positions_collection(collection)].find(
+                {'token': {'$in': list(post_dicts)}}, {'_id': 0}))
+        return post_dicts
+
+    def insert_doc_stats(self, doc_lengths: Dict[int, int], collection: str = "doc_stats") -> None:
+        import pymongo
+        doc_stats = self.db[collection]
+        doc_stats.create_index([('id', pymongo.ASCENDING)], unique=True)
+        doc_stats.insert_many([{'id': doc_id, 'length': length} for doc_id, length in doc_lengths.items()])
+
+    def query_doc_stats(self, collection: str = "doc_stats") -> Dict[int, int]:
+        return {doc['id']: doc['length'] for doc in self.db[collection].find({}, {'_id': 0, 'id': 1, 'length': 1})}
+
+    def drop_collection(self, collection: str) -> None:
+        self.db.drop_collection(collection)
+        self.db.drop_collection(positions_collection(collection))
+
+    def rename_collection(self, collection: str, new_name: str) -> None:
+        # the positions of an index go along with it. a query in between gets doc ids and positions of different
+        # builds, join_positions then leaves the positions out
+        names = self.db.list_collection_names()
+        for source, target in ((positions_collection(collection), positions_collection(new_name)),
+                               (collection, new_name)):
+            if source in names:
+                self.db[source].rename(target, dropTarget=True)
+            else:
+                self.db.drop_collection(target)
+
+    def set_index_generation(self, collection: str, generation: str) -> None:
+        self.db[INDEX_META].replace_one({'collection': collection},
+                                        {'collection': collection, 'generation': generation}, upsert=True)
+
+    def query_index_generation(self, collection: str) -> Optional[str]:
+        meta = self.db[INDEX_META].find_one({'collection': collection}, {'_id': 0, 'generation': 1})
+        return meta['generation'] if meta else None
+
+
+def _quote(collection: str) -> str:
+    # sqlite identifier of the table of a collection
+    return '"' + collection.replace('"', '""') + '"'
+
+
+class SQLiteStorage(Storage):
+    # number of bound parameters of a query, below the limit of older sqlite versions
+    MAX_VARIABLES = 900
+
+    def __init__(self, path: str):
+        """
+        embedded storage in a single sqlite file, no server needed. the posting lists are stored compressed with
+        the encoding of postings_file, one row per token. each thread opens its own connection on first use, and the
+        database is in WAL mode so that readers are not blocked by a writer
+        :param path:
+        """
+        self.path = path
+        self._local = threading.local()
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect(self.path)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS wapo_docs (id INTEGER PRIMARY KEY, title TEXT, content_str TEXT, "
+                         "doc TEXT)")
+        return conn
+
+    def _index_table(self, collection: str) -> str:
+        table = _quote(collection)
+        self.conn.execute(f"CREATE TABLE IF NOT EXISTS {table} (token TEXT PRIMARY KEY, doc_ids BLOB, positions BLOB) "
+                          f"WITHOUT ROWID")
+        return table
+
+    def _stats_table(self, collection: str) -> str:
+        table = _quote(collection)
+        self.conn.execute(f"CREATE TABLE IF NOT EXISTS {table} (id INTEGER PRIMARY KEY, length INTEGER)")
+        return table
+
+    def _insert_docs(self, batch: List[Dict]) -> None:
+        with self.conn:
+            self.conn.executemany("INSERT OR IGNORE INTO wapo_docs VALUES (?, ?, ?, ?)",
+                                  [(doc['id'], doc['title'], doc['content_str'], json.dumps(doc, default=str))
+                                   for doc in batch])
+
+    def has_docs(self) -> bool:
+        return self.conn.execute("SELECT 1 FROM wapo_docs LIMIT 1").fetchone() is not None
+
+    def next_doc_id(self) -> int:
+        (last,) = self.conn.execute("SELECT max(id) FROM wapo_docs").fetchone()
+        return 0 if last is None else last + 1
+
+    def query_doc(self, doc_id: int) -> Optional[Dict]:
+        row = self.conn.execute("SELECT doc FROM wapo_docs WHERE id = ?", (doc_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def query_docs(self, doc_ids: List[int], snippet_len: int = 150) -> List[Dict]:
+        docs = {}
+        doc_ids = list(doc_ids)
+        for i in range(0, len(doc_ids), self.MAX_VARIABLES):
+            chunk = doc_ids[i:i + self.MAX_VARIABLES]
+            rows = self.conn.execute(f"SELECT id, title, substr(content_str, 1, ?) FROM wapo_docs "
+                                     f"WHERE id IN ({','.join('?' * len(chunk))})", [snippet_len] + chunk)
+            for doc_id, title, snippet in rows:
+                docs[doc_id] = {'id': doc_id, 'title': title, 'snippet': snippet}
+        return [docs[doc_id] for doc_id in doc_ids if doc_id in docs]
+
+    def insert_index(self, index_list: List[Dict], collection: str = "inverted_index") -> None:
+        table = self._index_table(collection)
+        with self.conn:
+            self.conn.executemany(f"INSERT INTO {table} VALUES (?, ?, ?)",
+                                  [(post_dict['token'], encode_postings(post_dict['doc_ids']),
+                                    encode_positions(post_dict['positions']) if 'positions' in post_dict else None)
+                                   for post_dict in index_list])
+
+    def query_index_many(self, tokens: List[str], positions: bool = True,
+                         collection: str = "inverted_index") -> Dict[str, Dict]:
+        table = self._index_table(collection)
+        columns = "token, doc_ids, positions" if positions else "token, doc_ids, NULL"
+        found = {}
+        tokens = list(tokens)
+        for i in range(0, len(tokens), self.MAX_VARIABLES):
+            chunk = tokens[i:i + self.MAX_VARIABLES]
+            rows = self.conn.execute(f"SELECT {columns} FROM {table} WHERE token IN ({','.join('?' * len(chunk))})",
+                                     chunk)
+            for token, doc_ids, token_positions in rows:
+                post_dict = {'token': token, 'doc_ids': decode_postings(doc_ids)}
+                if token_positions is not None:
+                    post_dict['positions'] = decode_positions(token_positions)
+                found[token] = post_dict
+        return found
+
+    def insert_doc_stats(self, doc_lengths: Dict[int, int], collection: str = "doc_stats") -> None:
+        table = self._stats_table(collection)
+        with self.conn:
+            self.conn.executemany(f"INSERT INTO {table} VALUES (?, ?)", doc_lengths.items())
+
+    def query_doc_stats(self, collection: str = "doc_stats") -> Dict[int, int]:
+        return dict(self.conn.execute(f"SELECT id, length FROM {self._stats_table(collection)}"))
+
+    def drop_collection(self, collection: str) -> None:
+        with self.conn:
+            self.conn.execute(f"DROP TABLE IF EXISTS {_quote(collection)}")
+
+    def rename_collection(self, collection: str, new_name: str) -> None:
+        # one transaction, so that readers never see the table missing (and recreate it empty, see _index_table)
+        conn = self.conn
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(f"DROP TABLE IF EXISTS {_quote(new_name)}")
+            if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (collection,)).fetchone():
+                conn.execute(f"ALTER TABLE {_quote(collection)} RENAME TO {_quote(new_name)}")
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+
+    def _meta_table(self) -> str:
+        self.conn.execute(f"CREATE TABLE IF NOT EXISTS {INDEX_META} (collection TEXT PRIMARY KEY, generation TEXT)")
+        return INDEX_META
+
+    def set_index_generation(self, collection: str, generation: str) -> None:
+        table = self._meta_table()
+        with self.conn:
+            self.conn.execute(f"INSERT OR REPLACE INTO {table} VALUES (?, ?)", (collection, generation))
+
+    def query_index_generation(self, collection: str) -> Optional[str]:
+        row = self.conn.execute(f"SELECT generation FROM {self._meta_table()} WHERE collection = ?",
+                                (collection,)).fetchone()
+        return row[0] if row else None
+
+
+def open_storage(url: str) -> Storage:
+    """
+    storage from its configuration string:
+    - "mongo" or a "mongodb://host:port" uri
+    - "sqlite:path/to/file.db"
+    :param url:
+    :return:
+    """
+    if url == "mongo":
+        return MongoStorage()
+    if url.startswith("mongodb://") or url.startswith("mongodb+srv://"):
+        return MongoStorage(url)
+    if url.startswith("sqlite:"):
+        return SQLiteStorage(url[len("sqlite:"):])
+    raise ValueError(f"unknown storage {url!r}, expected mongo, mongodb://... or sqlite:<path>")
+
+
+_storage: Optional[Storage] = None
+
+
+def get_storage() -> Storage:
+    """
+    the storage configured with the BRS_STORAGE environment variable (see open_storage), mongo on localhost by
+    default. nothing is connected before the first query
+    :return:
+    """
+    global _storage
+    if _storage is None:
+        _storage = open_storage(os.environ.get("BRS_STORAGE", "mongo"))
+    return _storage
+
+
+def set_storage(storage: Storage) -> None:
+    global _storage
+    _storage = storage
@@ -0,0 +1,287 @@
+import heapq
+import os
+import re
+import struct
+from array import array
+from bisect import bisect_left
+from collections import Counter
+from itertools import groupby
+from operator import itemgetter
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+# terms file, written next to the index (see terms_path):
+#   header       MAGIC, number of terms (u32), size of the blob in bytes (u32)
+#   dfs          document frequency of each term (u32)
+#   offsets      character offset of each term in the blob, plus the length of the blob (u32)
+#   form offsets character offset of the surface form of each term in the forms blob, plus its length (u32)
+#   blob         utf-8 sorted terms, each one followed by a newline
+#   forms blob   utf-8 most frequent surface form of each term, each one followed by a newline
+# the files of the first version have neither the blob size, the form offsets nor the forms
+MAGIC = b"BRSTRM02"
+HEADER = struct.Struct("<8sII")
+MAGIC_V1 = b"BRSTRM01"
+HEADER_V1 = struct.Struct("<8sI")
+# most terms a wildcard or prefix expands to, the most frequent ones are kept
+MAX_EXPANSIONS = int(os.environ.get("BRS_MAX_EXPANSIONS", 64))
+# largest edit distance of a spelling suggestion
+MAX_EDIT_DISTANCE = 2
+# the suggestions share this many leading characters with the misspelled word: first letters are rarely mistyped and
+# the walk only covers the terms starting with them
+SUGGEST_PREFIX_LENGTH = 1
+WILDCARDS = re.compile(r"[*?]")
+# sorts after any character a term can continue a prefix with
+_LAST_CHAR = "\U0010ffff"
+
+
+def terms_path(index_file: Union[str, os.PathLike]) -> str:
+    """
+    the term dictionary is written next to a postings file, in <index_file>.terms
+    :param index_file:
+    :return:
+    """
+    return f"{index_file}.terms"
+
+
+def is_wildcard(word: str) -> bool:
+    return WILDCARDS.search(word) is not None
+
+
+def most_frequent_forms(form_counts: Counter) -> Dict[str, str]:
+    """
+    :param form_counts: (term, surface form) -> number of occurrences, see TextProcessing.get_normalized_positions
+    :return: term -> its most frequent surface form
+    """
+    forms = {}
+    counts = {}
+    for (term, form), count in form_counts.items():
+        if count > counts.get(term, 0):
+            forms[term] = form
+            counts[term] = count
+    return forms
+
+
+def _lines(lines: Iterable[str]) -> Tuple[str, array]:
+    # the lines joined in one string, with the offset of each line and the length of the string
+    lines = list(lines)
+    offsets = array('I', [0])
+    pos = 0
+    for line in lines:
+        pos += len(line) + 1
+        offsets.append(pos)
+    return "".join(line + "\n" for line in lines), offsets
+
+
+class TermDictionary:
+    def __init__(self, terms: Iterable[str] = (), dfs: Optional[Iterable[int]] = None,
+                 forms: Optional[Iterable[str]] = None):
+        """
+        sorted in-memory dictionary of the terms of an index with their document frequency. the terms are kept in one
+        string, one per line, with an array of their offsets instead of one str object per term, so a term costs its
+        characters plus 8 bytes. every lookup starts with a binary search of the sorted terms: the terms with a
+        prefix are a range of the array, a wildcard pattern is matched by one regex over the lines of the range of
+        its literal prefix, and the spelling suggestions walk the sorted terms like a trie (see suggest)
+        :param terms: ascending terms
+        :param dfs: document frequency of each term, 0 when not given
+        :param forms: most frequent surface form of each term (see most_frequent_forms), to show a term to the user
+            as a word rather than as a stem. "" when unknown
+        """
+        terms = list(terms)
+        self._blob, self._offsets = _lines(terms)
+        self._dfs = array('I', dfs if dfs is not None else [0] * len(terms))
+        self._forms, self._form_offsets = _lines(forms if forms is not None else [""] * len(terms))
+        self._lcp = None
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i: int) -> str:
+        return self._blob[self._offsets[i]:self._offsets[i + 1] - 1]
+
+    def __contains__(self, term: str) -> bool:
+        i = bisect_left(self, term)
+        return i < len(self) and self[i] == term
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._blob.splitlines())
+
+    def items(self) -> Iterator[Tuple[str, int]]:
+        return zip(self, self._dfs)
+
+    def _form(self, i: int) -> str:
+        return self._forms[self._form_offsets[i]:self._form_offsets[i + 1] - 1]
+
+    def _entries(self) -> Iterator[Tuple[str, int, str]]:
+        # (term, df, surface form) of every term
+        return zip(self, self._dfs, (self._form(i) for i in range(len(self))))
+
+    def df(self, term: str) -> int:
+        i = bisect_left(self, term)
+        return self._dfs[i] if i < len(self) and self[i] == term else 0
+
+    def form(self, term: str) -> str:
+        """
+        :param term:
+        :return: the most frequent surface form of the term in the documents, "" when unknown
+        """
+        i = bisect_left(self, term)
+        return self._form(i) if i < len(self) and self[i] == term else ""
+
+    def prefix_range(self, prefix: str) -> Tuple[int, int]:
+        """
+        :param prefix:
+        :return: [start, end) range of the indexes of the terms starting with the prefix
+        """
+        start = bisect_left(self, prefix)
+        return start, bisect_left(self, prefix + _LAST_CHAR, start)
+
+    def _most_frequent(self, indexes: Iterable[int], limit: int) -> List[str]:
+        return [self[i] for i in heapq.nsmallest(limit, indexes, key=lambda i: (-self._dfs[i], i))]
+
+    def expand_prefix(self, prefix: str, limit: int = MAX_EXPANSIONS) -> List[str]:
+        """
+        :param prefix:
+        :param limit: most terms returned
+        :return: the most frequent terms starting with the prefix, by decreasing document frequency
+        """
+        return self._most_frequent(range(*self.prefix_range(prefix)), limit)
+
+    def expand(self, pattern: str, limit: int = MAX_EXPANSIONS) -> List[str]:
+        """
+        terms matching a wildcard pattern: * stands for any characters, ? for one character. only the range of the
+        literal prefix of the pattern is searched, a pattern starting with a wildcard scans the whole dictionary
+        :param pattern:
+        :param limit: most terms returned
+        :return: the most frequent matching terms, by decreasing document frequency
+        """
+        literal = WILDCARDS.split(pattern, 1)[0]
+        if pattern == literal + "*":
+            return self.expand_prefix(literal, limit)
+        lo, hi = self.prefix_range(literal)
+        # a line is a term followed by its newline, an empty match at the end of the blob is not a term
+        regex = re.compile("^" + "".join("[^\n]*" if c == "*" else "[^\n]" if c == "?" else re.escape(c)
+                                         for c in pattern) + "\n", re.MULTILINE)
+        indexes = (bisect_left(self._offsets, m.start(), lo, hi)
+                   for m in regex.finditer(self._blob, self._offsets[lo], self._offsets[hi]))
+        return self._most_frequent(indexes, limit)
+
+    def _common_prefixes(self) -> array:
+        # lcp[i] is the length of the common prefix of the terms i - 1 and i, capped at 255
+        if self._lcp is None:
+            lcp = array('B', [0] * len(self))
+            terms = self._blob.splitlines()
+            for i in range(1, len(terms)):
+                common = 0
+                for a, b in zip(terms[i - 1], terms[i]):
+                    if a != b:
+                        break
+                    common += 1
+                lcp[i] = min(common, 255)
+            self._lcp = lcp
+        return self._lcp
+
+    def suggest(self, word: str, max_distance: int = MAX_EDIT_DISTANCE, limit: int = 5,
+                prefix_length: int = SUGGEST_PREFIX_LENGTH) -> List[str]:
+        """
+        spelling suggestions: the terms within max_distance edits (Levenshtein distance) of the word that start with
+        its first prefix_length characters. the terms of that range are walked as a trie: the dynamic programming row
+        of each prefix is computed once for all the terms sharing it, and the terms under a prefix are skipped as soon
+        as every cell of its row exceeds max_distance. the common prefix lengths of the consecutive terms are
+        computed on the first call
+        :param word:
+        :param max_distance:
+        :param limit: most terms returned
+        :param prefix_length: number of leading characters assumed to be right
+        :return: the closest terms, the most frequent first among terms at the same distance
+        """
+        lcp = self._common_prefixes()
+        # rows[d] is the edit distance row of the first d characters of the last term walked
+        far = max_distance + 1
+        rows = [[min(j, far) for j in range(len(word) + 1)]]
+        matches = []
+        i, n = self.prefix_range(word[:prefix_length])
+        while i < n:
+            term = self[i]
+            del rows[min(lcp[i], len(rows) - 1) + 1:]
+            for depth in range(len(rows) - 1, len(term)):
+                char = term[depth]
+                above = rows[-1]
+                # only the cells within max_distance of the diagonal can be <= max_distance, the others stay at
+                # max_distance + 1
+                row = [far] * (len(word) + 1)
+                row[0] = min(depth + 1, far)
+                best = row[0]
+                for j in range(max(1, depth + 1 - max_distance), min(len(word), depth + 1 + max_distance) + 1):
+                    cell = min(row[j - 1] + 1, above[j] + 1, above[j - 1] + (word[j - 1] != char))
+                    row[j] = cell
+                    if cell < best:
+                        best = cell
+                rows.append(row)
+                if best > max_distance:
+                    # no term starting with term[:depth + 1] can get closer, they follow this one
+                    i += 1
+                    while i < n and lcp[i] > depth:
+                        i += 1
+                    break
+            else:
+                if rows[-1][-1] <= max_distance:
+                    matches.append((rows[-1][-1], -self._dfs[i], term))
+                i += 1
+        return [term for _, _, term in sorted(matches)[:limit]]
+
+    def save(self, path: Union[str, os.PathLike]) -> None:
+        blob = self._blob.encode("utf-8")
+        with open(path, "wb") as f:
+            f.write(HEADER.pack(MAGIC, len(self), len(blob)))
+            self._dfs.tofile(f)
+            self._offsets.tofile(f)
+            self._form_offsets.tofile(f)
+            f.write(blob)
+            f.write(self._forms.encode("utf-8"))
+
+    @classmethod
+    def load(cls, path: Union[str, os.PathLike]) -> "TermDictionary":
+        with open(path, "rb") as f:
+            data = f.read()
+        magic = data[:len(MAGIC)]
+        if magic == MAGIC:
+            _, num_terms, blob_size = HEADER.unpack_from(data, 0)
+            pos = HEADER.size
+        elif magic == MAGIC_V1:
+            _, num_terms = HEADER_V1.unpack_from(data, 0)
+            blob_size = None
+            pos = HEADER_V1.size
+        else:
+            raise ValueError(f"{path} is not a terms file")
+        dictionary = cls()
+        dictionary._dfs = array('I', data[pos:pos + 4 * num_terms])
+        pos += 4 * num_terms
+        dictionary._offsets = array('I', data[pos:pos + 4 * (num_terms + 1)])
+        pos += 4 * (num_terms + 1)
+        if blob_size is None:
+            dictionary._blob = data[pos:].decode("utf-8")
+            dictionary._forms, dictionary._form_offsets = _lines([""] * num_terms)
+            return dictionary
+        dictionary._form_offsets = array('I', data[pos:pos + 4 * (num_terms + 1)])
+        pos += 4 * (num_terms + 1)
+        dictionary._blob = data[pos:pos + blob_size].decode("utf-8")
+        dictionary._forms = data[pos + blob_size:].decode("utf-8")
+        return dictionary
+
+    @classmethod
+    def merge(cls, dictionaries: Iterable["TermDictionary"]) -> "TermDictionary":
+        """
+        union of dictionaries (e.g. of the segments of an index), the document frequencies of a term are summed. the
+        surface form of a term is the one of the dictionary where the term is the most frequent
+        :param dictionaries:
+        :return:
+        """
+        terms = []
+        dfs = []
+        forms = []
+        entries = heapq.merge(*(dictionary._entries() for dictionary in dictionaries), key=itemgetter(0))
+        for term, group in groupby(entries, key=itemgetter(0)):
+            group = list(group)
+            terms.append(term)
+            dfs.append(sum(df for _, df, _ in group))
+            forms.append(max((df, bool(form), form) for _, df, form in group)[2])
+        return cls(terms, dfs, forms)
@@ -0,0 +1,54 @@
+import json
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import inverted_index  # noqa: E402
+import storage  # noqa: E402
+
+BUILD = """
+import json, sys
+from inverted_index import build_inverted_index
+build_inverted_index(json.loads(sys.argv[1]))
+"""
+
+
+def build(tmp_path, docs):
+    # the builds run in another process, as the indexer does next to a running search app
+    env = dict(os.environ, BRS_STORAGE=f"sqlite:{tmp_path / 'index.db'}", BRS_TERMS_DIR=str(tmp_path))
+    subprocess.run([sys.executable, "-c", BUILD, json.dumps(docs)], cwd=ROOT, env=env, check=True)
+
+
+@pytest.fixture
+def query_process(tmp_path, monkeypatch):
+    monkeypatch.setattr(inverted_index, "INDEX_CHECK_INTERVAL", 0)
+    monkeypatch.setattr(inverted_index, "TERMS_DIR", str(tmp_path))
+    previous = storage.get_storage()
+    storage.set_storage(storage.SQLiteStorage(str(tmp_path / "index.db")))
+    for cache in (inverted_index._generations, inverted_index._mongo_doc_lengths,
+                  inverted_index._mongo_term_dictionaries):
+        cache.clear()
+    yield
+    storage.set_storage(previous)
+
+
+def test_rebuild_is_seen_by_a_query_process(tmp_path, query_process):
+    build(tmp_path, [{'id': 0, 'title': 'police court', 'content_str': 'budget'},
+                     {'id': 1, 'title': 'police', 'content_str': 'river'}])
+    assert inverted_index.query_inverted_index("police")[0] == [0, 1]
+    generation = inverted_index.index_generation()
+
+    build(tmp_path, [{'id': 5, 'title': 'police senate', 'content_str': 'school'},
+                     {'id': 6, 'title': 'senate', 'content_str': 'budget'},
+                     {'id': 7, 'title': 'river', 'content_str': 'county'}])
+    assert inverted_index.query_inverted_index("police")[0] == [5]
+    assert inverted_index.query_inverted_index("senate")[0] == [5, 6]
+    assert inverted_index.index_generation() != generation
+    assert len(inverted_index.get_doc_lengths()) == 3
+    assert inverted_index.get_term_dictionary().expand_prefix("sen") == ["senat"]
@@ -0,0 +1,60 @@
+import os
+import signal
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import sharding  # noqa: E402
+
+WORDS = ["police", "court", "senate", "homicide", "county", "budget", "school", "river"]
+
+
+def docs(num_docs: int):
+    for doc_id in range(num_docs):
+        words = [WORDS[(doc_id * 7 + i * 3) % len(WORDS)] for i in range(12)]
+        yield {'id': doc_id, 'title': " ".join(words[:3]), 'content_str': " ".join(words)}
+
+
+@pytest.fixture
+def shards(tmp_path):
+    sharding.build_shards(docs(40), tmp_path, 40, 2, workers=1)
+    processes, addresses = sharding.start_local_shards(tmp_path)
+    yield processes, addresses
+    for process in processes:
+        os.kill(process.pid, signal.SIGCONT)
+        process.terminate()
+        process.join()
+
+
+@pytest.mark.skipif(not hasattr(signal, "SIGSTOP"), reason="needs SIGSTOP")
+def test_stalled_shard_does_not_exhaust_the_pool(shards):
+    processes, addresses = shards
+    coordinator = sharding.ShardCoordinator(addresses, timeout=0.2)
+    try:
+        assert coordinator.query("police")[3] is False
+        os.kill(processes[1].pid, signal.SIGSTOP)
+        # the signal is delivered asynchronously, wait until the shard is stopped
+        os.waitpid(processes[1].pid, os.WUNTRACED)
+        # more requests than the pool has threads, every call to the stalled shard times out
+        for _ in range(4 * len(addresses) * 2 + 1):
+            start_t = time.monotonic()
+            responses, partial = coordinator.scatter({shard_id: ("stats", ["polic"], "nltk")
+                                                      for shard_id in range(len(addresses))})
+            assert list(responses) == [0] and partial
+            assert time.monotonic() - start_t < 1.0
+        os.kill(processes[1].pid, signal.SIGCONT)
+        time.sleep(0.3)
+        matched_ids, _, _, partial = coordinator.query("police")
+        assert not partial and max(matched_ids) >= 20
+    finally:
+        coordinator.close()
+
+
+def test_remote_shards_need_an_authkey(monkeypatch):
+    monkeypatch.setattr(sharding, "AUTHKEY", None)
+    with pytest.raises(ValueError):
+        sharding.ShardCoordinator.from_env("localhost:7000")
@@ -1,35 +1,83 @@
 import re
-from typing import Set, Any, List
+from collections import Counter
+from typing import Set, Any, List, Dict, Optional
 
-from nltk.tokenize import word_tokenize  # type: ignore
-from nltk.stem.porter import PorterStemmer  # type: ignore
-from nltk.corpus import stopwords  # type: ignore
+from utils import LRUCache
+from tracing import span
+from tokenization import Tokenizer, NLTKTokenizer, get_tokenizer, DEFAULT_TOKENIZER
+
+NON_ALNUM = re.compile(r'[^a-zA-Z0-9\-]')
+
+
+def nltk_stop_words() -> List[str]:
+    """
+    the nltk english stop words. nltk is imported on first call, it takes a few hundred milliseconds
+    :return:
+    """
+    from nltk.corpus import stopwords  # type: ignore
+    return stopwords.words("english")
 
 
 class TextProcessing:
-    def __init__(self, stemmer, stop_words, *args):
+    def __init__(self, stemmer, stop_words, *args, cache_size: int = 200000, tokenizer: Tokenizer = None):
         """
         class TextProcessing is used to tokenize and normalize tokens that will be further used to build inverted index.
-        :param stemmer:
+        :param stemmer: None for the nltk Porter stemmer, loaded the first time a token is not in the term cache
         :param stop_words:
         :param args:
+        :param cache_size: number of surface forms whose normalized term is memoized
+        :param tokenizer: tokenization.Tokenizer, nltk word_tokenize by default
         """
-        self.stemmer = stemmer
+        self._stemmer = stemmer
         self.STOP_WORDS = stop_words
+        self.term_cache = LRUCache(cache_size)
+        self.tokenizer = tokenizer or NLTKTokenizer()
 
     @classmethod
     def from_nltk(
             cls,
-            stemmer: Any = PorterStemmer().stem,
-            stop_words: List[str] = stopwords.words("english"),
+            stemmer: Any = None,
+            stop_words: Optional[List[str]] = None,
+            tokenizer: str = DEFAULT_TOKENIZER,
     ) -> "TextProcessing":
         """
         initialize from nltk
-        :param stemmer:
-        :param stop_words:
+        :param stemmer: nltk Porter stemmer by default
+        :param stop_words: nltk english stop words by default
+        :param tokenizer: name of the tokenizer, see tokenization.get_tokenizer
+        :return:
+        """
+        if stop_words is None:
+            stop_words = nltk_stop_words()
+        return cls(stemmer, set(stop_words), tokenizer=get_tokenizer(tokenizer))
+
+    @classmethod
+    def from_state(cls, state: Dict, tokenizer: str = DEFAULT_TOKENIZER) -> "TextProcessing":
+        """
+        analyzer restored from its state (see state and analyzer_snapshot), without loading nltk
+        :param state:
+        :param tokenizer: name of the tokenizer, see tokenization.get_tokenizer
         :return:
         """
-        return cls(stemmer, set(stop_words))
+        tp = cls(None, state['stop_words'], cache_size=state['cache_size'], tokenizer=get_tokenizer(tokenizer))
+        for token, term in state['term_cache']:
+            tp.term_cache.put(token, term)
+        return tp
+
+    def state(self) -> Dict:
+        """
+        what the analyzer needs to normalize tokens: stop words and normalized terms of the cached surface forms
+        :return: dict of builtin types, so that it is serialized and loaded without importing nltk
+        """
+        return {'stop_words': set(self.STOP_WORDS), 'cache_size': self.term_cache.maxsize,
+                'term_cache': list(self.term_cache.items())}
+
+    @property
+    def stemmer(self):
+        if self._stemmer is None:
+            from nltk.stem.porter import PorterStemmer  # type: ignore
+            self._stemmer = PorterStemmer().stem
+        return self._stemmer
 
     def normalize(self, token: str) -> str:
         """
@@ -42,13 +90,28 @@ class TextProcessing:
         :return:
         """
         # TODO:
+        # surface forms repeat a lot across documents, so reuse the normalized term when possible
+        term = self.term_cache.get(token)
+        if term is None:
+            term = self._normalize(token)
+            self.term_cache.put(token, term)
+        return term
+
+    def _normalize(self, token: str) -> str:
         # lower case, remove non alphanumeric, remove stopwords
-        token = token.lower()
-        normal_token = re.sub(r'[^a-zA-Z0-9\-]', '', token)
-        if normal_token in self.STOP_WORDS or len(token) <= 1:
+        lower_token = token.lower()
+        normal_token = NON_ALNUM.sub('', lower_token)
+        if normal_token in self.STOP_WORDS or len(lower_token) <= 1:
             return ""
         else:
-            return TextProcessing.from_nltk().stemmer(normal_token)
+            return self.stemmer(normal_token)
+
+    def cache_info(self) -> dict:
+        """
+        hit/miss counters of the normalization cache
+        :return:
+        """
+        return self.term_cache.stats()
 
     def get_normalized_tokens(self, title: str, content: str) -> Set[str]:
         """
@@ -61,16 +124,48 @@ class TextProcessing:
         # TODO:
         token_set = set()
         # tokenize input strings and normalize tokens, make a set
-        if title is not None:
-            for token in word_tokenize(title):
-                token_set.add(self.normalize(token))
-        if content is not None:
-            for token in word_tokenize(content):
-                token_set.add(self.normalize(token))
+        with span("tokenize"):
+            texts = [self.tokenizer.tokenize(text) for text in (title, content) if text is not None]
+        with span("normalize"):
+            for tokens in texts:
+                for token in tokens:
+                    token_set.add(self.normalize(token))
         if "" in token_set:
             token_set.remove("")
         return token_set
 
+    def get_normalized_positions(self, title: str, content: str,
+                                 forms: Optional[Counter] = None) -> Dict[str, List[int]]:
+        """
+        positional version of get_normalized_tokens: map each normalized token to the ascending positions it occurs at.
+        positions count every token of the tokenizer, stop words included, so that phrase queries can check the
+        distance between terms. the content starts one position after the end of the title so that a phrase never
+        matches across both
+        :param title:
+        :param content:
+        :param forms: when given, the occurrences of each (normalized token, lower case token) are counted into it,
+            see term_dictionary.most_frequent_forms
+        :return:
+        """
+        positions = {}
+        pos = 0
+        with span("tokenize"):
+            texts = [self.tokenizer.tokenize(text) for text in (title, content) if text is not None]
+        with span("normalize"):
+            for tokens in texts:
+                for token in tokens:
+                    term = self.normalize(token)
+                    if term:
+                        if term in positions:
+                            positions[term].append(pos)
+                        else:
+                            positions[term] = [pos]
+                        if forms is not None:
+                            forms[term, token.lower()] += 1
+                    pos += 1
+                pos += 1
+        return positions
+
 
 if __name__ == "__main__":
     tp = TextProcessing.from_nltk()
@@ -0,0 +1,73 @@
+import os
+import re
+from typing import Dict, Iterator, List, Tuple, Type
+
+
+class Tokenizer:
+    """
+    splits a text into un-normalized tokens, the analyzers (TextProcessing, CustomizedTextProcessing) take any
+    Tokenizer
+    """
+    name = ""
+
+    def tokenize(self, text: str) -> List[str]:
+        raise NotImplementedError
+
+    def span_tokenize(self, text: str) -> Iterator[Tuple[int, int]]:
+        """
+        character offsets (start, end) of the tokens in the text
+        :param text:
+        :return:
+        """
+        raise NotImplementedError
+
+
+class NLTKTokenizer(Tokenizer):
+    """
+    nltk word_tokenize (punkt sentence splitting + treebank word tokenizer), the reference tokenizer
+    """
+    name = "nltk"
+
+    def __init__(self):
+        self._word_tokenize = None
+
+    def tokenize(self, text: str) -> List[str]:
+        if self._word_tokenize is None:
+            # importing nltk takes a few hundred milliseconds, only pay for it once something is tokenized
+            from nltk.tokenize import word_tokenize  # type: ignore
+            self._word_tokenize = word_tokenize
+        return self._word_tokenize(text)
+
+
+class RegexTokenizer(Tokenizer):
+    """
+    single compiled regex approximating word_tokenize for indexing: alphanumeric runs joined by inner dots and dashes
+    ("D.C", "double-digit") or by commas and colons followed by a digit ("3,36", "10:30"), with treebank's "n't"
+    contraction split ("ca", "n't").
+    punctuation is dropped instead of being returned as tokens since the analyzers discard it anyway
+    """
+    name = "regex"
+    PATTERN = re.compile(r"n['’]t\b|\w+(?=n['’]t\b)|\w+(?:[.\-]\w+|[,:]\d+)*", re.IGNORECASE)
+
+    def tokenize(self, text: str) -> List[str]:
+        return self.PATTERN.findall(text)
+
+    def span_tokenize(self, text: str) -> Iterator[Tuple[int, int]]:
+        for m in self.PATTERN.finditer(text):
+            yield m.span()
+
+
+TOKENIZERS: Dict[str, Type[Tokenizer]] = {cls.name: cls for cls in (NLTKTokenizer, RegexTokenizer)}
+# tokenizer of the analyzers used to build and query the index, the same one must be used for both
+DEFAULT_TOKENIZER = os.environ.get("BRS_TOKENIZER", NLTKTokenizer.name)
+
+
+def get_tokenizer(name: str) -> Tokenizer:
+    """
+    :param name: "nltk" or "regex"
+    :return:
+    """
+    try:
+        return TOKENIZERS[name]()
+    except KeyError:
+        raise ValueError(f"unknown tokenizer {name!r}, expected one of {sorted(TOKENIZERS)}")
@@ -0,0 +1,194 @@
+import json
+import logging
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from typing import Dict, List, Optional
+
+# upper bounds in seconds of the latency histogram buckets, the last bucket is unbounded
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+           30.0, 60.0, 300.0)
+
+slow_query_log = logging.getLogger("brs.slow_queries")
+
+
+class Histogram:
+    __slots__ = ("counts", "total", "count")
+
+    def __init__(self):
+        """
+        cumulative latency distribution of a stage, in the BUCKETS buckets
+        """
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, seconds: float) -> None:
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """
+        upper bound of the bucket of the q quantile
+        :param q: between 0 and 1
+        :return:
+        """
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= rank and seen:
+                return bound
+        return float("inf")
+
+
+# stage name -> histogram of its durations, for the whole process
+HISTOGRAMS: Dict[str, Histogram] = {}
+_lock = threading.Lock()
+
+
+class Trace:
+    __slots__ = ("name", "attrs", "stages", "start", "elapsed", "token")
+
+    def __init__(self, name: str, attrs: Dict):
+        """
+        the stages of one request or build: stage name -> [number of spans, total seconds]
+        :param name:
+        :param attrs: context written to the slow query log, e.g. the query
+        """
+        self.name = name
+        self.attrs = attrs
+        self.stages = {}
+        self.start = time.perf_counter()
+        self.elapsed = 0.0
+        self.token = None
+
+    def add(self, stage: str, seconds: float) -> None:
+        entry = self.stages.get(stage)
+        if entry is None:
+            self.stages[stage] = [1, seconds]
+        else:
+            entry[0] += 1
+            entry[1] += seconds
+
+    def breakdown(self) -> Dict[str, float]:
+        """
+        milliseconds spent in each stage
+        :return:
+        """
+        return {stage: round(seconds * 1000, 3) for stage, (_, seconds) in self.stages.items()}
+
+
+_trace: ContextVar[Optional[Trace]] = ContextVar("trace", default=None)
+# requests slower than this many seconds are written to the slow query log, None to disable it
+_slow_threshold: Optional[float] = None
+
+
+def record(stage: str, seconds: float) -> None:
+    """
+    add a duration to the histogram of the stage and to the current trace
+    :param stage:
+    :param seconds:
+    :return:
+    """
+    with _lock:
+        histogram = HISTOGRAMS.get(stage)
+        if histogram is None:
+            histogram = HISTOGRAMS[stage] = Histogram()
+        histogram.observe(seconds)
+    trace = _trace.get()
+    if trace is not None:
+        trace.add(stage, seconds)
+
+
+class span:
+    __slots__ = ("stage", "start", "elapsed")
+
+    def __init__(self, stage: str):
+        """
+        context manager timing a stage: with span("fetch_postings"): ...
+        the cost is two perf_counter calls and a histogram update, so spans can be left on around the hot path, but
+        not around each token
+        :param stage:
+        """
+        self.stage = stage
+        self.elapsed = 0.0
+
+    def __enter__(self) -> "span":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.elapsed = time.perf_counter() - self.start
+        record(self.stage, self.elapsed)
+
+
+def start_trace(name: str, **attrs) -> Trace:
+    """
+    start collecting the spans of the current request (or thread, or task) into a new trace
+    :param name: stage name of the whole trace, e.g. the endpoint
+    :param attrs:
+    :return:
+    """
+    trace = Trace(name, attrs)
+    trace.token = _trace.set(trace)
+    return trace
+
+
+def finish_trace(trace: Trace) -> Trace:
+    """
+    stop the trace: its duration is recorded as a span of the enclosing trace, if any, and the trace is written to
+    the slow query log when it took longer than the threshold
+    :param trace:
+    :return:
+    """
+    trace.elapsed = time.perf_counter() - trace.start
+    _trace.reset(trace.token)
+    record(trace.name, trace.elapsed)
+    if _slow_threshold is not None and trace.elapsed >= _slow_threshold:
+        slow_query_log.warning(json.dumps({"trace": trace.name, "ms": round(trace.elapsed * 1000, 3),
+                                           "stages": trace.breakdown(), **trace.attrs}, default=str))
+    return trace
+
+
+def current_trace() -> Optional[Trace]:
+    return _trace.get()
+
+
+def configure_slow_query_log(threshold_ms: float, path: Optional[str] = None) -> None:
+    """
+    log the traces that take at least threshold_ms milliseconds as JSON lines with their stage breakdown
+    :param threshold_ms:
+    :param path: file to append to, the log goes to the root logger handlers when it is not given
+    :return:
+    """
+    global _slow_threshold
+    _slow_threshold = threshold_ms / 1000
+    if path:
+        handler = logging.FileHandler(path, encoding="utf-8")
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        slow_query_log.addHandler(handler)
+        slow_query_log.propagate = False
+    slow_query_log.setLevel(logging.WARNING)
+
+
+def metrics_text(prefix: str = "brs") -> str:
+    """
+    the histograms in the prometheus text exposition format
+    :param prefix:
+    :return:
+    """
+    name = f"{prefix}_stage_seconds"
+    lines: List[str] = [f"# HELP {name} duration of the traced stages", f"# TYPE {name} histogram"]
+    with _lock:
+        histograms = {stage: (list(h.counts), h.total, h.count) for stage, h in sorted(HISTOGRAMS.items())}
+    for stage, (counts, total, count) in histograms.items():
+        cumulative = 0
+        for bound, bucket_count in zip(BUCKETS + ("+Inf",), counts):
+            cumulative += bucket_count
+            lines.append(f'{name}_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_sum{{stage="{stage}"}} {total}')
+        lines.append(f'{name}_count{{stage="{stage}"}} {count}')
+    return "\n".join(lines) + "\n"
@@ -1,27 +1,139 @@
-from typing import Dict, Union, Generator
+from typing import Dict, Union, Generator, Any, Hashable, Optional, List, Tuple
+from collections import OrderedDict
 import functools
 import os
+import threading
 import time
 import json
 import re
 from datetime import datetime
 
+from tracing import start_trace, finish_trace
+
+try:
+    # optional faster JSON parser
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
+
 
 def timer(func):
+    """
+    trace the calls of func (see tracing): the duration of each call and of the stages traced inside it are recorded
+    in the stage histograms, and printed
+    :param func:
+    :return:
+    """
     @functools.wraps(func)
     def wrapper_timer(*args, **kwargs):
-        start_t = time.perf_counter()
-        f_value = func(*args, **kwargs)
-        elapsed_t = time.perf_counter() - start_t
+        trace = start_trace(func.__name__)
+        try:
+            f_value = func(*args, **kwargs)
+        finally:
+            finish_trace(trace)
+        elapsed_t = trace.elapsed
         mins = elapsed_t // 60
         print(
             f"'{func.__name__}' elapsed time: {mins} minutes, {elapsed_t - mins * 60:0.2f} seconds"
         )
+        if trace.stages:
+            print("    " + ", ".join(f"{stage}: {seconds:0.2f}s" for stage, (_, seconds) in trace.stages.items()))
         return f_value
 
     return wrapper_timer
 
 
+class LRUCache:
+    def __init__(self, maxsize: int = 100000):
+        """
+        thread-safe bounded mapping that evicts the least recently used entry once maxsize entries are stored.
+        hits and misses are counted so that the cache efficiency can be inspected
+        :param maxsize:
+        """
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        # reentrant so that subclasses can hold it around the calls to these methods
+        self._lock = threading.RLock()
+
+    def get(self, key: Hashable, default: Optional[Any] = None) -> Any:
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._data
+
+    def items(self) -> List[Tuple[Hashable, Any]]:
+        """
+        the entries from the least to the most recently used, without counting them as lookups
+        :return:
+        """
+        with self._lock:
+            return list(self._data.items())
+
+    def stats(self) -> Dict[str, Union[int, float]]:
+        lookups = self.hits + self.misses
+        return {"size": len(self._data), "maxsize": self.maxsize, "hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0}
+
+
+class TTLCache(LRUCache):
+    def __init__(self, maxsize: int = 1024, ttl: float = 300.0):
+        """
+        LRUCache whose entries also expire ttl seconds after they were stored
+        :param maxsize:
+        :param ttl: time to live of an entry in seconds
+        """
+        super().__init__(maxsize)
+        self.ttl = ttl
+
+    def get(self, key: Hashable, default: Optional[Any] = None) -> Any:
+        with self._lock:
+            entry = super().get(key)
+            if entry is None:
+                return default
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._data[key]
+                # an expired entry is a miss
+                self.hits -= 1
+                self.misses += 1
+                return default
+            return value
+
+    def put(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            super().put(key, (time.monotonic() + self.ttl, value))
+
+    def clear(self) -> None:
+        with self._lock:
+            super().clear()
+
+
 CLEANR = re.compile('<.*?>|&([a-z0-9]+|#[0-9]{1,6}|#x[0-9a-f]{1,6});')
 
 
@@ -30,7 +142,8 @@ def cleanhtml(raw_html):
     return cleantext
 
 
-def load_wapo(wapo_jl_path: Union[str, os.PathLike]) -> Generator[Dict, None, None]:
+def load_wapo(wapo_jl_path: Union[str, os.PathLike], start: int = 0,
+              id_offset: int = 0) -> Generator[Dict, None, None]:
     """
     Unlike HW2, load_wapo should be an iterator in this assignment. It's more memory-efficient when you need to
     load each document and build the inverted index.
@@ -52,31 +165,42 @@ def load_wapo(wapo_jl_path: Union[str, os.PathLike]) -> Generator[Dict, None, No
             %: from datetime import datetime
             %: doc["published_date"] = datetime.fromtimestamp(doc["published_date"] / 1000.0)
 
+    The file is streamed line by line, so memory does not grow with the size of the corpus.
+
     :param wapo_jl_path:
+    :param start: id of the first document to yield, the lines before it are skipped without being parsed
+    :param id_offset: id of the first line, to append a file to a corpus that is already loaded
     :return:
     """
     # TODO:
 
-    idx = 0  # counter for article id
-    data = []  # list to hold json lines
-    for json_line in open(wapo_jl_path):
-        data.append(json.loads(json_line))  # append json line to list
-
-    for article in data:
-        content_str = ""
-        for content in article["contents"]:
-            if content is not None:
-                if content["type"] == "sanitized_html":
-                    content_str += " " + content["content"]
-
-        article_dict = {"id": idx,
-                        "title": article["title"],
-                        "author": article["author"],
-                        "published_date": datetime.fromtimestamp(article["published_date"] / 1000.0).strftime(
-                            '%m/%d/%Y'),
-                        "content_str": cleanhtml(content_str)}
-        idx += 1
-        yield article_dict
+    with open(wapo_jl_path, "rb") as f:
+        for idx, json_line in enumerate(f, id_offset):  # the article id is the line number
+            if idx < start:
+                continue
+            yield parse_wapo_article(json_loads(json_line), idx)
+
+
+def parse_wapo_article(article: Dict, idx: int) -> Dict:
+    """
+    convert one raw WAPO article to the document format described in load_wapo
+    :param article: parsed json line
+    :param idx: article id
+    :return:
+    """
+    content_str = ""
+    for content in article["contents"]:
+        if content is not None:
+            if content["type"] == "sanitized_html":
+                content_str += " " + content["content"]
+
+    article_dict = {"id": idx,
+                    "title": article["title"],
+                    "author": article["author"],
+                    "published_date": datetime.fromtimestamp(article["published_date"] / 1000.0).strftime(
+                        '%m/%d/%Y'),
+                    "content_str": cleanhtml(content_str)}
+    return article_dict
 
 
 if __name__ == "__main__":